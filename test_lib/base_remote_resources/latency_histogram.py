@@ -0,0 +1,117 @@
+"""Log-bucketed latency histograms, in the manner of HdrHistogram.
+
+Latencies are recorded in microseconds. Values below 2^(SUB_BITS + 1) have a
+bucket each; above, values sharing their highest SUB_BITS + 1 bits share a
+bucket, so a bucket is at most 1/2^SUB_BITS (about 3%) wider than its values
+whatever their magnitude, and a few hundred buckets cover microseconds to
+hours. Histograms are sparse, so they merge by adding counts and are small
+enough to print every few seconds.
+
+The load generator prints one line per interval with the histograms of the
+interval:
+    LATENCY {"time": <end>, "interval": 5, "mongos": "host:port",
+             "ops": {"query": <to_dict()>, ...}}
+See latency_report for reading them back.
+"""
+
+import json
+
+SUB_BITS = 5
+# Prefix of the lines with histograms in the logs of load generators.
+LINE_PREFIX = 'LATENCY '
+
+
+def bucket_of(value):
+    """The bucket of a value, buckets increase with their values."""
+    value = int(value)
+    if value < 2 << SUB_BITS:
+        return max(0, value)
+    shift = value.bit_length() - SUB_BITS - 1
+    return (shift << SUB_BITS) + (value >> shift)
+
+
+def bucket_range(bucket):
+    """The lowest and highest value of a bucket."""
+    if bucket < 2 << SUB_BITS:
+        return bucket, bucket
+    shift = (bucket >> SUB_BITS) - 1
+    mantissa = bucket - (shift << SUB_BITS)
+    return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+
+class Histogram(object):
+    """Counts of latencies per bucket.
+
+    Attributes:
+        counts: (dict of int to int) Values recorded per bucket.
+        max: (int) The highest value recorded, exactly.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.max = 0
+
+    def record(self, micros):
+        b = bucket_of(micros)
+        self.counts[b] = self.counts.get(b, 0) + 1
+        self.max = max(self.max, int(micros))
+
+    def merge(self, other):
+        """Add the values of other to this histogram."""
+        for b, n in other.counts.iteritems():
+            self.counts[b] = self.counts.get(b, 0) + n
+        self.max = max(self.max, other.max)
+        return self
+
+    def total(self):
+        return sum(self.counts.itervalues())
+
+    def percentile(self, p):
+        """The value below which p percent of the values are, as the highest
+        value of its bucket. 0 if empty."""
+        total = self.total()
+        if not total:
+            return 0
+        rank = p / 100.0 * total
+        seen = 0
+        for b in sorted(self.counts):
+            seen += self.counts[b]
+            if seen >= rank:
+                return min(bucket_range(b)[1], self.max)
+        return self.max
+
+    def to_dict(self):
+        """JSON serializable form, see from_dict()."""
+        return {'counts': dict((str(b), n) for b, n in self.counts.items()),
+                'max': self.max}
+
+    @staticmethod
+    def from_dict(d):
+        h = Histogram()
+        h.counts = dict((int(b), n) for b, n in d['counts'].items())
+        h.max = d['max']
+        return h
+
+
+def format_line(end, interval, mongos, histograms):
+    """The LATENCY line of the histograms of ops recorded in an interval.
+
+    Args:
+        end: (float) When the interval ended.
+        interval: (float) Seconds of the interval.
+        mongos: (str) 'host:port' loaded.
+        histograms: (dict of str to Histogram) Per op.
+    """
+    return LINE_PREFIX + json.dumps({
+        'time': end, 'interval': interval, 'mongos': mongos,
+        'ops': dict((op, h.to_dict()) for op, h in histograms.items())})
+
+
+def parse_line(line):
+    """The dict of a LATENCY line with Histograms in 'ops', None if line is
+    not one."""
+    if not line.startswith(LINE_PREFIX):
+        return None
+    d = json.loads(line[len(LINE_PREFIX):])
+    d['ops'] = dict((op, Histogram.from_dict(h))
+                    for op, h in d['ops'].items())
+    return d
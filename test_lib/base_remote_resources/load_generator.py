@@ -0,0 +1,316 @@
+#!/usr/bin/python
+"""Load generator runs the operations of PerfTest in driver.js from Python,
+with many clients in every process:
+
+    python base_remote_resources/load_generator.py <host:port> [options]
+
+Every client is a thread with its own client id, inserting documents in
+order and querying, updating and deleting them like a mongo shell running
+PerfTest does, chosen at random by the percentages of --ops. The clients are
+spread over --processes processes, by default one per core, which share a
+connection pool each. Every --report-interval seconds one line with the
+operations of all clients is printed, instead of one printjson per operation,
+followed by a LATENCY line with the latency histograms of every op in the
+interval, see latency_histogram.
+
+pymongo is needed on the host, see LoadGenerator in console_config.
+"""
+
+import argparse
+import math
+import multiprocessing
+import os
+import Queue
+import random
+import signal
+import sys
+import threading
+import time
+
+import pymongo
+from bson.objectid import ObjectId
+
+from latency_histogram import Histogram, format_line
+
+OPS = ['query', 'insert', 'update', 'delete']
+# Percentages of PerfTest.
+DEFAULT_OPS = 'query=40,insert=30,update=5,delete=5'
+# Names of the fields with the value smeared over 2^1 to 2^32.
+MIX_FIELD_NAMES = ['mix2^%d' % i for i in range(32)]
+# Values of the largest range queried.
+MAX_QUERY_RANGE = 300
+
+TWO_TO_31 = 2 ** 31
+TWO_TO_32 = 2 ** 32
+
+
+def wrap(value):
+    """Wrap value into [-2^31, 2^31)."""
+    return (int(value) + TWO_TO_31) % TWO_TO_32 - TWO_TO_31
+
+
+def smear_over(value, power_of_2_range):
+    """value moved at random within a range of 2^power_of_2_range."""
+    size = 2 ** power_of_2_range
+    return wrap(value - size // 2 + random.randrange(size))
+
+
+def add_mix_clauses(query, value_range, shard_key_mix, index_mix):
+    """Add the clauses on the shard key and index fields matching
+    value_range to query."""
+    for mix in (shard_key_mix, index_mix):
+        amount = 2 ** mix
+        query[MIX_FIELD_NAMES[mix]] = {'$gte': value_range[0] - amount,
+                                       '$lt': value_range[1] + amount}
+
+
+def parse_ops(s):
+    """Parse 'query=40,insert=30,...' into a list of (op, percent)."""
+    percents = []
+    for item in s.split(','):
+        op, _, percent = item.partition('=')
+        if op not in OPS:
+            raise ValueError('Unknown op <%s>, use one of %s' %
+                             (op, ', '.join(OPS)))
+        percents.append((op, float(percent)))
+    return percents
+
+
+class Client(object):
+    """One logical client of PerfTest on a collection.
+
+    Attributes:
+        counts: (dict of str to int) Operations done per op, and 'errors'.
+    """
+    def __init__(self, coll, shard_key_mix, index_mix):
+        self._coll = coll
+        self._shard_key_mix = shard_key_mix
+        self._index_mix = index_mix
+        self._client_id = ObjectId()
+        # Values inserted, and the next to update and delete.
+        self._max_range = [0, 0]
+        self._max_update = 0
+        self._max_delete = 1
+        self.counts = dict((op, 0) for op in OPS + ['errors'])
+        # Latencies of ops since take_histograms().
+        self._histograms = dict((op, Histogram()) for op in OPS)
+        self._lock = threading.Lock()
+
+    def take_histograms(self):
+        """The latency histograms of ops since the last call, per op."""
+        fresh = dict((op, Histogram()) for op in OPS)
+        with self._lock:
+            taken, self._histograms = self._histograms, fresh
+        return taken
+
+    def _id(self, value):
+        return '%d%s' % (value, self._client_id)
+
+    def query(self):
+        low, high = self._max_range
+        if high - low >= MAX_QUERY_RANGE:
+            low = int(random.random() * (high - MAX_QUERY_RANGE))
+            high = low + MAX_QUERY_RANGE
+        # Only even values match the query, the sparsity is 2^1.
+        low += low % 2
+        high -= high % 2
+        query = {'clientId': self._client_id,
+                 'value': {'$mod': [2, 0], '$gte': low, '$lt': high}}
+        add_mix_clauses(query, (low, high), self._shard_key_mix,
+                        self._index_mix)
+        expected = low
+        for doc in self._coll.find(query).sort('value', 1):
+            if doc['value'] != expected:
+                self.counts['errors'] += 1
+                return
+            expected += 2
+        if expected != low + 2 * int(math.ceil((high - low) / 2.0)):
+            self.counts['errors'] += 1
+
+    def insert(self):
+        value = wrap(self._max_range[1])
+        doc = {'_id': self._id(value), 'clientId': self._client_id,
+               'value': value}
+        for i in range(32):
+            doc[MIX_FIELD_NAMES[i]] = smear_over(value, i + 1)
+        self._coll.insert(doc)
+        self._max_range[1] += 1
+
+    def update(self):
+        # Don't update unless there are documents there already.
+        if self._max_update >= self._max_range[1] - 1:
+            return
+        value = wrap(self._max_update)
+        query = {'_id': self._id(value), 'clientId': self._client_id,
+                 'value': value}
+        add_mix_clauses(query, (value, value), self._shard_key_mix,
+                        self._index_mix)
+        self._coll.update(query, {'$set': {'updateData': ObjectId()}})
+        self._max_update += 2
+
+    def delete(self):
+        if self._max_delete >= self._max_range[1] - 1:
+            return
+        value = wrap(self._max_delete)
+        query = {'_id': self._id(value), 'clientId': self._client_id,
+                 'value': value}
+        add_mix_clauses(query, (value, value), self._shard_key_mix,
+                        self._index_mix)
+        self._coll.remove(query)
+        self._max_delete += 2
+
+    def run(self, op_percents, stop):
+        """Do operations chosen at random until stop is set."""
+        total = sum(p for _, p in op_percents)
+        while not stop.is_set():
+            choice = random.random() * total
+            for op, percent in op_percents:
+                if choice < percent:
+                    break
+                choice -= percent
+            start = time.time()
+            try:
+                getattr(self, op)()
+            except pymongo.errors.PyMongoError:
+                self.counts['errors'] += 1
+                # E.g. the mongos restarts, don't spin.
+                stop.wait(1)
+                continue
+            with self._lock:
+                self._histograms[op].record((time.time() - start) * 1e6)
+            self.counts[op] += 1
+
+
+def run_worker(args, indexes, reports):
+    """Run the clients with indexes in this process, putting the operations
+    done since the last report on reports every report interval.
+
+    Client i starts --wait-for plus i times --ramp-up seconds after the
+    worker.
+    """
+    host, _, port = args.host.partition(':')
+    while True:
+        try:
+            conn = pymongo.Connection(host, int(port or 27017),
+                                      max_pool_size=len(indexes))
+            break
+        except pymongo.errors.ConnectionFailure as e:
+            print 'Connecting to %s failed, retry: %s' % (args.host, e)
+            sys.stdout.flush()
+            time.sleep(1)
+    db_name, _, coll_name = args.collection.partition('.')
+    coll = conn[db_name][coll_name]
+    op_percents = parse_ops(args.ops)
+    stop = threading.Event()
+    clients = []
+
+    def start_client(index):
+        stop.wait(max(0, start + args.wait_for + index * args.ramp_up -
+                      time.time()))
+        if stop.is_set():
+            return
+        client = Client(coll, args.shard_key_mix, args.index_mix)
+        clients.append(client)
+        client.run(op_percents, stop)
+
+    start = time.time()
+    for i in indexes:
+        t = threading.Thread(target=start_client, args=(i,))
+        t.daemon = True
+        t.start()
+
+    parent = os.getppid()
+    last = dict((op, 0) for op in OPS + ['errors'])
+    while os.getppid() == parent:
+        time.sleep(args.report_interval)
+        counts = dict((op, sum(c.counts[op] for c in list(clients)))
+                      for op in last)
+        histograms = dict((op, Histogram()) for op in OPS)
+        for c in list(clients):
+            for op, h in c.take_histograms().items():
+                histograms[op].merge(h)
+        reports.put((len(clients),
+                     dict((op, counts[op] - last[op]) for op in counts),
+                     dict((op, h.to_dict()) for op, h in histograms.items())))
+        last = counts
+    # The parent went away, stop.
+    stop.set()
+
+
+def main():
+    """Main method that starts the worker processes and prints what they
+    report."""
+    parser = argparse.ArgumentParser(
+        description='Generate the load of PerfTest with many clients.')
+    parser.add_argument('host', help='host:port of the mongos')
+    parser.add_argument('--collection', default='foo.bar')
+    parser.add_argument('--clients', type=int, default=100,
+                        help='clients in all processes')
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--ops', default=DEFAULT_OPS,
+                        help='percentages of operations, default %(default)s')
+    parser.add_argument('--shard-key-mix', type=int, default=5)
+    parser.add_argument('--index-mix', type=int, default=4)
+    parser.add_argument('--wait-for', type=float, default=0,
+                        help='seconds before the first client starts')
+    parser.add_argument('--ramp-up', type=float, default=0,
+                        help='seconds between the starts of clients')
+    parser.add_argument('--report-interval', type=float, default=5)
+    args = parser.parse_args()
+    parse_ops(args.ops)  # Fail early on bad ops.
+
+    # Stop the workers too when the process manager terminates us.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    processes = max(1, min(args.processes, args.clients))
+    reports = multiprocessing.Queue()
+    workers = []
+    for i in range(processes):
+        # Client i runs in process i % processes, so that clients ramping
+        # up are spread over the processes.
+        w = multiprocessing.Process(
+            target=run_worker,
+            args=(args, range(i, args.clients, processes), reports))
+        w.daemon = True
+        w.start()
+        workers.append(w)
+    print 'Started %d clients in %d processes on %s' % (
+        args.clients, processes, args.host)
+    sys.stdout.flush()
+
+    try:
+        total = 0
+        while True:
+            # One report of every worker per interval.
+            running = 0
+            counts = dict((op, 0) for op in OPS + ['errors'])
+            histograms = dict((op, Histogram()) for op in OPS)
+            if not any(w.is_alive() for w in workers):
+                print 'All workers exited.'
+                sys.exit(1)
+            for _ in workers:
+                try:
+                    clients, delta, latencies = reports.get(
+                        timeout=2 * args.report_interval + 5)
+                except Queue.Empty:
+                    continue
+                running += clients
+                for op in delta:
+                    counts[op] += delta[op]
+                for op, h in latencies.items():
+                    histograms[op].merge(Histogram.from_dict(h))
+            ops = sum(counts[op] for op in OPS)
+            total += ops
+            print 'Current stats: %d ops, %.0f ops/s, %d clients, %s' % (
+                total, ops / args.report_interval, running,
+                ' '.join('%s=%d' % (op, counts[op])
+                         for op in OPS + ['errors']))
+            print format_line(time.time(), args.report_interval, args.host,
+                              histograms)
+            sys.stdout.flush()
+    finally:
+        for w in workers:
+            w.terminate()
+
+if __name__ == '__main__':
+    main()
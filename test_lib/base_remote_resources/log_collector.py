@@ -0,0 +1,105 @@
+#!/usr/bin/python
+"""Log collector receives the output of processes forwarded by process
+managers, see process_manager.LogForwarder, and writes it to '<dir>/<tag>.log'.
+
+    python base_remote_resources/log_collector.py <port> [<dir>]
+
+Every line received is '<tag> <line>', or '! dropped <tag> <n>' when a process
+manager had to drop n lines of tag because the collector fell behind. Drops
+are noted in the log of the tag and the totals are kept in
+'<dir>/dropped.json'.
+"""
+
+import json
+import os
+import socket
+import sys
+
+from process_manager import LineReader, Poller
+
+# File in the collector's dir with the lines dropped for every tag.
+DROPPED_FILE = 'dropped.json'
+
+
+class Collector(object):
+    """Accepts forwarders and writes their lines to one file per tag.
+
+    Attributes:
+        port: (int) The port listened on.
+        directory: (str) Where the logs are written.
+        dropped: (dict of str to int) Lines dropped for every tag so far.
+    """
+
+    def __init__(self, port, directory):
+        self.port = port
+        self.directory = directory
+        self.dropped = {}
+        # Map from tag to the open log file.
+        self._files = {}
+        # Map from fd to (socket, LineReader) of connected forwarders.
+        self._clients = {}
+
+    def start(self):
+        """Collect until killed."""
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind(('', self.port))
+        server_socket.listen(128)
+        print 'Collecting logs on port %d in %s' % (self.port, self.directory)
+
+        poller = Poller()
+        poller.register(server_socket, Poller.READ)
+        while True:
+            for ready, _ in poller.poll(1):
+                if ready is server_socket:
+                    client, address = server_socket.accept()
+                    print 'Forwarder connected from %s:%d' % address
+                    self._clients[client.fileno()] = (client,
+                                                      LineReader(client))
+                    poller.register(client, Poller.READ)
+                    continue
+                client, reader = self._clients[ready.fileno()]
+                try:
+                    lines = reader.read_lines()
+                except socket.error:
+                    lines = None
+                if lines is None:
+                    # The process manager went away, it reconnects if needed.
+                    poller.unregister(client.fileno())
+                    del self._clients[client.fileno()]
+                    client.close()
+                    continue
+                for line in lines:
+                    self._write(line)
+            for f in self._files.values():
+                f.flush()
+
+    def _write(self, line):
+        """Write a line received to the log of its tag."""
+        tag, _, text = line.partition(' ')
+        if tag == '!':
+            # '! dropped <tag> <n>'
+            _, tag, number = text.split()
+            self.dropped[tag] = self.dropped.get(tag, 0) + int(number)
+            text = '[log_collector] %s lines dropped by the forwarder\n' % number
+            with open(os.path.join(self.directory, DROPPED_FILE), 'w') as f:
+                json.dump(self.dropped, f, indent=2, sort_keys=True)
+        if tag not in self._files:
+            self._files[tag] = open(
+                os.path.join(self.directory,
+                             tag.replace(os.sep, '_') + '.log'), 'a')
+        self._files[tag].write(text)
+
+
+def main():
+    """Main method that collects on a given port into a given directory."""
+    port = int(sys.argv[1])
+    directory = 'collected'
+    if len(sys.argv) > 2:
+        directory = sys.argv[2]
+    Collector(port, directory).start()
+
+if __name__ == '__main__':
+    main()
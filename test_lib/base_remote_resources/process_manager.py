@@ -3,6 +3,9 @@
 manages processes and relanch processes when they crash.
 """
 
+import collections
+import errno
+import json
 import os
 import re
 import select
@@ -52,6 +55,282 @@ class LineReader(object):
         return lines
 
 
+class Poller(object):
+    """Wait for I/O readiness on many objects with fileno().
+
+    Uses epoll when available, poll() otherwise, so that it is not limited by
+    FD_SETSIZE like select(), and falls back to select() on platforms having
+    neither.
+    """
+    READ = 1
+    WRITE = 4
+
+    def __init__(self):
+        self._objects = {}  # Map from fd to (object, events).
+        self._millis = False  # Whether poll() takes milliseconds.
+        if hasattr(select, 'epoll'):
+            self._impl = select.epoll()
+            self._read_bits = select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR
+            self._write_bits = select.EPOLLOUT
+        elif hasattr(select, 'poll'):
+            self._impl = select.poll()
+            self._read_bits = select.POLLIN | select.POLLHUP | select.POLLERR
+            self._write_bits = select.POLLOUT
+            self._millis = True
+        else:
+            self._impl = None
+
+    def _mask(self, events):
+        mask = 0
+        if events & Poller.READ:
+            mask |= self._read_bits
+        if events & Poller.WRITE:
+            mask |= self._write_bits
+        return mask
+
+    def register(self, obj, events):
+        """Watch obj for READ and/or WRITE events, or change them if watched.
+
+        Registering with no events stops watching obj.
+        """
+        fd = obj.fileno()
+        if not events:
+            self.unregister(fd)
+            return
+        if self._impl is not None:
+            if fd in self._objects:
+                try:
+                    self._impl.modify(fd, self._mask(events))
+                except (IOError, OSError) as e:
+                    # The fd was closed and reused, so the kernel forgot it.
+                    if e.errno != errno.ENOENT:
+                        raise
+                    self._impl.register(fd, self._mask(events))
+            else:
+                self._impl.register(fd, self._mask(events))
+        self._objects[fd] = (obj, events)
+
+    def unregister(self, fd):
+        """Stop watching the file descriptor fd.
+
+        The fd is used rather than the object, since the object may have
+        closed its file already.
+        """
+        if fd not in self._objects:
+            return
+        del self._objects[fd]
+        if self._impl is not None:
+            try:
+                self._impl.unregister(fd)
+            except (IOError, OSError, ValueError):
+                pass  # Already removed when the file was closed.
+
+    def registered(self):
+        """Map from fd to (object, events) being watched."""
+        return self._objects
+
+    def poll(self, timeout):
+        """Wait for events.
+
+        Args:
+            timeout: (float) Seconds to wait at most.
+
+        Returns:
+            A list of (object, events) that became ready.
+        """
+        if self._impl is None:
+            rlist = [o for o, e in self._objects.values() if e & Poller.READ]
+            wlist = [o for o, e in self._objects.values() if e & Poller.WRITE]
+            r, w, _ = select.select(rlist, wlist, [], timeout)
+            ready = dict((o.fileno(), Poller.READ) for o in r)
+            for o in w:
+                ready[o.fileno()] = ready.get(o.fileno(), 0) | Poller.WRITE
+        else:
+            if self._millis:
+                timeout = int(timeout * 1000)
+            ready = {}
+            try:
+                pairs = self._impl.poll(timeout)
+            except (IOError, select.error) as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                pairs = []
+            for fd, mask in pairs:
+                events = 0
+                if mask & self._read_bits:
+                    events |= Poller.READ
+                if mask & self._write_bits:
+                    events |= Poller.WRITE
+                ready[fd] = events
+        return [(self._objects[fd][0], events) for fd, events in ready.items()
+                if fd in self._objects]
+
+
+class ProcStats(object):
+    """Sample CPU and memory usage of processes from /proc.
+
+    Only Linux has /proc/<pid>/stat. Elsewhere the usage is unknown.
+    """
+
+    def __init__(self):
+        self._hz = os.sysconf('SC_CLK_TCK')
+        self._page_kb = os.sysconf('SC_PAGE_SIZE') / 1024
+        # Map from pid to (cpu ticks, time) of the previous sample.
+        self._last = {}
+
+    def sample(self, pid):
+        """Sample a process.
+
+        Returns:
+            (cpu, rss) CPU percent since the previous sample and resident
+            memory in KB, or (None, None) if unknown. CPU is None on the first
+            sample of a pid.
+        """
+        try:
+            with open('/proc/%d/stat' % pid, 'r') as f:
+                stat = f.read()
+        except (IOError, TypeError):
+            self._last.pop(pid, None)
+            return None, None
+        # The command name in parentheses may contain spaces.
+        fields = stat[stat.rfind(')') + 2:].split()
+        ticks = int(fields[11]) + int(fields[12])  # utime + stime
+        rss = int(fields[21]) * self._page_kb
+        now = time.time()
+        cpu = None
+        if pid in self._last:
+            last_ticks, last_time = self._last[pid]
+            if now > last_time:
+                cpu = (100.0 * (ticks - last_ticks) / self._hz /
+                       (now - last_time))
+        self._last[pid] = (ticks, now)
+        return cpu, rss
+
+    def forget(self, live_pids):
+        """Drop samples of pids not in live_pids."""
+        for pid in set(self._last) - set(live_pids):
+            del self._last[pid]
+
+
+class LogForwarder(threading.Thread):
+    """Sends the output of processes to a log collector over TCP, see
+    log_collector.py.
+
+    Monitors queue the lines of their process with put(), and this thread
+    sends them in batches, one '<tag> <line>' per line. The queue is bounded:
+    when the collector or the network falls behind, the queue fills up and
+    new lines are dropped instead of blocking the processes. The collector is
+    told how many lines of every tag were dropped with '! dropped <tag> <n>'.
+    The log file of a process always has every line.
+
+    Attributes:
+        address: (str, int) The address of the collector.
+        dropped: (dict of str to int) Lines dropped so far for every tag.
+    """
+    # Lines queued at most before new lines are dropped.
+    MAX_QUEUED = 10000
+    # Lines sent in a batch at most.
+    BATCH_LINES = 500
+    # Seconds to wait for a batch to fill up.
+    BATCH_INTERVAL = 0.2
+    # Seconds between attempts to connect to the collector.
+    RECONNECT_INTERVAL = 1
+
+    def __init__(self, address):
+        super(LogForwarder, self).__init__()
+        self.daemon = True
+        self.address = address
+        self.dropped = {}
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        # Lines dropped since the collector was last told.
+        self._unreported = {}
+        self._socket = None
+
+    def put(self, tag, line):
+        """Queue a line of output of tag, or drop it if the queue is full."""
+        with self._condition:
+            if len(self._queue) >= LogForwarder.MAX_QUEUED:
+                self.dropped[tag] = self.dropped.get(tag, 0) + 1
+                self._unreported[tag] = self._unreported.get(tag, 0) + 1
+                return
+            if not line.endswith('\n'):
+                line += '\n'
+            self._queue.append('%s %s' % (tag, line))
+            if len(self._queue) >= LogForwarder.BATCH_LINES:
+                self._condition.notify()
+
+    def run(self):
+        """Send batches until the process manager exits."""
+        while True:
+            with self._condition:
+                if len(self._queue) < LogForwarder.BATCH_LINES:
+                    self._condition.wait(LogForwarder.BATCH_INTERVAL)
+                batch = [self._queue.popleft() for _ in
+                         range(min(len(self._queue), LogForwarder.BATCH_LINES))]
+                unreported = self._unreported.items()
+                self._unreported = {}
+            markers = ['! dropped %s %d\n' % item for item in unreported]
+            if not batch and not markers:
+                continue
+            sent = self._send(''.join(batch + markers))
+            # The collector ignores a line cut off by a failure, so a line
+            # counts as sent only if all of it was.
+            unsent = []
+            for line in batch:
+                sent -= len(line)
+                if sent < 0:
+                    unsent.append(line)
+            unsent_markers = []
+            for marker, item in zip(markers, unreported):
+                sent -= len(marker)
+                if sent < 0:
+                    unsent_markers.append(item)
+            if unsent or unsent_markers:
+                # Try again later. Meanwhile the queue fills up and new lines
+                # are dropped, which is the backpressure.
+                self._requeue(unsent, unsent_markers)
+                time.sleep(LogForwarder.RECONNECT_INTERVAL)
+
+    def _requeue(self, lines, unreported):
+        """Put lines not sent back in front of the queue, dropping the newest
+        lines beyond MAX_QUEUED, and unreported counts back to be reported.
+
+        Args:
+            lines: (list of str) '<tag> <line>' in order.
+            unreported: (list of (str, int)) Dropped lines not reported yet
+                per tag.
+        """
+        with self._condition:
+            for tag, number in unreported:
+                self._unreported[tag] = self._unreported.get(tag, 0) + number
+            self._queue.extendleft(reversed(lines))
+            while len(self._queue) > LogForwarder.MAX_QUEUED:
+                tag = self._queue.pop().partition(' ')[0]
+                self.dropped[tag] = self.dropped.get(tag, 0) + 1
+                self._unreported[tag] = self._unreported.get(tag, 0) + 1
+
+    def _send(self, data):
+        """Send data on a blocking socket, connecting first if needed.
+
+        Returns:
+            (int) The bytes of data sent, less than len(data) on failure.
+        """
+        sent = 0
+        try:
+            if self._socket is None:
+                self._socket = socket.create_connection(self.address)
+            while sent < len(data):
+                sent += self._socket.send(data[sent:])
+            return sent
+        except socket.error as e:
+            print 'Log collector %s:%d:' % self.address, e
+            if self._socket is not None:
+                self._socket.close()
+                self._socket = None
+            return sent
+
+
 class Monitor(threading.Thread):
     """Monitor of a process.
 
@@ -69,6 +348,14 @@ class Monitor(threading.Thread):
             the process and the Monitor.
         in_r, in_w: The read and write file descriptors of input of process.
         out_r, out_w: The read and write file descriptors of output of process.
+        state: (str) STARTING, RUNNING, DIED_STATE or FINISHED_STATE, as last
+            reported to the Manager.
+        pid: (int) The pid of the latest process, None before lanched.
+        restarts: (int) Times the process has been relanched.
+        started: (float) When the latest process was lanched.
+        forward: (str, LogForwarder) The tag and forwarder that the output
+            of the process is sent to besides its log file, None if it is
+            not forwarded.
     """
     # Commands used between Monitor and Manager.
     READY = 'ready\n'
@@ -78,7 +365,13 @@ class Monitor(threading.Thread):
     DIED = 'died\n'
     FINISHED = 'finished\n'
 
-    def __init__(self, command_str, alias=None):
+    # States reported to console in response to 'status'.
+    STARTING = 'starting'
+    RUNNING = 'running'
+    DIED_STATE = 'died'
+    FINISHED_STATE = 'finished'
+
+    def __init__(self, command_str, alias=None, forward=None):
         """Arguments to __init__() are as described in the description above."""
         # Initialize Thread before start().
         super(Monitor, self).__init__()
@@ -110,10 +403,29 @@ class Monitor(threading.Thread):
         # the process.
         self.interest = Monitor.LANCHED
 
+        self.state = Monitor.STARTING
+        self.pid = None
+        self.restarts = 0
+        self.started = None
+        self.forward = forward
+
     def fileno(self):
         """File number used by select()."""
         return self.out_r.fileno()
 
+    def status(self):
+        """The status of the monitor reported to console.
+
+        'dropped' is the number of lines of output the log forwarder dropped,
+        None if the output is not forwarded.
+        """
+        dropped = None
+        if self.forward is not None:
+            tag, forwarder = self.forward
+            dropped = forwarder.dropped.get(tag, 0)
+        return {'alias': self.alias, 'state': self.state, 'pid': self.pid,
+                'restarts': self.restarts, 'dropped': dropped}
+
     def run(self):
         """Main method of the thread.
 
@@ -143,18 +455,32 @@ class Monitor(threading.Thread):
                 # Add current dir to $PATH.
                 env = os.environ.copy()
                 env["PATH"] = os.getcwd() + ':' + env["PATH"]
-                # Fork a process with given envirenment.
+                # Fork a process with given envirenment. Forwarded output is
+                # read through a pipe and copied to the log file.
+                if self.forward is None:
+                    out, err = log_file, log_file
+                else:
+                    out, err = subprocess.PIPE, subprocess.STDOUT
                 self._process = subprocess.Popen(
-                    self.command, stdin=subprocess.PIPE, stdout=log_file,
-                    stderr=log_file, env=env, close_fds=True)
+                    self.command, stdin=subprocess.PIPE, stdout=out,
+                    stderr=err, env=env, close_fds=True)
 
             # Lanching. Notify Manager.
             self.out_w.write(Monitor.LANCHED)
-            # Wait for the process finishes or terminates and buffer
-            # all output in memory.
-            output, err = self._process.communicate()
-            print output
-            print err
+            if self.forward is None:
+                # Wait for the process finishes or terminates and buffer
+                # all output in memory.
+                output, err = self._process.communicate()
+                print output
+                print err
+            else:
+                self._process.stdin.close()
+                tag, forwarder = self.forward
+                for line in iter(self._process.stdout.readline, ''):
+                    log_file.write(line)
+                    log_file.flush()
+                    forwarder.put(tag, line)
+                self._process.wait()
             log_file.close()
 
             # Finished or died. Notify Manager.
@@ -213,8 +539,19 @@ class ConsoleSocket(object):
     def send_all(self, data):
         """Send data to socket until either all data has been sent or
         an error occurs.
+
+        The socket is non-blocking, so wait until it is writable whenever the
+        send buffer is full.
         """
-        self._socket.sendall(data)
+        while data:
+            try:
+                sent = self._socket.send(data)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                select.select([], [self._socket], [], 1)
+                continue
+            data = data[sent:]
 
     def close(self):
         """Close underlying socket and clean up reader."""
@@ -236,11 +573,33 @@ class ProcessManager(object):
     OK = 'ok\n'
     DUP_ALIAS = 'duplicated alias\n'
     SHUTDOWN = 'shutdown\n'
+    STATUS = 'status\n'
+    # Prefix of the response to STATUS, followed by a JSON list of the
+    # status of every monitor, see Monitor.status().
+    STATUS_REPLY = 'status '
+    # "top <interval>" asks for the usage of monitored processes every
+    # interval seconds until "top 0". Every push is a TOP_REPLY followed by
+    # JSON {"time": now, "changed": [entries], "removed": [aliases]}, where
+    # only entries that changed since the last push are sent.
+    TOP = 'top'
+    TOP_REPLY = 'top '
 
     def __init__(self, port):
         self.port = port
         # List of monitors. Each one corresponds to a process.
         self._monitors = []
+        # Map from alias to the last status of monitors that finished, so
+        # that a console connecting later knows they ran.
+        self._finished = {}
+        # Seconds between pushes of process usage to console, None if the
+        # console did not ask for them.
+        self._top_interval = None
+        self._top_next = 0
+        # Map from alias to the entry last pushed to console.
+        self._top_sent = {}
+        self._proc_stats = ProcStats()
+        # Map from the address of a log collector to its LogForwarder.
+        self._forwarders = {}
         # ConsoleSocket. Only one console could connect to a Manager.
         self._console_socket = None
         # Flag to indicate whether the Manager should stop.
@@ -259,6 +618,7 @@ class ProcessManager(object):
         # Check alias duplication.
         if any(monitor.alias == m.alias for m in self._monitors):
             return False
+        self._finished.pop(monitor.alias, None)
         self._monitors.append(monitor)
         return True
 
@@ -288,15 +648,28 @@ class ProcessManager(object):
             t.start()
 
         # Loop until done.
+        poller = Poller()
         while not self._done:
-            # select() on _monitors, server_socket and _console_socket.
+            # Poll on _monitors, server_socket and _console_socket.
             potential_read_list = self._monitors[:] # Make a copy.
             potential_read_list.append(server_socket)
             if self._console_socket is not None:
                 potential_read_list.append(self._console_socket)
-
-            # Select on read list with timeout.
-            (rlist, _, _) = select.select(potential_read_list, [], [], 1)
+            fds = set()
+            for r in potential_read_list:
+                poller.register(r, Poller.READ)
+                fds.add(r.fileno())
+            for fd in set(poller.registered()) - fds:
+                poller.unregister(fd)
+
+            # Poll on read list with timeout, waking up for the next push.
+            timeout = 1
+            if self._top_interval is not None:
+                timeout = max(0, min(timeout, self._top_next - time.time()))
+            rlist = [r for r, _ in poller.poll(timeout)]
+            if (self._top_interval is not None and
+                    time.time() >= self._top_next):
+                self._push_top()
 
             for read_ready in rlist:
                 # Monitor becomes ready for read.
@@ -319,6 +692,7 @@ class ProcessManager(object):
                         print 'EOF of console socket'
                         self._console_socket.close()
                         self._console_socket = None
+                        self._top_interval = None
                     else:
                         for command in commands:
                             print command
@@ -347,24 +721,67 @@ class ProcessManager(object):
         if output == Monitor.READY:
             monitor.in_w.write(Monitor.LANCH)
         elif output == Monitor.LANCHED:
+            monitor.state = Monitor.RUNNING
+            monitor.pid = monitor._process.pid
+            monitor.started = time.time()
             if monitor.interest == Monitor.LANCHED:
                 response = "%s %s" % (monitor.alias, ProcessManager.OK)
-                self._console_socket.send_all(response)
+                self._send_to_console(response)
                 monitor.interest = None
         elif output == Monitor.DIED:
+            monitor.state = Monitor.DIED_STATE
+            monitor.restarts += 1
             monitor.in_w.write(Monitor.RELANCH)
         elif output == Monitor.FINISHED:
+            monitor.state = Monitor.FINISHED_STATE
             # Send OK if console is waiting for process finsih.
             if monitor.interest == Monitor.FINISHED:
                 response = "%s %s" % (monitor.alias, ProcessManager.OK)
-                self._console_socket.send_all(response)
+                self._send_to_console(response)
                 monitor.interest = None
             # Join finished thread.
             monitor.join()
             self._monitors.remove(monitor)
+            self._finished[monitor.alias] = monitor.status()
         else:
             print 'Unknown Monitor output'
 
+    def _push_top(self):
+        """Push the usage entries that changed since the last push."""
+        self._top_next = time.time() + self._top_interval
+        entries = {}
+        for m in self._monitors:
+            entry = m.status()
+            entry['started'] = m.started
+            cpu, rss = (None, None)
+            if m.state == Monitor.RUNNING:
+                cpu, rss = self._proc_stats.sample(m.pid)
+            # Round, so that small fluctuations don't count as changes.
+            entry['cpu'] = round(cpu, 1) if cpu is not None else None
+            entry['rss'] = rss / 1024 * 1024 if rss is not None else None
+            entries[m.alias] = entry
+        for alias, status in self._finished.items():
+            entries[alias] = status
+        self._proc_stats.forget([m.pid for m in self._monitors])
+
+        changed = [e for alias, e in entries.items()
+                   if self._top_sent.get(alias) != e]
+        removed = [alias for alias in self._top_sent if alias not in entries]
+        self._top_sent = entries
+        self._send_to_console(ProcessManager.TOP_REPLY + json.dumps(
+            {'time': time.time(), 'changed': changed, 'removed': removed}) +
+            '\n')
+
+    def _send_to_console(self, response):
+        """Send response to console if connected.
+
+        A console that connects later learns the outcome from 'status'.
+        """
+        if self._console_socket is None:
+            print 'No console connected, drop response:', response,
+            return
+        self._console_socket.send_all(response)
+
     def _stop_monitor(self, alias):
         """Stop monitor with given alias or stop all monitors if alias is None.
 
@@ -374,7 +791,9 @@ class ProcessManager(object):
             for m in self._monitors:
                 m.stop()
             del self._monitors[:]
+            self._finished.clear()
         else:
+            self._finished.pop(alias, None)
             for m in self._monitors:
                 if m.alias == alias:
                     m.stop()
@@ -393,10 +812,33 @@ class ProcessManager(object):
         elif command == ProcessManager.SHUTDOWN:
             self._stop_monitor(None)
             self._done = True  # Stop Manager.
+        # TOP
+        elif command.startswith(ProcessManager.TOP + ' '):
+            interval = float(command.split()[1])
+            if interval > 0:
+                # Start over with a full push.
+                self._top_interval = interval
+                self._top_next = 0
+                self._top_sent = {}
+            else:
+                self._top_interval = None
+        # STATUS
+        elif command == ProcessManager.STATUS:
+            status = [m.status() for m in self._monitors]
+            status.extend(self._finished.values())
+            self._send_to_console(
+                ProcessManager.STATUS_REPLY + json.dumps(status) + '\n')
         # RUN
         elif command.startswith(ProcessManager.RUN):
-            alias, command, wait = ProcessManager._parse_run_command(command)
-            monitor = Monitor(command, alias)
+            alias, command, wait, forward = (
+                ProcessManager._parse_run_command(command))
+            if forward is not None:
+                tag, address = forward
+                if address not in self._forwarders:
+                    self._forwarders[address] = LogForwarder(address)
+                    self._forwarders[address].start()
+                forward = (tag, self._forwarders[address])
+            monitor = Monitor(command, alias, forward)
             if wait:
                 monitor.interest = Monitor.FINISHED
             if self.add_monitor(monitor):
@@ -405,28 +847,36 @@ class ProcessManager(object):
             else:
                 # Alais duplicate. Report to Console.
                 response = "%s %s" % (monitor.alias, ProcessManager.DUP_ALIAS)
-                self._console_socket.send_all(response)
+                self._send_to_console(response)
         # Unknown
         else:
             print 'Unknown command'
 
     @staticmethod
     def _parse_run_command(command_str):
-        """Paser RUN command "run [-as <alias>][-w] <program and arguments>".
+        """Paser RUN command
+        "run [-as <alias>][-w][-fw <tag>@<host>:<port>] <program and arguments>".
 
         -as <alias>: Give the command an alias.
         -w: Wait for the command to stop.
+        -fw <tag>@<host>:<port>: Forward the output to the log collector at
+            host:port, tagged with tag, see LogForwarder.
 
         For example:
             "run ls -l", "run -as mongod01 mongod --dbpath /var/lib/mongodb/"
             "run -c mkdir -p ./data"
 
         Returns:
-            The tuple (alias, command).
+            The tuple (alias, command, wait, forward). forward is
+            (tag, (host, port)), None if not given.
         """
-        m = re.match(r"^run(\s+-as\s+(?P<alias>[^\s]*))?(\s+(?P<w>-w))?\s+(?P<cmd>.*)\n$",
-                     command_str)
-        return m.group('alias'), m.group('cmd'), m.group('w')
+        m = re.match(r"^run(\s+-as\s+(?P<alias>[^\s]*))?(\s+(?P<w>-w))?"
+                     r"(\s+-fw\s+(?P<tag>[^\s@]+)@(?P<host>[^\s]+):(?P<port>\d+))?"
+                     r"\s+(?P<cmd>.*)\n$", command_str)
+        forward = None
+        if m.group('tag') is not None:
+            forward = (m.group('tag'), (m.group('host'), int(m.group('port'))))
+        return m.group('alias'), m.group('cmd'), m.group('w'), forward
 
     @staticmethod
     def _parse_stop_command(command_str):
@@ -0,0 +1,165 @@
+#!/usr/bin/python
+"""Setup runner runs all setup scripts of a host in one remote session and
+reports the result of every script in a structured way.
+
+The console uploads the scripts together with a manifest and invokes the runner
+once per host over SSH:
+
+    python base_remote_resources/setup_runner.py <manifest> [--force]
+
+The runner is started in the working dir 'cluster_test_<port>'.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# File in the working dir recording setup scripts that have run successfully,
+# one "<md5> <timestamp> <name>" line per script.
+SETUP_STATE = 'setup_state'
+
+# Prefixes of the structured lines parsed by the console.
+RESULT = 'SETUP_RESULT'
+DONE = 'SETUP_DONE'
+
+OK = 'ok'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class ScriptRun(object):
+    """The run of a single setup script.
+
+    Attributes:
+        name: (str) The file name of the script in the scripts dir.
+        hash: (str) MD5 hex digest of the script's content.
+        independent: (boolean) Whether the script can run in parallel with
+            its independent neighbours.
+        status: (str) OK, FAILED or SKIPPED after the run.
+        exit_code: (int) Exit code of the script, None if it didn't run.
+        duration: (float) Wall time of the script in seconds.
+    """
+
+    def __init__(self, script_dir, entry):
+        self.name = entry['name']
+        self.hash = entry['hash']
+        self.independent = entry.get('independent', False)
+        self.status = None
+        self.exit_code = None
+        self.duration = 0.0
+        self._path = os.path.join(script_dir, self.name)
+
+    def run(self, capture=False):
+        """Source the script in a fresh bash.
+
+        Args:
+            capture: (boolean) Write the output to '<script>.out' instead of
+                the terminal, used when scripts run in parallel.
+        """
+        start = time.time()
+        out = None
+        if capture:
+            out = open(self._path + '.out', 'w')
+            print "Running %s in parallel, output in %s.out" % (self.name,
+                                                                self._path)
+        self.exit_code = subprocess.call(['bash', '-c', '. ./%s' % self._path],
+                                         stdout=out, stderr=out)
+        if out is not None:
+            out.close()
+        self.duration = time.time() - start
+        self.status = OK if self.exit_code == 0 else FAILED
+
+    def report(self):
+        """Print the structured result line."""
+        print "%s %s" % (RESULT, json.dumps({'name': self.name,
+                                             'hash': self.hash,
+                                             'status': self.status,
+                                             'exit_code': self.exit_code,
+                                             'duration': self.duration}))
+        sys.stdout.flush()
+
+
+def read_state():
+    """Read hashes of the scripts that already ran successfully."""
+    if not os.path.exists(SETUP_STATE):
+        return set()
+    with open(SETUP_STATE, 'r') as f:
+        return set(line.split()[0] for line in f if line.strip())
+
+
+def record_state(script_run):
+    """Record a successful run in the state file."""
+    with open(SETUP_STATE, 'a') as f:
+        f.write("%s %d %s\n" % (script_run.hash, time.time(), script_run.name))
+
+
+def batches(script_runs):
+    """Group script runs into batches run one after another.
+
+    Consecutive independent scripts form one batch and run in parallel. Any
+    other script runs alone, after all scripts before it have finished.
+    """
+    batch = []
+    for s in script_runs:
+        if not s.independent:
+            if batch:
+                yield batch
+                batch = []
+            yield [s]
+        else:
+            batch.append(s)
+    if batch:
+        yield batch
+
+
+def run_batch(batch):
+    """Run a batch of scripts, in parallel if there are more than one."""
+    if len(batch) == 1:
+        batch[0].run()
+    else:
+        threads = [threading.Thread(target=s.run, kwargs={'capture': True})
+                   for s in batch]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    for s in batch:
+        if s.status == OK:
+            record_state(s)
+        s.report()
+
+
+def main():
+    """Run all scripts in the manifest, stopping at the first failed batch."""
+    manifest_path = sys.argv[1]
+    force = '--force' in sys.argv[2:]
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    script_dir = os.path.dirname(manifest_path)
+
+    done_hashes = set() if force else read_state()
+    to_run = []
+    for entry in manifest:
+        s = ScriptRun(script_dir, entry)
+        if s.hash in done_hashes:
+            s.status = SKIPPED
+            print "Skipping unchanged setup script", s.name
+            s.report()
+        else:
+            to_run.append(s)
+
+    failed = 0
+    for batch in batches(to_run):
+        run_batch(batch)
+        failed = len([s for s in batch if s.status == FAILED])
+        if failed:
+            break
+
+    print "%s %s" % (DONE, json.dumps({'failed': failed}))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""Dependency graph of remote commands and phase checkers.
+
+Remote commands and phase checkers become nodes of a graph, so that a command
+can start as soon as its own prerequisites are done instead of waiting for the
+whole previous phase. See Console.run_dag().
+
+A node declares its prerequisites by name with the 'deps' argument of
+AddCommandToProcMgr() or AddPhaseChecker(). Commands are named by their alias
+and phase checkers by their name. Aliases are only unique per process manager,
+so a command whose alias is used on several hosts is named 'alias@host:port'
+and depending on the bare alias means depending on all of them. Nodes without
+declared deps keep the phase semantics:
+    + An undeclared command depends on every node of earlier phases.
+    + An undeclared phase checker depends on every node of earlier phases, on
+      the commands of its own phase and on the checkers added before it in its
+      own phase.
+    + A declared node depends on its declared deps and on every undeclared
+      node of earlier phases, e.g. waiting for staging.
+"""
+
+
+class GraphError(Exception):
+    """Error in building the command graph."""
+    def __init__(self, msg):
+        super(GraphError, self).__init__(msg)
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+
+class Node(object):
+    """A remote command or a phase checker in the graph.
+
+    Attributes:
+        name: (str) Unique name of the node.
+        item: (RemoteCommand or PhaseChecker) The wrapped object.
+        is_command: (boolean) Whether item is a RemoteCommand.
+        phase: (int) The phase of item.
+        deps: (set of str) Names of the nodes this node waits for.
+        start, finish: (float) Timestamps recorded by the scheduler.
+    """
+    def __init__(self, name, item, is_command):
+        self.name = name
+        self.item = item
+        self.is_command = is_command
+        self.phase = item.phase
+        self.declared = item.deps is not None
+        self.deps = set()
+        self.start = None
+        self.finish = None
+
+    def duration(self):
+        """Seconds between start and finish, None if not finished."""
+        if self.start is None or self.finish is None:
+            return None
+        return self.finish - self.start
+
+
+def build(commands, checkers):
+    """Build the graph of commands and checkers.
+
+    Args:
+        commands: (list of RemoteCommand)
+        checkers: (list of PhaseChecker) In the order they were added.
+
+    Returns:
+        (dict of str to Node) Nodes by name.
+
+    Raises:
+        GraphError on duplicated names, unknown deps or cycles.
+    """
+    nodes = {}
+    ordered = []
+    by_alias = {}
+    for c in commands:
+        by_alias.setdefault(c.alias, []).append(c)
+    for c in commands:
+        name = c.alias
+        if len(by_alias[c.alias]) > 1:
+            name = '%s@%s:%s' % (c.alias, c.address[0], c.address[1])
+        ordered.append(Node(name, c, True))
+    for i, pc in enumerate(checkers):
+        name = pc.name if pc.name is not None else 'checker_%d' % i
+        ordered.append(Node(name, pc, False))
+    for n in ordered:
+        if n.name in nodes:
+            raise GraphError('Duplicated node name <%s>' % n.name)
+        nodes[n.name] = n
+
+    for i, n in enumerate(ordered):
+        for j, other in enumerate(ordered):
+            if other is n:
+                continue
+            if other.phase < n.phase:
+                if not n.declared or not other.declared:
+                    n.deps.add(other.name)
+            elif (other.phase == n.phase and not n.declared
+                  and not n.is_command):
+                # Undeclared checker waits for its phase's commands and
+                # checkers added before it.
+                if other.is_command or j < i:
+                    n.deps.add(other.name)
+        if n.declared:
+            for d in n.item.deps:
+                if d in nodes:
+                    n.deps.add(d)
+                elif d in by_alias:
+                    n.deps.update('%s@%s:%s' % (d, c.address[0], c.address[1])
+                                  for c in by_alias[d])
+                else:
+                    raise GraphError('<%s> depends on unknown <%s>' %
+                                     (n.name, d))
+
+    _check_acyclic(nodes)
+    return nodes
+
+
+def _check_acyclic(nodes):
+    """Raise GraphError if the graph has a cycle."""
+    remaining = dict((name, set(n.deps)) for name, n in nodes.items())
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            raise GraphError('Cycle among %s' % ', '.join(sorted(remaining)))
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+
+
+def critical_path(nodes):
+    """The chain of nodes that determined the end time of the run.
+
+    Starting from the node that finished last, repeatedly step to the
+    prerequisite that finished last.
+
+    Returns:
+        (list of Node) From the first to the last node of the path.
+    """
+    finished = [n for n in nodes.values() if n.finish is not None]
+    if not finished:
+        return []
+    path = [max(finished, key=lambda n: n.finish)]
+    while True:
+        deps = [nodes[d] for d in path[-1].deps if nodes[d].finish is not None]
+        if not deps:
+            break
+        path.append(max(deps, key=lambda n: n.finish))
+    path.reverse()
+    return path
+
+
+def print_critical_path(nodes):
+    """Print the critical path with start offsets and durations."""
+    path = critical_path(nodes)
+    if not path:
+        return
+    t0 = min(n.start for n in nodes.values() if n.start is not None)
+    print '\n', '=' * 20, "Critical path", '=' * 20
+    for n in path:
+        kind = 'command' if n.is_command else 'checker'
+        print "%8.2fs %8.2fs  %-8s %s" % (n.start - t0, n.duration(), kind,
+                                           n.name)
+    print "Total: %.2fs" % (path[-1].finish - t0)
@@ -0,0 +1,120 @@
+"""Connections of the console to mongods and mongoses.
+
+Phase checkers and helpers of the config, e.g. waiting for a primary or
+adding shards, get their connections here instead of opening their own:
+    conn = connection_pool.get(host, port)
+A connection is kept per host:port and handed out again until close_all(),
+which the console calls at the end of every phase and run. A connection idle
+for HEALTH_CHECK_IDLE seconds is pinged before it is reused and replaced if
+the ping fails. Users don't close what they get, but call discard() after an
+error so that the next get() connects anew.
+
+pymongo is imported on first use, so the console runs without it as long as
+the config doesn't talk to mongo.
+"""
+
+import threading
+import time
+
+# Seconds a connection may be idle before get() checks it with a ping.
+HEALTH_CHECK_IDLE = 5
+
+
+class ConnectionPool(object):
+    """One pymongo connection per host and port, shared between threads.
+
+    Attributes:
+        opened: (int) Connections opened since the last close_all().
+        reused: (int) get() calls answered with an open connection.
+    """
+    def __init__(self):
+        self.opened = 0
+        self.reused = 0
+        # Map from (host, port) to [connection, last used].
+        self._conns = {}
+        self._lock = threading.Lock()
+
+    def get(self, host, port):
+        """An open connection to host:port.
+
+        Raises:
+            pymongo.errors.PyMongoError: Can't connect.
+        """
+        import pymongo
+        key = (host, port)
+        with self._lock:
+            entry = self._conns.get(key)
+        if entry is not None:
+            conn, used = entry
+            if time.time() - used < HEALTH_CHECK_IDLE or self._healthy(conn):
+                with self._lock:
+                    entry[1] = time.time()
+                    self.reused += 1
+                return conn
+            self.discard(host, port)
+
+        # Connect without the lock, connecting may take long.
+        conn = pymongo.Connection(host, port)
+        with self._lock:
+            if key in self._conns:
+                # Another thread connected meanwhile, use its connection.
+                conn.close()
+                entry = self._conns[key]
+                entry[1] = time.time()
+                self.reused += 1
+                return entry[0]
+            self._conns[key] = [conn, time.time()]
+            self.opened += 1
+        return conn
+
+    def discard(self, host, port):
+        """Close the connection to host:port, e.g. after it failed."""
+        with self._lock:
+            entry = self._conns.pop((host, port), None)
+        if entry is not None:
+            entry[0].close()
+
+    def close_all(self):
+        """Close all connections and reset the counts.
+
+        Returns:
+            (int, int) The connections opened and reused before.
+        """
+        with self._lock:
+            conns = [conn for conn, _ in self._conns.values()]
+            self._conns = {}
+            counts = (self.opened, self.reused)
+            self.opened = self.reused = 0
+        for conn in conns:
+            conn.close()
+        return counts
+
+    @staticmethod
+    def _healthy(conn):
+        import pymongo
+        try:
+            conn.admin.command('ping')
+            return True
+        except pymongo.errors.PyMongoError:
+            return False
+
+
+_pool = ConnectionPool()
+
+
+def get(host, port):
+    """An open connection to host:port from the console's pool."""
+    return _pool.get(host, port)
+
+
+def discard(host, port):
+    """Drop the pooled connection to host:port."""
+    _pool.discard(host, port)
+
+
+def close_all():
+    """Close the pooled connections and print how many were opened and
+    reused, if any."""
+    opened, reused = _pool.close_all()
+    if opened or reused:
+        print "Mongo connections: %d opened, %d reused" % (opened, reused)
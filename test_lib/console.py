@@ -4,20 +4,37 @@ communicates with remote process managers.
 """
 
 import argparse
+import errno
+import glob
+import hashlib
+import jobs
+import json
+import latency_report
 import os
 import process_manager
+import provisioning
+import Queue
 import re
-import select
 import shlex
+import signal
 import socket
 import subprocess
 import sys
 import time
 import traceback
 import tempfile
+import threading
 import shutil
 
+import command_graph
 import console_config
+import log_index
+import log_merge
+import plan_cache
+import run_report
+import run_trace
+import setup_runner
+import top_view
 
 class RemoteCommand(object):
     """A command entry for a remote process manager.
@@ -30,14 +47,28 @@ class RemoteCommand(object):
         state: (str) The state of the command.
         phase: (int) The phase of the command.
         wait: (boolean) Wait for command to finish on process manager.
+        deps: (list of str) Names of commands and phase checkers that must be
+            done before this command starts in 'run --dag'. None means the
+            command keeps the phase order. See command_graph.
+        pid, restarts: (int) The pid and restart count on the process manager
+            as of the last status sync, None if unknown.
+        forward: (str) '<tag>@<host>:<port>' of the log collector that the
+            process manager forwards the output to, None if not forwarded.
+            See process_manager.LogForwarder.
+        dropped: (int) Lines of output the process manager could not forward,
+            as of the last status sync, None if unknown.
     """
 
     # States used by ProcMgrProxy to record progress in callback methods.
+    NEW = 'NEW'  # Not running as far as we know.
     READY = 'READY'
     DONE = 'DONE'
+    FAILED = 'FAILED'  # Not acknowledged after all retries.
+    # Lanched by an earlier console and waited for, but not finished yet.
+    RUNNING = 'RUNNING'
 
     def __init__(self, host, port, user_name, command, alias=None, phase=1,
-            wait=False):
+            wait=False, deps=None, forward=None):
         """Initialize remote command.
 
         Args:
@@ -46,6 +77,8 @@ class RemoteCommand(object):
             alias: (str) If alias is None, use the command name itself as
                 an alias.
             phase: (int) The phase of the command.
+            deps: (list of str) Prerequisites in 'run --dag'.
+            forward: (str) The log collector to forward the output to.
         """
         self.address = (host, port)
         self.user_name = user_name
@@ -54,9 +87,45 @@ class RemoteCommand(object):
             alias = shlex.split(command)[0]
         self.alias = alias
         self.command = command
-        self.state = RemoteCommand.DONE
+        self.state = RemoteCommand.NEW
         self.phase = phase
         self.wait = wait
+        self.deps = deps
+        self.forward = forward
+        self.pid = None
+        self.restarts = None
+        self.dropped = None
+
+    def reset(self):
+        """Forget the remote state, e.g. after the command is stopped."""
+        self.state = RemoteCommand.NEW
+        self.pid = None
+        self.restarts = None
+        self.dropped = None
+
+
+class PendingRequest(object):
+    """A request sent to a process manager and waiting for its response.
+
+    Attributes:
+        data: (str) The request line, resent on retry.
+        created: (float) The time it was first sent.
+        sent: (float) The time it was last sent.
+        timeout: (float) Seconds to wait for the response before retrying.
+            None means waiting forever.
+        retry: (boolean) Whether the request can be resent safely.
+        retries: (int) Times it has been resent.
+    """
+    def __init__(self, data, timeout, retry):
+        self.data = data
+        self.created = self.sent = time.time()
+        self.timeout = timeout
+        self.retry = retry
+        self.retries = 0
+
+    def timed_out(self, now):
+        """Whether the response is overdue."""
+        return self.timeout is not None and now - self.sent > self.timeout
 
 
 class ProcMgrProxy(object):
@@ -69,6 +138,10 @@ class ProcMgrProxy(object):
         key_file: (str) The path of private key used for SSH authorization.
         remote_commands: (list of RemoteCommand) Remote commands assigned to
             a given process manager.
+        top: (dict of str to dict) Usage of processes by alias, merged from
+            the updates pushed by the process manager during 'top'.
+        top_time: (float) Time of the last update on the process manager's
+            clock, None before the first one.
 
     Usage:
         1. setup. Copy files to remote cluster and lanch process managers
@@ -88,16 +161,48 @@ class ProcMgrProxy(object):
 
         Only run and shutdown need to receive the acknowledgement from process
         manager, so they are separated to two parts, sending commands and the
-        callback function. We use select() to get acknowledgements in any order.
+        callback function. We use a Poller to get acknowledgements in any order.
         Other methods just fire commands to process managers and return.
+
+        The socket is non-blocking. Outgoing data is buffered and flushed
+        whenever the socket is writable. Requests waiting for a response are
+        resent after REQUEST_TIMEOUT, on a new connection if the old one broke,
+        and given up after MAX_RETRIES.
     """
-    def __init__(self, address, user_name, key_file=None, remote_resource_downloads=None):
+    # Seconds to wait for the response of a request before resending it.
+    REQUEST_TIMEOUT = 30
+    # Times a request is resent before it is given up.
+    MAX_RETRIES = 3
+    # Seconds 'setup' waits for restarted process managers to listen.
+    AGENT_START_TIMEOUT = 30
+
+    # Manifest uploaded with the setup scripts for the remote setup runner.
+    SETUP_MANIFEST = 'setup_manifest.json'
+
+    def __init__(self, address, user_name, key_file=None, remote_resource_downloads=None,
+                 local_root=None):
         self.address = address
         self.user_name = user_name
         self.key_file = key_file
+        # For a machine of provisioning.Local, the directory that stands in
+        # for the home directory on the remote machine. Commands run there
+        # with bash instead of SSH.
+        self.local_root = local_root
         self.remote_commands = []
         self._socket = None
         self._reader = None
+        # Data waiting to be sent on the non-blocking socket.
+        self._out_buffer = ''
+        # Map from key to PendingRequest. Keys are ('run', alias),
+        # ('status',) and ('shutdown',).
+        self._requests = {}
+        # Whether the state of commands has been synced with the process
+        # manager since connected.
+        self._synced = False
+        # Per-script results of the last setup, parsed from the setup runner.
+        self.setup_results = []
+        self.top = {}
+        self.top_time = None
                 
         print "Initializing proxy to host, available at : %s" % (self._ssh_str())
 
@@ -137,14 +242,102 @@ class ProcMgrProxy(object):
         return self._socket is not None
 
     def fileno(self):
-        """File number used by select()."""
+        """File number used by the Poller."""
         return self._socket.fileno()
 
-    def set_up(self):
+    def _send(self, data):
+        """Buffer data and send as much as possible without blocking."""
+        self._out_buffer += data
+        self.flush()
+
+    def flush(self):
+        """Send buffered data until the socket would block.
+
+        A broken connection is closed, and requests waiting on it are resent
+        on a new connection when they time out.
+        """
+        while self._out_buffer and self._socket is not None:
+            try:
+                sent = self._socket.send(self._out_buffer)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                print self.address, "connection broken:", e
+                self._disconnect()
+                return
+            self._out_buffer = self._out_buffer[sent:]
+
+    def wants_write(self):
+        """Whether there is buffered data waiting for the socket."""
+        return self._socket is not None and bool(self._out_buffer)
+
+    def _request(self, key, data, timeout=None, retry=True):
+        """Send data as a request waiting for a response.
+
+        Args:
+            key: (tuple) Identifies the response, see _complete().
+            timeout: (float) Seconds to wait before retrying, None is forever.
+            retry: (boolean) Whether the request can be resent safely.
+        """
+        self._requests[key] = PendingRequest(data, timeout, retry)
+        self._send(data)
+
+    def _complete(self, key):
+        """Mark the request identified by key as responded."""
+        self._requests.pop(key, None)
+
+    def has_requests(self):
+        """Whether any request is waiting for its response."""
+        return bool(self._requests)
+
+    def check_timeouts(self):
+        """Resend overdue requests or give them up after MAX_RETRIES.
+
+        A given-up 'run' request marks its command FAILED and a given-up
+        'shutdown' closes the connection.
+        """
+        now = time.time()
+        for key, r in self._requests.items():
+            if not r.timed_out(now):
+                continue
+            if r.retry and r.retries < ProcMgrProxy.MAX_RETRIES:
+                r.retries += 1
+                r.sent = now
+                print self.address, "no response, retry %d: %s" % (
+                    r.retries, r.data.strip())
+                run_trace.instant('retry ' + ' '.join(key), 'retry',
+                                  self._lane(), retries=r.retries)
+                if not self.is_connected():
+                    self.connect()
+                if self.is_connected():
+                    self._send(r.data)
+                continue
+            print self.address, "no response, give up:", r.data.strip()
+            del self._requests[key]
+            if key[0] == 'run':
+                for c in self.remote_commands:
+                    if c.alias == key[1]:
+                        c.state = RemoteCommand.FAILED
+                        run_trace.complete('run ' + c.alias, 'command',
+                                           r.created, now, self._lane(),
+                                           {'phase': c.phase,
+                                            'retries': r.retries,
+                                            'failed': True})
+            elif key[0] == 'shutdown':
+                self.close()
+
+    def set_up(self, force=False):
         """Rsync's all files under the local directory 'bin/' to the remote
         cluster machine directory 'cluster_test_<port>' and launches an
         instance of the process_manager in the background.
+
+        Args:
+            force: (boolean) Rerun setup scripts even if the same content has
+                already run successfully on this host.
+
+        Return: Whether the host was set up.
         """
+        self.setup_results = []
         
         print '\n', '=' * 20, "SETUP HOST %s" % (self.address,), '=' * 20
         
@@ -160,7 +353,7 @@ class ProcMgrProxy(object):
         if not self._rsync(src, dest):
             # Rsync fails.
             print self.address, "encounters problems when synchronizing files."
-            return
+            return False
         
         print "Syncing local resources..."
         
@@ -175,7 +368,7 @@ class ProcMgrProxy(object):
             local_path = os.path.abspath(local_path)
             if not self._rsync(local_path, "%s%s%s" % (dest, os.sep, rel_path)):
                 print self.address, "encounters problems when syncing local files."
-                return
+                return False
         
         print "Sync'd."
         
@@ -191,7 +384,7 @@ class ProcMgrProxy(object):
         for url, rel_path in all_dls:
             if not self._download(url, rel_path):
                 print self.address, "encounters problems when downloading files."
-                return
+                return False
         
         print "Attached."
         
@@ -203,9 +396,10 @@ class ProcMgrProxy(object):
                 
             temp_dir = tempfile.mkdtemp();
             
+            manifest = []
             for i, snippet in enumerate(setup_scripts):
                 
-                name, snippet, lang, isFile, shouldRun = snippet
+                name, snippet, lang, isFile, shouldRun, independent = snippet
                 
                 filename = os.path.join(temp_dir, name)
                 
@@ -214,28 +408,28 @@ class ProcMgrProxy(object):
                         file.write(snippet)                        
                 else:
                     shutil.copyfile(snippet, filename)
+                
+                if shouldRun:
+                    manifest.append({
+                        'name': name,
+                        'hash': ProcMgrProxy._script_hash(snippet, isFile),
+                        'independent': independent })
+            
+            with open(os.path.join(temp_dir, ProcMgrProxy.SETUP_MANIFEST), 'w') as f:
+                json.dump(manifest, f)
                     
             remote_snippet_dir = dest + "/base_remote_resources/scripts"
             
             if not self._rsync(temp_dir + os.sep, remote_snippet_dir):
                 print self.address, "encounters problems when uploading snippets."
-                return
+                return False
             
             shutil.rmtree(temp_dir)
             
-            # Run snippets
-            for i, snippet in enumerate(setup_scripts):
-                
-                name, snippet, lang, isFile, shouldRun = snippet
-                if not shouldRun: continue
-                
-                remote_filename = "base_remote_resources/scripts/%s" % name
-                
-                run_cmd = ". ./%s" % remote_filename
-                
-                if not self._ssh(run_cmd, use_tty=True):
-                    print self.address, "encounters problems when executing snippets."
-                    return
+            # Run all snippets in one session.
+            if manifest and not self._run_setup_scripts(force):
+                print self.address, "encounters problems when executing snippets."
+                return False
         
         
         # Use SSH to run process manager.
@@ -249,9 +443,48 @@ class ProcMgrProxy(object):
             print self.address, "process manager has been set up."
         else:
             print self.address, "encounters problems when running SSH."
-            return
+            return False
         
         print "Done."
+        return True
+
+    def _run_setup_scripts(self, force=False):
+        """Run uploaded setup scripts with the remote setup runner.
+
+        The runner prints one structured line per script, which is parsed into
+        self.setup_results while the rest of the output is echoed.
+
+        Return: Whether all setup scripts succeeded or were skipped.
+        """
+        run_cmd = 'python base_remote_resources/setup_runner.py %s' % (
+            'base_remote_resources/scripts/%s' % ProcMgrProxy.SETUP_MANIFEST)
+        if force:
+            run_cmd += ' --force'
+        
+        self.setup_results = []
+        process = subprocess.Popen(self._ssh_args(run_cmd, use_tty=True),
+                                   stdout=subprocess.PIPE)
+        for line in iter(process.stdout.readline, ''):
+            line = line.rstrip()
+            if line.startswith(setup_runner.RESULT + ' '):
+                self.setup_results.append(
+                    json.loads(line[len(setup_runner.RESULT) + 1:]))
+            elif not line.startswith(setup_runner.DONE + ' '):
+                print line
+        process.wait()
+        
+        for r in self.setup_results:
+            print "%-40s %-8s exit=%-5s %8.1fs" % (r['name'], r['status'],
+                                                   r['exit_code'], r['duration'])
+        return process.returncode == 0
+
+    @staticmethod
+    def _script_hash(snippet, isFile):
+        """MD5 hex digest of a setup script's content."""
+        if isFile:
+            with open(snippet, 'r') as f:
+                snippet = f.read()
+        return hashlib.md5(snippet).hexdigest()
 
     def _remoteScript(self, source_script):
         """Remotely executes a script from the local host"""
@@ -287,18 +520,29 @@ class ProcMgrProxy(object):
         
         #print(source)
         
+        if self.local_root is not None:
+            # Copy within this machine. Wildcards that the remote shell would
+            # have expanded are expanded here.
+            if not isinstance(source, list):
+                source = [source]
+            source = [match for s in source
+                      for match in (glob.glob(self._local_path(s)) or
+                                    [self._local_path(s)])]
+            dest = self._local_path(dest)
+            if not os.path.exists(self.local_root):
+                os.makedirs(self.local_root)
         # Test SSH connection.
-        if not self._ssh('test 1 -eq 1', use_pwd=False):
+        elif not self._ssh('test 1 -eq 1', use_pwd=False):
             print "Waiting for SSH on %s with key %s" % (self.address[0], self.key_file)
-            time.sleep(1)
+            jobs.sleep(1)
             while not self._ssh('test 1 -eq 1', use_pwd=False):
-                time.sleep(1)
+                jobs.sleep(1)
 
         # Archive, compress, delete extraneous files from dest dirs.
         rsync = ['rsync', '-az', '--delete']
 
         # Use key file
-        if self.key_file:
+        if self.key_file and self.local_root is None:
             ssh = 'ssh -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -o IdentitiesOnly=yes -i "%s"'
             rsync.extend(['-e', ssh % self.key_file])
 
@@ -315,9 +559,20 @@ class ProcMgrProxy(object):
         else:
             return False
 
+    def _local_path(self, path):
+        """Path on this machine for a remote path 'user@host:path'."""
+        m = re.match(r'^[^/:]*@[^/:]*:(?P<path>.*)$', path)
+        if m is None:
+            return path
+        return os.path.join(self.local_root, m.group('path'))
+
     def _ssh_str(self):
         """SSH shell command"""
         
+        if self.local_root is not None:
+            return 'cd "%s"; $SHELL' % (os.path.join(
+                self.local_root, 'cluster_test_%d' % self.address[1]))
+        
         ssh = ['ssh',
                 '-o', 'StrictHostKeyChecking=no',
                 '-o', 'IdentitiesOnly=yes']
@@ -338,10 +593,28 @@ class ProcMgrProxy(object):
             command: (str) The program and its arguments.
                 For example: 'python process_manager.py 2900'.
         """
+        ssh = self._ssh_args(command, use_pwd, use_tty, forward_x)
+        
+        if verbose: print(" ".join(ssh))
+        
+        # Check whether ssh runs successfully.
+        if subprocess.call(ssh) == 0:
+            return True
+        else:
+            return False
+
+    def _ssh_args(self, command, use_pwd=True, use_tty=False, forward_x=False):
+        """Build the argument list of an SSH invocation running command."""
         if use_pwd:
             cd_cmd = 'cd cluster_test_%d; ' % self.address[1]
         else:
             cd_cmd = ''
+        if self.local_root is not None:
+            # A machine of provisioning.Local, use bash instead of SSH.
+            if not os.path.exists(self.local_root):
+                os.makedirs(self.local_root)
+            return ['bash', '-c', 'cd %s; %s%s' % (escape(self.local_root),
+                                                   cd_cmd, command)]
         ssh = ['ssh',
                 '-o', 'UserKnownHostsFile=/dev/null',
                 '-o', 'StrictHostKeyChecking=no',
@@ -355,14 +628,89 @@ class ProcMgrProxy(object):
             ssh.extend(['-Y'])
             
         ssh.extend([self.user_name + '@' + self.address[0], cd_cmd + command])
-        
-        if verbose: print(" ".join(ssh))
-        
-        # Check whether ssh runs successfully.
-        if subprocess.call(ssh) == 0:
+        return ssh
+
+    def start_sync(self, force=False):
+        """Ask the process manager which commands are running, so that a new
+        console doesn't run them again. See sync_done().
+
+        Args:
+            force: (boolean) Sync even if synced on this connection.
+        Return:
+            True if there is nothing to sync.
+        """
+        if not self.is_connected() or (self._synced and not force):
             return True
-        else:
-            return False
+        self._request(('status',), process_manager.ProcessManager.STATUS,
+                      ProcMgrProxy.REQUEST_TIMEOUT)
+        return False
+
+    def sync_done(self):
+        """The callback method to process response of 'status' command.
+
+        Return: True if the status has been received.
+        """
+        self.read_acks()
+        return ('status',) not in self._requests
+
+    def _apply_status(self, status):
+        """Update the state of commands from the status of the process
+        manager.
+
+        Commands that are running or finished are done, except that commands
+        waited for stay RUNNING until they finish. Commands unknown to the
+        process manager are NEW.
+
+        Args:
+            status: (list of dict) See process_manager.Monitor.status().
+        """
+        self._synced = True
+        by_alias = dict((s['alias'], s) for s in status)
+        running = finished = 0
+        for c in self.remote_commands:
+            s = by_alias.pop(c.alias, None)
+            if c.state == RemoteCommand.READY:
+                continue  # Acknowledgement on the way.
+            if s is None:
+                c.reset()
+                continue
+            c.pid = s['pid']
+            c.restarts = s['restarts']
+            c.dropped = s.get('dropped')
+            if s['state'] == process_manager.Monitor.FINISHED_STATE:
+                c.state = RemoteCommand.DONE
+                finished += 1
+            else:
+                c.state = (RemoteCommand.RUNNING if c.wait
+                           else RemoteCommand.DONE)
+                running += 1
+        print "%s: %d running, %d finished, %d of %d commands not started" % (
+            self.address, running, finished,
+            len(self.remote_commands) - running - finished,
+            len(self.remote_commands))
+        if by_alias:
+            print self.address, "running but not configured:", ', '.join(
+                sorted(by_alias))
+
+    def start_top(self, interval):
+        """Ask the process manager to push the usage of its processes every
+        interval seconds. Updates are merged into top by read_acks()."""
+        self.top = {}
+        self.top_time = None
+        self._send('%s %g\n' % (process_manager.ProcessManager.TOP, interval))
+
+    def stop_top(self):
+        """Stop the updates asked by start_top()."""
+        if self.is_connected():
+            self._send('%s 0\n' % process_manager.ProcessManager.TOP)
+
+    def _apply_top(self, update):
+        """Merge an update pushed by the process manager into top."""
+        for entry in update['changed']:
+            self.top[entry['alias']] = entry
+        for alias in update['removed']:
+            self.top.pop(alias, None)
+        self.top_time = update['time']
 
     def start_run(self, phase):
         """Issues all commands for this proxy to the remote process manager.
@@ -378,8 +726,10 @@ class ProcMgrProxy(object):
         done = True
         for c in self.remote_commands:
             if c.phase == phase:
+                if c.state == RemoteCommand.DONE:
+                    print c.alias, ' : already running'
+                    continue
                 print c.alias, ' : ', c.command
-                c.state = RemoteCommand.READY
                 self._start_run_binary(c)
                 done = False
         return done
@@ -387,6 +737,9 @@ class ProcMgrProxy(object):
     def _start_run_binary(self, remote_command):
         """Send command to ProcessManager to run a binary on remote machine.
 
+        The command becomes READY until acknowledged. A RUNNING command is
+        not sent again, the process manager acknowledges it when it finishes.
+
         Agrs:
             command_line: binary with arguments.
                 For example, "mongod --dbpath /var/lib/mongodb/"
@@ -399,34 +752,103 @@ class ProcMgrProxy(object):
             command_list.extend(['-as', remote_command.alias])
         if remote_command.wait:
             command_list.append('-w')
+        if remote_command.forward is not None:
+            command_list.extend(['-fw', remote_command.forward])
         command_list.append(remote_command.command)
         command = ' '.join(command_list) + '\n'
-        self._socket.sendall(command)
+        key = ('run', remote_command.alias)
+        if remote_command.state == RemoteCommand.RUNNING:
+            remote_command.state = RemoteCommand.READY
+            self._requests[key] = PendingRequest(command, None, retry=False)
+            return
+        remote_command.state = RemoteCommand.READY
+        # A command waited for responds when it finishes, which takes as
+        # long as it takes. Otherwise the response comes once it is lanched,
+        # and resending is safe since a running alias is not run twice.
+        if remote_command.wait:
+            self._request(key, command)
+        else:
+            self._request(key, command, ProcMgrProxy.REQUEST_TIMEOUT)
 
     def run_done(self):
         """The callback method to process response of 'run' command.
 
         Return: True if all remote commands are running, thus callback is done.
         """
-        lines = self._reader.read_lines()
-        # TODO(siyuan): EOF
+        self.read_acks()
+        return all(c.state != RemoteCommand.READY for c in self.remote_commands)
+
+    def read_acks(self):
+        """Read responses of 'run' commands and mark those commands done.
+
+        A response of 'status' updates the state of all commands and updates
+        of 'top' are merged into top.
+
+        Return: (list of RemoteCommand) Commands acknowledged just now.
+        """
+        acked = []
+        try:
+            lines = self._reader.read_lines()
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return acked
+            # Requests waiting on the connection are resent on a new one
+            # when they time out, as after EOF.
+            print self.address, "connection broken:", e
+            self._disconnect()
+            return acked
+        if lines is None:
+            print self.address, "connection closed by process manager"
+            self._disconnect()
+            return acked
         for response in lines:
+            status = ProcMgrProxy._parse_reply(
+                response, process_manager.ProcessManager.STATUS_REPLY)
+            if status is not None:
+                self._complete(('status',))
+                self._apply_status(status)
+                continue
+            update = ProcMgrProxy._parse_reply(
+                response, process_manager.ProcessManager.TOP_REPLY)
+            if update is not None:
+                self._apply_top(update)
+                continue
             print self.address, response
-            alias, _ = ProcMgrProxy._parse_response(response)
+            alias, resp = ProcMgrProxy._parse_response(response)
+            request = self._requests.get(('run', alias))
+            self._complete(('run', alias))
             for c in self.remote_commands:
                 if c.alias == alias:
                     c.state = RemoteCommand.DONE
+                    acked.append(c)
+                    if request is not None:
+                        # From sending to acknowledgement.
+                        run_trace.complete(
+                            'run ' + alias, 'command', request.created,
+                            time.time(), self._lane(),
+                            {'phase': c.phase, 'retries': request.retries,
+                             'wait': c.wait, 'response': resp})
                     break
-        return all(c.state != RemoteCommand.READY for c in self.remote_commands)
+        return acked
+
+    def _lane(self):
+        """Lane of this process manager in the run trace."""
+        return '%s:%s' % self.address
 
     def stop(self):
-        """Stop all commands."""
+        """Stop all commands.
+
+        Their acknowledgements are forgotten, since 'run' skips commands
+        acknowledged as running and must start stopped ones again.
+        """
         for c in self.remote_commands:
             self._stop_binary(c.alias)
+            c.reset()
 
     def start_shutdown(self):
         """Shut down the process manager."""
-        self._socket.sendall(process_manager.ProcessManager.SHUTDOWN)
+        self._request(('shutdown',), process_manager.ProcessManager.SHUTDOWN,
+                      ProcMgrProxy.REQUEST_TIMEOUT, retry=False)
 
     def shutdown_done(self):
         """Shutdown callback called when remote socket is closed.
@@ -434,15 +856,25 @@ class ProcMgrProxy(object):
         Return: True, meaning callback is done.
         """
         self._reader.read_lines()  # Should be None, EOF.
+        self._complete(('shutdown',))
         print self.address, "remote process manager closed"
         self.close()
+        for c in self.remote_commands:
+            c.reset()
         return True  # Callback done.
 
     def close(self):
-        """Close socket if necessary."""
+        """Close socket if necessary and forget pending requests."""
+        self._disconnect()
+        self._requests = {}
+
+    def _disconnect(self):
+        """Close socket if necessary, keeping pending requests for retry."""
         if self._socket is not None:
             self._socket.close()
             self._socket = None
+            self._out_buffer = ''
+            self._synced = False
 
     def _stop_binary(self, alias):
         """Send command to ProcessManager to stop a running binary on remote
@@ -456,21 +888,76 @@ class ProcMgrProxy(object):
             command = process_manager.ProcessManager.STOP + '\n'
         else:
             command = '%s %s\n' % (process_manager.ProcessManager.STOP, alias)
-        self._socket.sendall(command)
+        self._send(command)
 
     def collect_log(self):
-        """Collect logs from remote machine to local folder.
-
-        Parameters:
-            dest: (str) The path of local folder.
+        """Collect logs from remote machine to '<host>_<port>/' in the log
+        path, replacing the logs collected before, and record the clock
+        offset of the remote machine for log_merge.
         """
         path = 'cluster_test_%d/*.log' % self.address[1]
         src = "%s@%s:%s" % (self.user_name, self.address[0], path)
-        dest = console_config._log_path
+        dest = os.path.join(console_config._log_path,
+                            '%s_%d' % (self.address[0], self.address[1]))
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        os.makedirs(dest)
         self._rsync(src, dest)
+        clock = self.measure_clock_offset()
+        if clock is not None:
+            print "%s: clock offset %+.3fs (+/- %.3fs), UTC%+.1fh" % (
+                self.address, clock[0], clock[1], clock[2] / 3600.0)
+            log_merge.write_clock_offset(dest, *clock)
+
+    def measure_clock_offset(self, rounds=3):
+        """Measure how far the clock of the remote machine is ahead of ours.
+
+        A remote script answers every newline with its time and how far its
+        local time is ahead of UTC, which log_merge needs for timestamps
+        without a time zone. The time is compared with the middle of the
+        round trip, and the round with the shortest round trip wins, which
+        excludes the time to start SSH.
+
+        Return: (offset, error, utc_offset) in seconds, None if SSH fails.
+        """
+        script = ('import sys, time; [(sys.stdout.write("%r %d\\n" % ('
+                  'time.time(), -(time.altzone if time.localtime().tm_isdst '
+                  '> 0 else time.timezone))), sys.stdout.flush()) '
+                  'for l in iter(sys.stdin.readline, "")]')
+        process = subprocess.Popen(
+            self._ssh_args("python -c %s" % escape(script), use_pwd=False),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        best = None
+        try:
+            for _ in range(rounds):
+                sent = time.time()
+                process.stdin.write('\n')
+                process.stdin.flush()
+                remote, utc_offset = process.stdout.readline().split()
+                received = time.time()
+                rtt = received - sent
+                if best is None or rtt < best[1] * 2:
+                    best = (float(remote) - (sent + received) / 2, rtt / 2,
+                            int(utc_offset))
+        except (IOError, ValueError) as e:
+            print self.address, "failed to measure clock offset:", e
+        process.stdin.close()
+        process.wait()
+        return best
 
     def clean_all(self):
         """Clean all process manager, mongod, mongos and mongo."""
+        if self.local_root is not None:
+            # Only the processes of this process manager, not every mongod
+            # of this machine.
+            path = os.path.join(self.local_root,
+                                'cluster_test_%d' % self.address[1])
+            for pid in provisioning.local_processes(path):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            return
         for p in ['process_manager.py', 'mongo']:
             cmd = ("ps aux | grep %s | grep -v grep | awk '{ print $2 }'"
             " | xargs kill -s 9") % p
@@ -482,42 +969,161 @@ class ProcMgrProxy(object):
         m = re.match(r"^(?P<alias>[^\s]*)\s+(?P<resp>.*)$", response)
         return m.group('alias'), m.group('resp')
 
+    @staticmethod
+    def _parse_reply(response, prefix):
+        """Parse the JSON following prefix in response, e.g. the reply of
+        'status'. None if response is not such a reply."""
+        if not (response.startswith(prefix + '[') or
+                response.startswith(prefix + '{')):
+            return None
+        return json.loads(response[len(prefix):])
+
 
 class Console(object):
     """Console deploys test system, manages process managers and reports
         the progress.
     """
+    # Commands that can run as jobs, i.e. with '&'. Others are interactive or
+    # manage jobs.
+    BACKGROUND_COMMANDS = ['con', 'setup', 'run', 'status', 'stop',
+                           'shutdown', 'close', 'collect', 'clean', 'e',
+                           'wait']
+
     def __init__(self):
         self._done = False
         self._remote_commands = []
         self._process_managers = []
         self._key_file = None
+        # (namespace, path) of the command configs, see config().
+        self._configs = []
+        # Map from namespace to the globals of its config.
+        self._namespaces = {}
+        # Whether the config ran in this console, so that the phase checkers
+        # and the provisioner exist. False if the plan came from the cache.
+        self._hydrated = False
+        # Report of the script being run by run_script(), None if
+        # interactive.
+        self._report = None
+        self._jobs = jobs.JobManager()
+        # Held while talking to process managers, which jobs and the prompt
+        # do concurrently.
+        self._io_lock = threading.RLock()
+        # Poller on proxy sockets and the file number each is registered by.
+        self._poller = process_manager.Poller()
+        self._poll_fds = {}
 
-    def config(self, command_config_path):
-        """Configure Console with a command config file."""
-        
+    @staticmethod
+    def parse_configs(specs):
+        """Parse '-c' arguments into configs for config().
+
+        Args:
+            specs: (list of str) 'path' or 'namespace=path'. Configs without
+                a namespace get the name of their file, unless there is only
+                one.
+
+        Return: (list of (str, str)) The namespace and path of every config.
+        """
+        configs = []
+        for spec in specs:
+            namespace, sep, path = spec.partition('=')
+            if not sep:
+                path = spec
+                namespace = (None if len(specs) == 1 else
+                             re.sub(r'\W', '_', os.path.basename(spec)))
+            configs.append((namespace, path))
+        namespaces = [ns for ns, _ in configs]
+        if len(set(namespaces)) != len(namespaces):
+            raise ValueError('Namespaces must differ: %s' % namespaces)
+        return configs
+
+    def _describe_configs(self):
+        return ', '.join(path if ns is None else '%s=%s' % (ns, path)
+                         for ns, path in self._configs)
+
+    def config(self, configs, refresh=False):
+        """Configure Console with command config files.
+
+        Several configs are loaded side by side, each in its namespace: the
+        aliases of its commands and names of its phase checkers are prefixed
+        with '<namespace>.', and processes whose ports collide with another
+        namespace's get free ports, see console_config._claim_port().
+        Commands for the same process manager share its connection.
+
+        The plan of the configs is loaded from plan_cache if it is up to
+        date, without running them.
+
+        Args:
+            configs: (str or list of (str, str)) The path of a config, or the
+                namespace and path of every config, see parse_configs().
+            refresh: (boolean) Run the configs even if their plan is cached.
+        """
+        if isinstance(configs, basestring):
+            configs = [(None, configs)]
+        self._configs = configs
+        start = time.time()
+        plan = None if refresh else plan_cache.load(configs)
+        if plan is not None:
+            console_config._load_plan_state(plan.remote_commands, plan.state)
+            self._remote_commands = plan.remote_commands
+            self._key_file = console_config._key_file
+            self._hydrated = False
+            print "Loaded cached plan of %s (%d commands) in %.3fs" % (
+                self._describe_configs(), len(self._remote_commands),
+                time.time() - start)
+            return
+
+        imported = self._exec_config()
+        self._hydrated = True
+        if imported is not None:
+            self._save_plan(imported)
+        print "Evaluated %s (%d commands) in %.2fs" % (
+            self._describe_configs(), len(self._remote_commands),
+            time.time() - start)
+
+    def _exec_config(self):
+        """Run the command configs in the console_config module.
+
+        A single config without namespace runs in the module itself, so it can
+        override e.g. _phase_check. Namespaced configs run in copies of it,
+        kept in self._namespaces for 'e <namespace>.<function>'.
+
+        Return: (set of str) Names of the modules the configs imported, None
+            if a config failed.
+        """
         # Read configs
         # Run console config in console_config module.
         m = sys.modules['console_config']
+        console_config._reset()
+        modules = set(sys.modules)
+        failed = False
+        self._namespaces = {}
         
         # Save the current dir
         cwd = os.getcwd()
-                
-        # Open and execute remote command config file.
-        with open(command_config_path, 'r') as command_file:
-            try:
-                # Reset the current path to the command file's directory
-                os.chdir(os.path.dirname(command_config_path))
-    
-                exec command_file in m.__dict__
-                        
-            except Exception as e:
-                print "Error in command config file:"
-                print e
-                print traceback.format_exc()
+
+        for namespace, path in self._configs:
+            console_config._namespace = namespace
+            if namespace is None:
+                scope = m.__dict__
+            else:
+                scope = self._namespaces[namespace] = dict(m.__dict__)
+            # Open and execute remote command config file.
+            with open(path, 'r') as command_file:
+                try:
+                    # Reset the current path to the command file's directory
+                    os.chdir(os.path.dirname(os.path.abspath(path)))
         
-        # Reset the path
-        os.chdir(cwd)
+                    exec command_file in scope
+                            
+                except Exception as e:
+                    print "Error in command config file %s:" % path
+                    print e
+                    print traceback.format_exc()
+                    failed = True
+            
+            # Reset the path
+            os.chdir(cwd)
+        console_config._namespace = None
         
         alias_set = set()
         self._remote_commands = []
@@ -529,6 +1135,72 @@ class Console(object):
                 print 'Global duplicated alias (ignored):', c.alias, c.command
         
         self._key_file = console_config._key_file
+        if failed:
+            return None
+        return set(sys.modules) - modules
+
+    def _save_plan(self, imported):
+        """Cache the plan of the configs that just ran."""
+        checkers = [(c.name, c.phase, c.deps, c.timeout)
+                    for c in console_config._phase_checkers]
+        plan = plan_cache.Plan(self._remote_commands,
+                               console_config._plan_state(), checkers,
+                               plan_cache.dependencies(self._configs,
+                                                       imported))
+        try:
+            plan_cache.save(self._configs, plan)
+        except Exception as e:
+            # E.g. a command holding an object that can't be pickled.
+            print "Could not cache the plan:", e
+
+    @staticmethod
+    def _digest(remote_commands):
+        """What identifies a list of commands, regardless of their state."""
+        return [(c.address, c.alias, c.command, c.phase, c.wait, c.deps,
+                 c.forward) for c in remote_commands]
+
+    def _hydrate(self):
+        """Run the config if the plan came from the cache, for the phase
+        checkers and the provisioner.
+
+        The commands already known, and their state, are kept if the config
+        still generates the same commands.
+        """
+        if self._hydrated:
+            return
+        cached = self._remote_commands
+        start = time.time()
+        imported = self._exec_config()
+        self._hydrated = True
+        print "Evaluated %s in %.2fs" % (self._describe_configs(),
+                                         time.time() - start)
+        if self._digest(self._remote_commands) == self._digest(cached):
+            self._remote_commands = cached
+            console_config._remote_commands = cached
+        else:
+            print "Warning: the commands of the cached plan are out of date."
+            self.async_run_all(ProcMgrProxy.close)
+            self.init_proxies()
+            if imported is not None:
+                self._save_plan(imported)
+
+    def print_plan(self):
+        """Print where the plan came from and its phase checkers."""
+        print "Config:", self._describe_configs()
+        print "Evaluated in this console:", self._hydrated
+        plan = plan_cache.load(self._configs)
+        if plan is None:
+            print "No cached plan."
+        else:
+            print "Cached plan from %s, depending on:" % time.ctime(
+                plan.created)
+            for path in sorted(plan.deps):
+                print "   ", path
+            print "Phase checkers:"
+            for name, phase, deps, timeout in plan.checkers:
+                print "    %s (phase %s, deps %s, timeout %s)" % (
+                    name, phase, deps, timeout)
+        print "Commands:", len(self._remote_commands)
 
     def init_proxies(self):
         """Initialize proxies."""
@@ -536,9 +1208,9 @@ class Console(object):
         address_dict = {}
         for rc in self._remote_commands:
             if rc.address not in address_dict:
-                address_dict[rc.address] = ProcMgrProxy(rc.address,
-                                                        rc.user_name,
-                                                        self._key_file)
+                address_dict[rc.address] = ProcMgrProxy(
+                    rc.address, rc.user_name, self._key_file,
+                    local_root=console_config._local_roots.get(rc.address[0]))
             
             if not address_dict[rc.address].add_remote_command(rc):
                 print ('Duplicated alias <%s>. Remote command: %s' % 
@@ -557,90 +1229,500 @@ class Console(object):
         while not self._done:
             in_command = raw_input('> ')
             print in_command
-            if in_command == 'exit':
-                self.async_run_all(ProcMgrProxy.close)
-                self._done = True
-            elif in_command == 'con':
-                self.connect_all()
-            elif in_command == 'setup':
-                self.async_run_all(ProcMgrProxy.set_up)
-            elif in_command == 'run':
-                # Auto connect.
-                if not self.connect_all():
-                    continue
-                # Run command in phases.
-                s = set([c.phase for c in self._remote_commands])
-                phases = list(s)
-                phases.sort()
-                for p in phases:
-                    print '\n', '=' * 20, "Current phase:", p, '=' * 20
-                    start_method = lambda pm: pm.start_run(p)
-                    self.async_run_all(start_method, ProcMgrProxy.run_done)
-                    if not console_config._phase_check(p):
-                        print "Error in phase_check, break."
+            self.execute(in_command)
+
+    def run_script(self, commands, report_path=None, keep_going=False):
+        """Run commands without prompting, recording a run trace and a
+        report, see run_report.
+
+        Args:
+            commands: (list of str) Console commands.
+            report_path: (str) Where to write the report, default
+                '<log_path>/report-<time>.json'.
+            keep_going: (boolean) Run the remaining commands after one fails.
+
+        Return: Whether all commands succeeded.
+        """
+        self._report = run_report.Report(self._describe_configs())
+        tracer = run_trace.start()
+        try:
+            for in_command in commands:
+                print '> ' + in_command
+                start = time.time()
+                try:
+                    with run_trace.span(in_command, 'console'):
+                        ok = self.execute(in_command)
+                except Exception:
+                    print traceback.format_exc()
+                    ok = False
+                self._report.add_step(in_command, start, time.time(), ok)
+                if not ok:
+                    print "Command failed:", in_command
+                    if not keep_going:
                         break
-            elif in_command == 'show':
-                # Print setup
-                print '\n', '=' * 20, "SETUP", '=' * 20
-                print "Local Resources:\n", console_config._local_resource_syncs
-                print "Downloads:\n", console_config._remote_resource_downloads
-                print "\nScripts:\n", console_config._setup_scripts
-                
-                # Print phases
-                phases = [(c.phase, c) for c in self._remote_commands]
-                phases.sort()
-                cur_phase = -1                
-                for p in phases:
-                    if p[0] != cur_phase:
-                        print '\n', '=' * 20, "Phase:", p[0], '=' * 20
-                        cur_phase = p[0]
-                    print p[1].alias, ":", p[1].address, p[1].command
-            elif in_command == 'stop':
-                # Auto connect.
-                if not self.connect_all():
-                    continue
-                self.async_run_all(ProcMgrProxy.stop)
-            elif in_command == 'shutdown':
-                # Auto connect.
-                if not self.connect_all():
-                    continue
-                # Shutdown
-                self.async_run_all(ProcMgrProxy.start_shutdown,
-                                   ProcMgrProxy.shutdown_done)
-            elif in_command == 'close':
+                if self._done:
+                    break
+        finally:
+            if not self._done:
                 self.async_run_all(ProcMgrProxy.close)
-            elif in_command == 'collect':
-                # Remove all existing logs.
-                log_path = console_config._log_path
-                if os.path.exists(log_path):
-                    file_list = os.listdir(log_path)
-                    for f in file_list:
-                        os.remove(os.path.join(log_path, f))
-
-                self.async_run_all(ProcMgrProxy.collect_log)
-            elif in_command == 'stats':
-                if console_config._stats_server:
-                    self.run_stats(console_config._stats_server)
-                else:
-                    print "No stats server specified in test script."
+            stamp = time.strftime('%Y%m%d-%H%M%S')
+            run_trace.stop(os.path.join(console_config._log_path,
+                                        'trace-%s.json' % stamp))
+            run_trace.print_phase_summary(tracer)
+            self._report.write(report_path or os.path.join(
+                console_config._log_path, 'report-%s.json' % stamp), tracer)
+        return self._report.ok
+
+    def execute(self, in_command):
+        """Execute a console command.
+
+        Return: Whether the command succeeded.
+        """
+        if in_command.endswith('&'):
+            in_command = in_command[:-1].strip()
+            if in_command.split(' ', 1)[0] not in Console.BACKGROUND_COMMANDS:
+                print "Can't run <%s> in the background." % in_command
+                return False
+            self._jobs.start(in_command, lambda: self.execute(in_command))
+            return True
+        if in_command == 'exit':
+            for job in self._jobs.running():
+                print "Cancelling job %d: %s" % (job.id, job.command)
+                job.cancel()
+            self.async_run_all(ProcMgrProxy.close)
+            self._done = True
+        elif in_command == 'con':
+            return self.connect_all()
+        elif re.match(r"^setup(\s+--force)?$", in_command):
+            return self.set_up_all(in_command.endswith('--force'))
+        elif in_command == 'run --dag':
+            # Auto connect.
+            if not self.connect_all():
+                return False
+            self._hydrate()
+            return self._traced(self.run_dag)
+        elif in_command == 'run':
+            # Auto connect.
+            if not self.connect_all():
+                return False
+            self._hydrate()
+            return self._traced(self.run_phases)
+        elif in_command == 'status':
+            # Auto connect.
+            if not self.connect_all():
+                return False
+            self.async_run_all(lambda pm: pm.start_sync(force=True),
+                               ProcMgrProxy.sync_done)
+            self._print_status()
+        elif re.match(r"^top(\s+.*)?$", in_command):
+            # Auto connect.
+            if not self.connect_all():
+                return False
+            try:
+                options = top_view.TopOptions(shlex.split(in_command)[1:])
+            except top_view.TopError as e:
+                print e
+                return False
+            self.top(options)
+        elif in_command == 'show':
+            # Print setup
+            print '\n', '=' * 20, "SETUP", '=' * 20
+            print "Local Resources:\n", console_config._local_resource_syncs
+            print "Downloads:\n", console_config._remote_resource_downloads
+            print "\nScripts:\n", console_config._setup_scripts
             
-            elif in_command == 'clean':
-                self.async_run_all(ProcMgrProxy.clean_all)
-            elif in_command == 'terminate':
-                if console_config._provisioner is not None:
-                    console_config._provisioner.terminate_all()
-                else:
-                    print "No provisioner."
-            elif in_command == 'help':
-                Console._print_help()
-            elif re.match(r"^e\s+(?P<fun>.*)$", in_command):
-                m = re.match(r"^e\s+(?P<fun>.*)$", in_command)
+            # Print phases
+            phases = [(c.phase, c) for c in self._remote_commands]
+            phases.sort()
+            cur_phase = -1                
+            for p in phases:
+                if p[0] != cur_phase:
+                    print '\n', '=' * 20, "Phase:", p[0], '=' * 20
+                    cur_phase = p[0]
+                print p[1].alias, ":", p[1].address, p[1].command
+        elif in_command == 'stop':
+            # Auto connect.
+            if not self.connect_all():
+                return False
+            self.async_run_all(ProcMgrProxy.stop)
+        elif in_command == 'shutdown':
+            # Auto connect.
+            if not self.connect_all():
+                return False
+            # Shutdown
+            self.async_run_all(ProcMgrProxy.start_shutdown,
+                               ProcMgrProxy.shutdown_done)
+        elif in_command == 'close':
+            self.async_run_all(ProcMgrProxy.close)
+        elif re.match(r"^collect(\s+--index)?$", in_command):
+            self.ssh_all(ProcMgrProxy.collect_log)
+            if in_command.endswith('--index'):
+                log_index.ingest(console_config._log_path)
+        elif re.match(r"^logq(\s+.*)?$", in_command):
+            try:
+                log_index.run_query(console_config._log_path,
+                                    shlex.split(in_command)[1:])
+            except SystemExit:
+                # Bad arguments or -h, usage is printed.
+                return False
+        elif re.match(r"^latency(\s+.*)?$", in_command):
+            phase_of = dict((c.alias, c.phase) for c in self._remote_commands)
+            try:
+                return latency_report.run(console_config._log_path,
+                                          shlex.split(in_command)[1:],
+                                          phase_of)
+            except SystemExit:
+                # Bad arguments or -h, usage is printed.
+                return False
+        elif re.match(r"^logs(\s+.*)?$", in_command):
+            args = shlex.split(in_command)[1:]
+            out_path = None
+            if args[:1] == ['-o'] and len(args) > 1:
+                out_path = args[1]
+                args = args[2:]
+            pattern = args[0] if args else None
+            sources = log_merge.find_sources(console_config._log_path,
+                                             pattern)
+            if not sources:
+                print "No logs, perhaps you should run 'collect' first."
+                return False
+            log_merge.output(log_merge.merge(sources), out_path)
+        elif in_command == 'stats':
+            self._hydrate()
+            if console_config._stats_server:
+                self.run_stats(console_config._stats_server)
+            else:
+                print "No stats server specified in test script."
+                return False
+        elif in_command == 'clean':
+            self.ssh_all(ProcMgrProxy.clean_all)
+        elif in_command == 'terminate':
+            self._hydrate()
+            if console_config._provisioners:
+                for provisioner in console_config._provisioners:
+                    provisioner.terminate_all()
+                # The machines of the plan are gone.
+                plan_cache.clear(self._configs)
+            else:
+                print "No provisioner."
+                return False
+        elif in_command == 'plan':
+            self.print_plan()
+        elif in_command == 'plan refresh':
+            self.async_run_all(ProcMgrProxy.close)
+            self.config(self._configs, refresh=True)
+            self.init_proxies()
+        elif in_command == 'plan clear':
+            print "Removed %d cached plans." % plan_cache.clear(
+                self._configs)
+        elif in_command == 'jobs':
+            self._jobs.print_jobs()
+        elif in_command == 'wait':
+            return all([self._jobs.wait(job)
+                        for job in self._jobs.running()])
+        elif re.match(r"^(wait|cancel)\s+%\d+$", in_command):
+            # Jobs are '%<id>' as in bash, a bare number is a duration.
+            command, job_id = in_command.split()
+            job_id = job_id[1:]
+            job = self._jobs.get(int(job_id))
+            if job is None:
+                print "No job %s." % job_id
+                return False
+            if command == 'cancel':
+                job.cancel()
+                return True
+            return self._jobs.wait(job)
+        elif re.match(r"^wait\s+\S+$", in_command):
+            try:
+                seconds = run_report.parse_duration(in_command.split()[1])
+            except ValueError as e:
+                print e
+                return False
+            print "Waiting %ds..." % seconds
+            with run_trace.span('wait %ds' % seconds, 'console'):
+                jobs.sleep(seconds)
+        elif in_command == 'help':
+            Console._print_help()
+        elif re.match(r"^e\s+(?P<fun>.*)$", in_command):
+            m = re.match(r"^e\s+(?P<fun>.*)$", in_command)
+            self._hydrate()
+            namespace, _, fun = m.group('fun').rpartition('.')
+            if namespace:
+                # A function of a namespaced config.
+                if namespace not in self._namespaces:
+                    print 'unknown namespace:', namespace
+                    return False
+                scope = self._namespaces[namespace]
+                if fun not in scope:
+                    print 'no function %s in namespace %s' % (fun, namespace)
+                    return False
+                scope[fun]()
+            else:
                 try:
-                    getattr(console_config, m.group('fun'))()
+                    getattr(console_config, fun)()
                 except AttributeError as e:
                     print e
-            else:
-                print 'unknown command:', in_command
+                    return False
+        else:
+            print 'unknown command:', in_command
+            return False
+        return True
+
+
+    def run_phases(self):
+        """Run commands phase by phase, running the phase checkers of every
+        phase after its commands are acknowledged.
+
+        Return: Whether all phases succeeded.
+        """
+        s = set([c.phase for c in self._remote_commands])
+        phases = list(s)
+        phases.sort()
+        done_phases = self._done_phases()
+        for p in phases:
+            jobs.check_cancelled()
+            if p in done_phases:
+                print "Phase %d is already running, skipped." % p
+                continue
+            print '\n', '=' * 20, "Current phase:", p, '=' * 20
+            with run_trace.span('phase %d' % p, 'phase', phase=p):
+                start_method = lambda pm: pm.start_run(p)
+                self.async_run_all(start_method, ProcMgrProxy.run_done)
+                failed = [c.alias for c in self._remote_commands
+                          if c.phase == p and c.state == RemoteCommand.FAILED]
+                if failed:
+                    print "No response for %s, break." % ', '.join(failed)
+                    return False
+                try:
+                    ok = console_config._phase_check(p)
+                except command_graph.GraphError as e:
+                    print "Error in phase checkers:", e
+                    return False
+                if not ok:
+                    print "Error in phase_check, break."
+                    return False
+        return True
+
+    def _traced(self, run_method):
+        """Call run_method while recording a run trace, then write the trace
+        to the log path and print the phase summary.
+
+        In a script the span goes to the trace of the script instead.
+
+        Return: What run_method returns.
+        """
+        if run_trace.tracing():
+            with run_trace.span('run', 'console'):
+                return run_method()
+        tracer = run_trace.start()
+        try:
+            with run_trace.span('run', 'console'):
+                return run_method()
+        finally:
+            path = os.path.join(console_config._log_path,
+                                time.strftime('trace-%Y%m%d-%H%M%S.json'))
+            run_trace.stop(path)
+            run_trace.print_phase_summary(tracer)
+
+    def top(self, options):
+        """Show the processes of all process managers until Ctrl-C, or once.
+
+        Process managers push updates of what changed, so a refresh costs
+        little even with many processes.
+
+        Args:
+            options: (top_view.TopOptions)
+        """
+        proxies = [pm for pm in self._process_managers if pm.is_connected()]
+        with self._io_lock:
+            for pm in proxies:
+                pm.start_top(options.interval)
+        start = time.time()
+        next_draw = start + 0.5  # Give the first updates time to arrive.
+        try:
+            while True:
+                # Let jobs talk to process managers between polls.
+                with self._io_lock:
+                    for pm in self._poll(proxies, 0.2):
+                        pm.read_acks()
+                now = time.time()
+                if options.once:
+                    # Wait for the first update of everyone, but not forever.
+                    if (all(pm.top_time is not None for pm in proxies) or
+                            now - start > 2 * options.interval + 5):
+                        print top_view.render(proxies, options, clear=False)
+                        break
+                elif now >= next_draw:
+                    print top_view.render(proxies, options)
+                    print "Press Ctrl-C to stop."
+                    next_draw = now + options.interval
+        except KeyboardInterrupt:
+            print
+        finally:
+            for pm in proxies:
+                pm.stop_top()
+            # Flush the requests to stop.
+            self.async_run_all(lambda pm: True)
+
+    def _done_phases(self):
+        """Phases that an earlier run already got through.
+
+        A phase is done if all its commands are running and some command of a
+        later phase is running too, which means the phase checkers of the
+        phase passed.
+
+        Return: (set of int)
+        """
+        started = [c.phase for c in self._remote_commands
+                   if c.state == RemoteCommand.DONE]
+        if not started:
+            return set()
+        return set(c.phase for c in self._remote_commands
+                   if c.phase < max(started)) - set(
+                       c.phase for c in self._remote_commands
+                       if c.state != RemoteCommand.DONE)
+
+    def _print_status(self):
+        """Print the state of every command."""
+        commands = sorted(self._remote_commands,
+                          key=lambda c: (c.phase, c.address, c.alias))
+        print "%-5s %-24s %-30s %-8s %-8s %s" % ('phase', 'address', 'alias',
+                                                  'state', 'pid', 'restarts')
+        for c in commands:
+            print "%-5d %-24s %-30s %-8s %-8s %s" % (
+                c.phase, '%s:%s' % c.address, c.alias, c.state,
+                c.pid if c.pid is not None else '-',
+                c.restarts if c.restarts is not None else '-')
+        dropped = [c for c in commands if c.dropped]
+        if dropped:
+            print "Lines dropped by log forwarding:", ', '.join(
+                '%s %d' % (c.alias, c.dropped) for c in dropped)
+
+    def run_dag(self):
+        """Run commands and phase checkers as soon as their own prerequisites
+        are done, instead of phase by phase. See command_graph for how
+        prerequisites are derived.
+
+        Commands are sent to process managers when ready and done when
+        acknowledged. Phase checkers run in their own threads. At the end, the
+        critical path of the run is printed.
+
+        Return: Whether all commands and phase checkers succeeded.
+        """
+        try:
+            nodes = command_graph.build(self._remote_commands,
+                                        console_config._phase_checkers)
+        except command_graph.GraphError as e:
+            print "Error in command graph:", e
+            return False
+
+        proxy_for = {}
+        name_of = {}
+        for pm in self._process_managers:
+            for c in pm.remote_commands:
+                proxy_for[c] = pm
+        for name, node in nodes.items():
+            name_of[node.item] = name
+
+        # Commands still running from an earlier run are done, and so are
+        # the phase checkers of phases it got through.
+        done_phases = self._done_phases()
+        done = set(name for name, node in nodes.items()
+                   if (node.is_command and
+                       node.item.state == RemoteCommand.DONE) or
+                   (not node.is_command and node.phase in done_phases))
+        pending = set(nodes) - done
+        running = set()
+        results = Queue.Queue()  # (checker, success) of finished checkers.
+        success = True
+
+        while success and (pending or running):
+            jobs.check_cancelled()
+            # Start every node whose prerequisites are done.
+            for name in [n for n in pending if nodes[n].deps <= done]:
+                node = nodes[name]
+                pending.remove(name)
+                running.add(name)
+                node.start = time.time()
+                if node.is_command:
+                    print node.item.alias, ' : ', node.item.command
+                    with self._io_lock:
+                        proxy_for[node.item]._start_run_binary(node.item)
+                else:
+                    node.item.start(results)
+
+            if not running:
+                break
+
+            # Wait for acknowledgements, polling checker results regularly.
+            waiting = set(proxy_for[nodes[n].item] for n in running
+                          if nodes[n].is_command)
+            finished = []
+            with self._io_lock:
+                for pm in self._poll(waiting, 0.1):
+                    finished.extend(name_of[c] for c in pm.read_acks())
+                for pm in waiting:
+                    pm.check_timeouts()
+            for name in running:
+                node = nodes[name]
+                if node.is_command and node.item.state == RemoteCommand.FAILED:
+                    print "Command <%s> failed, stop." % name
+                    success = False
+            while not results.empty():
+                checker, ok = results.get()
+                name = name_of[checker]
+                if not ok:
+                    print "Error in phase checker <%s>, stop." % name
+                    success = False
+                finished.append(name)
+            for name in running:
+                node = nodes[name]
+                if not node.is_command and node.item.timed_out(node.start):
+                    print "Phase checker <%s> timed out, stop." % name
+                    success = False
+                    node.item.cancel()
+            for name in finished:
+                if name in running:
+                    nodes[name].finish = time.time()
+                    running.remove(name)
+                    done.add(name)
+        console_config.close_connections(
+            [n.item for n in nodes.values() if not n.is_command])
+        jobs.check_cancelled()
+
+        command_graph.print_critical_path(nodes)
+        if pending:
+            print "Not started:", ', '.join(sorted(pending))
+        return success and not pending
+
+    def set_up_all(self, force=False):
+        """Set up all hosts, see ProcMgrProxy.set_up().
+
+        Return: Whether all hosts were set up.
+        """
+        failed = []
+        def set_up(pm):
+            start = time.time()
+            with run_trace.span('setup', 'setup', pm._lane()) as span:
+                ok = span.args['ok'] = pm.set_up(force)
+            if self._report is not None:
+                self._report.add_setup(pm._lane(), start, time.time(), ok,
+                                       pm.setup_results)
+            if not ok:
+                failed.append(pm._lane())
+        self.ssh_all(set_up)
+        # The process managers are started in the background, wait until
+        # they listen so that 'run' can connect right away.
+        started = [pm for pm in self._process_managers
+                   if pm._lane() not in failed]
+        listening = console_config.wait_for_all(
+            [pm.address for pm in started],
+            timeout=ProcMgrProxy.AGENT_START_TIMEOUT)
+        failed.extend(pm._lane() for pm in started
+                      if pm.address not in listening)
+        if failed:
+            print "Setup failed on", ', '.join(failed)
+        return not failed
 
     def connect_all(self):
         """Connect to all process managers.
@@ -651,18 +1733,32 @@ class Console(object):
         if not all(p.is_connected() for p in self._process_managers):
             print 'Connecting...'
             self.async_run_all(ProcMgrProxy.connect)
+        # Learn what is running on newly connected process managers.
+        self.async_run_all(ProcMgrProxy.start_sync, ProcMgrProxy.sync_done)
         # Check failure.
         success = all(p.is_connected() for p in self._process_managers)
         if not success:
             print "Perhaps you should run 'setup' first"
         return success
 
+    def ssh_all(self, method):
+        """Call method on every proxy in turn, for methods that only use SSH
+        and rsync. Unlike async_run_all(), other commands can talk to process
+        managers meanwhile. The call is a span of the run trace.
+        """
+        with run_trace.span('ssh_all ' + method.__name__, 'console'):
+            for pm in self._process_managers:
+                jobs.check_cancelled()
+                method(pm)
+
     def async_run_all(self, start_method, callback_method=None):
         """Send commmand to all process managers and wait for response
         in any given order.
 
         After commands are sent sequentially, they are running on remote
-        machines in parallel. We use select() to get responses without blocking.
+        machines in parallel. We use a Poller to get responses and to flush
+        buffered requests without blocking. Overdue requests are retried, see
+        ProcMgrProxy.check_timeouts(). The call is a span of the run trace.
 
         Args:
             start_method: Class method of ProcMgrProxy which runs on each proxy
@@ -675,20 +1771,68 @@ class Console(object):
                 means no response.
 
                 *IMPORTANT* Only if the callback_method returns True, meaning
-                callback is done, we remove it from next select(), so that the
+                callback is done, or no request of the proxy is waiting for a
+                response any more, we remove it from next poll, so that the
                 loop could stop.
         """
-        # start_method returns False or None when it is not done.
-        active_pms = [pm for pm in self._process_managers
-                      if not start_method(pm)]
-
-        if callback_method is not None:
-            while active_pms:
-                # Select on read list with timeout.
-                (rlist, _, _) = select.select(active_pms, [], [], 10)
-                for pm in rlist:
-                    if callback_method(pm):
+        method = callback_method or start_method
+        with self._io_lock, run_trace.span('async_run_all ' + method.__name__,
+                                           'console'):
+            # start_method returns False or None when it is not done.
+            active_pms = [pm for pm in self._process_managers
+                          if not start_method(pm)]
+            if callback_method is None:
+                active_pms = []
+
+            # Loop until all responses are received and all requests are sent.
+            while active_pms or any(pm.wants_write()
+                                    for pm in self._process_managers):
+                for pm in self._poll(active_pms, 1):
+                    if pm in active_pms and callback_method(pm):
                         active_pms.remove(pm)
+                for pm in active_pms[:]:
+                    pm.check_timeouts()
+                    if not pm.has_requests():
+                        active_pms.remove(pm)
+
+    def _poll(self, readers, timeout):
+        """Flush buffered requests and wait for responses.
+
+        Args:
+            readers: (collection of ProcMgrProxy) Proxies waiting for response.
+            timeout: (float) Seconds to wait at most.
+
+        Returns:
+            (list of ProcMgrProxy) Readers that became ready for reading.
+        """
+        for pm in self._process_managers:
+            # Forget the old file number if the proxy reconnected or closed.
+            old_fd = self._poll_fds.pop(pm, None)
+            fd = pm.fileno() if pm.is_connected() else None
+            registered = self._poller.registered().get(old_fd, (None, 0))[0]
+            if old_fd is not None and old_fd != fd and registered is pm:
+                self._poller.unregister(old_fd)
+            if fd is None:
+                continue
+            events = 0
+            if pm in readers:
+                events |= process_manager.Poller.READ
+            if pm.wants_write():
+                events |= process_manager.Poller.WRITE
+            self._poller.register(pm, events)
+            if events:
+                self._poll_fds[pm] = fd
+        if not self._poll_fds:
+            time.sleep(timeout)
+            return []
+
+        readable = []
+        for pm, events in self._poller.poll(timeout):
+            if events & process_manager.Poller.WRITE:
+                pm.flush()
+            if events & process_manager.Poller.READ and pm.is_connected():
+                readable.append(pm)
+        return readable
 
     def run_stats(self, stats_server):
         
@@ -711,16 +1855,49 @@ class Console(object):
     def _print_help():
         """Print usage help."""
         print "Usage:"
-        print ("1. setup. Copy files to remote cluster and lanch process"
-               " managers.")
-        print "2. con. Establish connections to every process manager."
-        print "3. run. Run binaries on remote machines."
+        print ("1. setup [--force]. Copy files to remote cluster and lanch"
+               " process managers. Setup scripts that already ran unchanged"
+               " are skipped unless --force is given.")
+        print ("2. con. Establish connections to every process manager and"
+               " learn which commands are already running.")
+        print ("   status. Show the state, pid and restarts of every"
+               " command.")
+        print ("   top [-s <key>] [-n <rows>] [-i <seconds>] [--once] [<glob>]."
+               " Live state, uptime, restarts, CPU and memory of all"
+               " processes, sorted by key (%s) and filtered by a host or"
+               " alias glob." % ', '.join(sorted(top_view.SORT_KEYS)))
+        print ("3. run. Run binaries on remote machines, skipping those"
+               " already running.")
+        print ("   run --dag. Start every command as soon as its own"
+               " prerequisites are done and print the critical path.")
         print "4. stop. Terminate binaries running in process manager."
         print "5. close. Close sockets to process manager."
         print ("6. shutdown. Stop binaries, shutdown process managers and"
                " close sockets.")
-        print ("7. e <function_name>. Execute function defined in"
-               " command_config.")
+        print ("7. e [<namespace>.]<function_name>. Execute function"
+               " defined in command_config, or in the config of a"
+               " namespace.")
+        print ("8. collect [--index]. Copy the logs of every host to"
+               " <log path>/<host>_<port>/ and measure clock offsets. With"
+               " --index, add new lines to the log index.")
+        print ("   logq [--logs <glob>] [--from <time>] [--to <time>]"
+               " [--by <keys>] [-n <rows>] [<words>]. Query the log index,"
+               " see logq -h.")
+        print ("   logs [-o <file>] [<glob>]. Merge collected logs of all"
+               " hosts in time order into a pager or file, filtered by a glob"
+               " of 'host:port/name'.")
+        print ("   latency [--by phase|host|mongos] [--interval <duration>]"
+               " [<glob>]. p50, p99, p99.9 and max latency of every op of the"
+               " load generators in the collected logs, per group and over"
+               " time.")
+        print ("9. plan [refresh|clear]. Show the cached plan of the command"
+               " config, run the config again, or remove the cached plan.")
+        print ("10. wait <duration>. Sleep, e.g. 'wait 30m' or 'wait 90'"
+               " between 'run' and 'collect' in a script run with --exec.")
+        print ("11. <command> &. Run con, setup, run, status, stop, shutdown,"
+               " close, collect, clean, e or wait as a background job.")
+        print ("    jobs. List jobs. wait [%<id>]. Follow the output of a job,"
+               " or of all jobs, until it ends. cancel %<id>. Stop a job.")
         print
 
     
@@ -741,15 +1918,41 @@ def main():
     """Main function that runs console to interact with user."""
     # Parse arguments.
     parser = argparse.ArgumentParser(description='Console for cluster test.')
-    parser.add_argument('-c', dest='command_config_file',
-        default='command_config',
-        help='set command config file path (default=command_config)')
+    parser.add_argument('-c', dest='configs', action='append',
+        metavar='[NAMESPACE=]PATH',
+        help='set command config file path (default=command_config). '
+             'Repeat to run several configs side by side, each in a '
+             'namespace named after its file unless given')
+    parser.add_argument('--refresh-plan', action='store_true',
+        help='run the command configs even if their plan is cached')
+    parser.add_argument('--exec', dest='script', default=None,
+        help='run commands separated by ";" without prompting, e.g. '
+             '"setup;run;wait 30m;collect;shutdown"')
+    parser.add_argument('--exec-file', dest='script_file', default=None,
+        help='run the commands in a file, one per line, without prompting')
+    parser.add_argument('--report', dest='report_path', default=None,
+        help='JSON report of --exec (default=<log path>/report-<time>.json)')
+    parser.add_argument('--keep-going', action='store_true',
+        help='with --exec, run the remaining commands after one fails')
     args = parser.parse_args()
 
+    try:
+        configs = Console.parse_configs(args.configs or ['command_config'])
+    except ValueError as e:
+        parser.error(str(e))
     console = Console()
-    console.config(args.command_config_file)
+    console.config(configs, args.refresh_plan)
     console.init_proxies()
-    console.run()
+    if args.script is None and args.script_file is None:
+        console.run()
+        return
+    if args.script_file is not None:
+        with open(args.script_file, 'r') as f:
+            commands = run_report.parse_script(f.read())
+    else:
+        commands = run_report.parse_script(args.script)
+    ok = console.run_script(commands, args.report_path, args.keep_going)
+    sys.exit(0 if ok else 1)
 
 if __name__ == '__main__':
     main()
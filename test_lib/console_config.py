@@ -1,19 +1,31 @@
 """This module provides the API that remote command config could use."""
 
 import datetime
+import errno
 import httplib
 import json
+import Queue
+import random
+import socket
+import threading
 import time
+import traceback
 import os
 
-import pymongo
 import hashlib
 
+import command_graph
+import connection_pool
 import console
+import jobs
+import process_manager
 import provisioning
+import run_trace
 
 # Provisioning
 _provisioner = None
+# Every provisioner set, by all namespaces.
+_provisioners = []
 
 # Test environment config
 _remote_commands = []
@@ -24,11 +36,76 @@ _key_file = None
 _remote_resource_downloads = {}
 _local_resource_syncs = {}
 _remote_binaries = {}
-_num_setup_scripts = 0
+# Map from host to the scripts uploaded on setup, see AddRemoteScript().
 _setup_scripts = {}
+# Map from the host of a machine of provisioning.Local to its local_root.
+_local_roots = {}
 
 _stats_server = None
 
+# Namespace of the config running, None when the console runs a single config.
+# Aliases and names of commands and phase checkers are prefixed with
+# '<namespace>.', see _scoped().
+_namespace = None
+
+# Ports of processes on every host, so that configs running side by side
+# don't collide: map from host to map from port to (namespace, alias).
+_ports = {}
+
+# Clusters created, for their default names.
+_clusters = 0
+
+# First port given by AllocatePort().
+FIRST_PORT = 27017
+
+# Globals above that are data and make up the cached plan, see plan_cache.
+# _remote_commands is cached separately.
+PLAN_GLOBALS = ['_bin_path', '_log_path', '_key_file',
+                '_remote_resource_downloads', '_local_resource_syncs',
+                '_remote_binaries', '_setup_scripts',
+                '_local_roots']
+
+# Timeout in seconds of the framework's phase checkers waiting for processes
+# and replica sets to be ready.
+READY_TIMEOUT = 10 * 60
+# Seconds that phase checkers cancelled after timing out get to stop.
+CANCEL_GRACE = 2
+
+# Seconds before the first retry of an endpoint in wait_for_all(), doubled on
+# every retry up to BACKOFF_MAX.
+BACKOFF_START = 0.05
+BACKOFF_MAX = 2.0
+# Seconds a connect of wait_for_all() may take before it is retried.
+CONNECT_TIMEOUT = 5
+# Attempts of addShard per shard, ADD_SHARD_RETRY_DELAY seconds apart at
+# first and doubling.
+ADD_SHARD_ATTEMPTS = 5
+ADD_SHARD_RETRY_DELAY = 1
+# Seconds between the first polls of replica set members for an elected
+# primary, growing by half on every poll up to ELECTION_POLL_MAX.
+ELECTION_POLL_START = 0.05
+ELECTION_POLL_MAX = 1.0
+
+# Resources of a machine that Placement balances.
+RESOURCES = ('cpu', 'mem', 'disk', 'net')
+
+# Estimated load of a process of every role, as fractions of a machine's
+# RESOURCES.
+ROLE_WEIGHTS = {
+    'mongod': (0.4, 0.5, 0.6, 0.3),
+    'configsvr': (0.05, 0.05, 0.1, 0.05),
+    'arbiter': (0.01, 0.01, 0.01, 0.01),
+    'mongos': (0.1, 0.05, 0.0, 0.2),
+    'loader': (0.1, 0.02, 0.0, 0.05),
+    'mongostat': (0.01, 0.01, 0.0, 0.01),
+    'mms': (0.02, 0.02, 0.0, 0.02),
+}
+
+# Roles that processes of a role keep away from by default, see Placement.
+ROLE_AVOID = {
+    'loader': ['mongod', 'configsvr'],
+}
+
 BASH_SETUP_SCRIPT_PREFIX = \
 """
 #!/bin/bash
@@ -43,19 +120,127 @@ MONGOSHELL_SETUP_SCRIPT_PREFIX = \
             
 """
 
+PYMONGO_SETUP_SCRIPT = \
+"""
+
+echo "Installing pymongo..."
+if [ -n "`command -v yum`" ]; then
+    sudo yum install -y python-devel python-setuptools gcc
+else
+    sudo apt-get install -y python-dev python-setuptools gcc
+fi
+
+sudo easy_install pip
+sudo pip install pymongo
+
+"""
+
+def _reset():
+    """Reset the globals to their values before the command config ran, so
+    that the config can run again."""
+    global _provisioner, _remote_commands, _bin_path, _log_path
+    global _phase_checkers, _key_file, _remote_resource_downloads
+    global _local_resource_syncs, _remote_binaries
+    global _setup_scripts, _stats_server, _phase_check, _provisioners
+    global _namespace, _ports, _local_roots, _clusters
+    _provisioner = None
+    _provisioners = []
+    _namespace = None
+    _ports = {}
+    _remote_commands = []
+    _bin_path = 'bin/'
+    _log_path = 'logs/'
+    _phase_checkers = []
+    _key_file = None
+    _remote_resource_downloads = {}
+    _local_resource_syncs = {}
+    _remote_binaries = {}
+    _setup_scripts = {}
+    _local_roots = {}
+    _stats_server = None
+    _clusters = 0
+    # The config may override it.
+    _phase_check = _default_phase_check
+
+def _plan_state():
+    """Values of PLAN_GLOBALS."""
+    return dict((name, globals()[name]) for name in PLAN_GLOBALS)
+
+def _load_plan_state(remote_commands, state):
+    """Set the globals from a cached plan instead of running the config."""
+    global _remote_commands
+    _reset()
+    _remote_commands = remote_commands
+    globals().update(state)
+
 def SetProvisioner(provisioner):
     """Provisioner setter. So that the console could know which provisioner is
     in use.
     """
     global _provisioner
     _provisioner = provisioner
+    if provisioner not in _provisioners:
+        _provisioners.append(provisioner)
+
+def _scoped(name):
+    """name in the current namespace, e.g. 'v207.rs1_1' for 'rs1_1'."""
+    if (_namespace is None or name is None or
+            name.startswith(_namespace + '.')):
+        return name
+    return '%s.%s' % (_namespace, name)
+
+def Namespace():
+    """The namespace of the config running, None if it runs alone."""
+    return _namespace
+
+def _free_port(host, start):
+    used = _ports.get(host, {})
+    port = start
+    while port in used:
+        port += 1
+    return port
+
+def _claim_port(host, port, alias):
+    """Claim a port on host for the process alias.
+
+    Args:
+        port: (int) The port the config asks for, None for any free port.
+
+    Returns:
+        (int) port, or the next free port if port is None or already used by
+        another namespace.
+    """
+    used = _ports.setdefault(host, {})
+    if port is None:
+        port = _free_port(host, FIRST_PORT)
+    elif port in used and used[port][0] != _namespace:
+        free = _free_port(host, port + 1)
+        print "Port %d on %s is used by %s, %s gets port %d." % (
+            port, host, used[port][1], alias, free)
+        port = free
+    used[port] = (_namespace, alias)
+    return port
+
+def AllocatePort(pm, start=FIRST_PORT):
+    """A port on the host of pm that no process of any loaded config uses.
+
+    The port is claimed, so the next call returns another one.
+    """
+    port = _free_port(pm.host, start)
+    _ports.setdefault(pm.host, {})[port] = (_namespace, None)
+    return port
 
 def AddCommandToProcMgr(proc_mgr, *args, **kwargs):
     """Add command to Console for given process manager."""
+    rc = console.RemoteCommand(proc_mgr.host, proc_mgr.port,
+                               proc_mgr.machine.user_name, *args, **kwargs)
+    rc.alias = _scoped(rc.alias)
+    if rc.deps is not None:
+        rc.deps = [_scoped(d) for d in rc.deps]
+    if proc_mgr.machine.local_root is not None:
+        _local_roots[proc_mgr.host] = proc_mgr.machine.local_root
     # _remote_commands is a global variable.
-    _remote_commands.append(console.RemoteCommand(
-        proc_mgr.host, proc_mgr.port, proc_mgr.machine.user_name,
-        *args, **kwargs))
+    _remote_commands.append(rc)
 
 def AddWaitStaging(pm):
     """Add command that will be waiting for staging to finish.
@@ -146,39 +331,65 @@ def LogPath(path):
     global _log_path
     _log_path = path
 
-def AddPhaseChecker(*args):
-    """Add a phase checker to global list."""
-    _phase_checkers.append(PhaseChecker(*args))
+def AddPhaseChecker(*args, **kwargs):
+    """Add a phase checker to global list.
 
-def AddRemoteScript(pm, snippet, lang, isFile=False, runAtStart=False):
-    """Add a script snippet to rsync on setup"""
+    Raises:
+        ValueError: Another phase checker has the same name.
+    """
+    pc = PhaseChecker(*args, **kwargs)
+    pc.name = _scoped(pc.name)
+    if pc.name is not None and any(other.name == pc.name
+                                   for other in _phase_checkers):
+        raise ValueError('Duplicated phase checker name <%s>' % pc.name)
+    if pc.deps is not None:
+        pc.deps = [_scoped(d) for d in pc.deps]
+    _phase_checkers.append(pc)
+
+def AddRemoteScript(pm, snippet, lang, isFile=False, runAtStart=False,
+                    independent=False):
+    """Add a script snippet to rsync on setup.
+
+    Setup scripts run in the order they are added. Consecutive scripts marked
+    independent may run in parallel on the host.
+
+    Scripts are named after their content, 'snippet-<md5>' or
+    'snippet-<md5>-<file name>', so a script added for many processes, e.g.
+    the script of every MongoShell, is uploaded once per host.
+
+    Return: (str) The name of the script in base_remote_resources/scripts.
+    """
     global _setup_scripts
-    global _num_setup_scripts
     
     if not pm.host in _setup_scripts:
         _setup_scripts[pm.host] = []
     
-    name = "snippet%d" % _num_setup_scripts
-    _num_setup_scripts = _num_setup_scripts + 1
-    
     if not isFile:
         if lang == 'bash':
             snippet = BASH_SETUP_SCRIPT_PREFIX + "\n" + snippet
             
         if lang == 'mongoshell':
             snippet = MONGOSHELL_SETUP_SCRIPT_PREFIX + "\n" + snippet
+        
+        name = "snippet-%s" % hashlib.md5(snippet).hexdigest()
     
     else:
         snippet = os.path.abspath(snippet)
-        name = name + "-" + os.path.split(snippet)[1]
+        with open(snippet, 'r') as f:
+            digest = hashlib.md5(f.read()).hexdigest()
+        name = "snippet-%s-%s" % (digest, os.path.split(snippet)[1])
     
-    _setup_scripts[pm.host].append((name, snippet, lang, isFile, runAtStart))
+    # Scripts that run on setup run every time they are added, others are
+    # only uploaded.
+    if runAtStart or not any(s[0] == name for s in _setup_scripts[pm.host]):
+        _setup_scripts[pm.host].append(
+            (name, snippet, lang, isFile, runAtStart, independent))
     
     return name
 
-def AddSetupScript(pm, snippet):
+def AddSetupScript(pm, snippet, independent=False):
     """Add a script snippet to run on setup"""
-    AddRemoteScript(pm, snippet, 'bash', False, True)
+    AddRemoteScript(pm, snippet, 'bash', False, True, independent)
 
 def SetStatsServer(stats_script=None):
     """Set the default statistics server"""
@@ -209,6 +420,17 @@ def SetStatsServer(stats_script=None):
     _stats_server = StatsServer(stats_pm, 'default_stats_server', 27017, version='2.0.7', stats_script=stats_script)
     _stats_server.gen_command(1)
 
+def close_connections(checkers):
+    """Close the connections of connection_pool, unless some of checkers
+    still run and may use them. Checkers cancelled after timing out get
+    CANCEL_GRACE seconds to stop first. Connections of checkers that don't
+    stop by then are closed at the end of a later phase or run instead."""
+    deadline = time.time() + CANCEL_GRACE
+    for pc in checkers:
+        pc.join(max(0, deadline - time.time()))
+    if not any(pc.is_running() for pc in checkers):
+        connection_pool.close_all()
+
 def GetNextPhase():
     """ Gets the next unused phase """
     
@@ -226,26 +448,115 @@ def _phase_check(phase):
 
     Phases should be same with that defined in AddCommand.
 
+    The phase checkers of the phase run concurrently, each in its own thread.
+    A checker declaring deps waits for the named checkers of the same phase.
+    A checker without deps waits for all checkers added before it, as if they
+    ran in order. After the first failure or timeout no more checkers start.
+    Checkers whose deps never succeed, e.g. because they depend on each
+    other, fail the phase.
+
     Args:
         phase: (int) The phase just done.
+
+    Returns:
+        Whether all phase checkers of the phase succeeded.
+
+    Raises:
+        command_graph.GraphError: A checker depends on a name that is neither
+            a phase checker nor a command.
     """
+    checkers = [pc for pc in _phase_checkers if pc.phase == phase]
+    by_name = dict((pc.name, pc) for pc in checkers if pc.name is not None)
+    # Deps on checkers of other phases and on commands are done by now.
+    known = set(pc.name for pc in _phase_checkers)
+    known.update(rc.alias for rc in _remote_commands)
+    deps = {}
+    for i, pc in enumerate(checkers):
+        if pc.deps is None:
+            deps[pc] = set(checkers[:i])
+            continue
+        for d in pc.deps:
+            if d not in known:
+                raise command_graph.GraphError(
+                    '<%s> depends on unknown <%s>' % (pc.name, d))
+        deps[pc] = set(by_name[d] for d in pc.deps if d in by_name)
+
+    pending = list(checkers)
+    running = {}  # Start time of running checkers.
+    status = {}
+    durations = {}
+    results = Queue.Queue()
     success = True
-    for pc in _phase_checkers:
-        if not pc.check(phase):
-            success = False
+    while pending or running:
+        jobs.check_cancelled()
+        if success:
+            for pc in [pc for pc in pending
+                       if all(status.get(d) == 'ok' for d in deps[pc])]:
+                pending.remove(pc)
+                running[pc] = time.time()
+                pc.start(results)
+        if not running:
             break
+
+        try:
+            pc, ok = results.get(timeout=0.1)
+        except Queue.Empty:
+            pass
+        else:
+            if pc in running:
+                durations[pc] = time.time() - running.pop(pc)
+                status[pc] = 'ok' if ok else 'failed'
+                success = success and ok
+        for pc in running.keys():
+            if pc.timed_out(running[pc]):
+                durations[pc] = time.time() - running.pop(pc)
+                status[pc] = 'timeout'
+                success = False
+                pc.cancel()
+    if pending and success:
+        print "Phase checkers waiting on each other: %s" % ', '.join(
+            sorted(str(pc.name) for pc in pending))
+        success = False
+    close_connections(checkers)
+    # Checkers of a cancelled job fail, which isn't their fault.
+    jobs.check_cancelled()
+
+    if len(checkers) > 1 or not success:
+        print '\n', '-' * 20, "Phase %s checkers" % phase, '-' * 20
+        for i, pc in enumerate(checkers):
+            name = pc.name if pc.name is not None else 'checker_%d' % i
+            if pc in durations:
+                print "%-40s %-8s %8.2fs" % (name, status[pc], durations[pc])
+            else:
+                print "%-40s %-8s" % (name, 'skipped')
     return success
 
 
+_default_phase_check = _phase_check
+
+
 class PhaseChecker(object):
     """Wrapper of check function and phase.
 
     Attributes:
         phase: (int)
+        name: (str) Name used by other commands and checkers to depend on this
+            checker in 'run --dag'.
+        deps: (list of str) Names of commands and phase checkers that must be
+            done before this checker runs. None means the checker keeps the
+            order it was added in. See _phase_check() and command_graph.
+        timeout: (float) Seconds after which the checker is considered failed
+            and cancelled. None means no timeout.
     """
-    def __init__(self, check_function, phase):
+    def __init__(self, check_function, phase, name=None, deps=None,
+                 timeout=None):
         self._fun = check_function
         self.phase = phase
+        self.name = name
+        self.deps = deps
+        self.timeout = timeout
+        self._thread = None
+        self._cancelled = None
 
     def check(self, phase):
         """Check given phase."""
@@ -253,19 +564,216 @@ class PhaseChecker(object):
             return self._fun()
         return True
 
+    def run(self):
+        """Run the check function regardless of phase."""
+        return self._fun()
+
+    def start(self, results):
+        """Run the check function in a new daemon thread.
+
+        Args:
+            results: (Queue.Queue) (checker, success) is put on it when the
+                check function returns. An exception counts as failure.
+        """
+        name = self.name or self._fun.__name__
+        job = jobs.current()
+        self._cancelled = threading.Event()
+        def target():
+            # Print to and be cancelled with the job running the checks, and
+            # on its own by cancel().
+            jobs.set_current(job)
+            jobs.cancel_with(self._cancelled)
+            with run_trace.span('checker ' + name, 'checker',
+                                phase=self.phase) as span:
+                try:
+                    ok = self._fun()
+                except jobs.Cancelled:
+                    ok = False
+                except Exception:
+                    print traceback.format_exc()
+                    ok = False
+                span.args['ok'] = ok
+            results.put((self, ok))
+        self._thread = threading.Thread(target=target, name='checker ' + name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel(self):
+        """Stop the check function started by start() at its next
+        cancellation point, see jobs."""
+        if self._cancelled is not None:
+            self._cancelled.set()
+
+    def join(self, timeout):
+        """Wait up to timeout seconds for the check function to return."""
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def is_running(self):
+        """Whether the check function started by start() still runs, e.g.
+        after timing out."""
+        return self._thread is not None and self._thread.is_alive()
+
+    def timed_out(self, start):
+        """Whether the checker started at start has run out of time."""
+        return self.timeout is not None and time.time() - start > self.timeout
+
 class ProcMgr(object):
     """Represent a process manager instance in configure.
 
     Attributes:
         machine: (provisioning.Machine) The machine on which process manager
             is running.
-        host: (str) Hostname of the server.
-        port: (str) The port that process manager listens on.
+        host: (str) Hostname of the server, only provisioned when read.
+        port: (str) The port that process manager listens on, mapped by
+            the machine, see provisioning.Machine.map_port().
     """
     def __init__(self, machine, port=2900):
         self.machine = machine
-        self.host = machine.host
-        self.port = port
+        self.port = machine.map_port(port)
+
+    @property
+    def host(self):
+        return self.machine.host
+
+class Placement(object):
+    """Places processes on process managers by their estimated load.
+
+    Add every process with its role, then place() bin-packs them on machines,
+    heaviest first, each on the fullest machine it still fits on, which keeps
+    machines free for roles that avoid each other. A process that fits
+    nowhere goes where the busiest resource ends up least loaded. Rules:
+    + Processes of the same spread group, e.g. the members of a replica set,
+      are on distinct machines.
+    + A process doesn't share a machine with the roles it avoids, or with
+      processes avoiding its role, e.g. loaders and mongods, see ROLE_AVOID.
+
+    Example:
+        placement = Placement(pms)
+        for alias in ['rs1_1', 'rs1_2', 'rs1_3']:
+            placement.add(alias, 'mongod', spread='rs1')
+        for i in range(200):
+            placement.add('shell_%d' % i, 'loader')
+        layout = placement.place()
+        rs1_1 = MongoD(layout['rs1_1'], 'rs1_1', 27017)
+
+    Attributes:
+        proc_mgrs: (list of ProcMgr) Where processes may go. Process managers
+            on the same machine share its resources, processes are placed on
+            the first of them.
+        weights: (dict of str to tuple) ROLE_WEIGHTS with the roles given.
+        avoid: (dict of str to list of str) ROLE_AVOID with the roles given.
+        capacity: (float) The load of every resource that a machine takes.
+        layout: (dict of str to ProcMgr) The result of place().
+    """
+    def __init__(self, proc_mgrs, weights=None, avoid=None, capacity=1.0):
+        self.proc_mgrs = proc_mgrs
+        self.weights = dict(ROLE_WEIGHTS)
+        self.weights.update(weights or {})
+        self.avoid = dict(ROLE_AVOID)
+        self.avoid.update(avoid or {})
+        self.capacity = capacity
+        self.layout = None
+        self._processes = []
+        # Filled by place(): the first process manager, load, roles, roles
+        # avoided and spread groups of every machine.
+        self._machines = []
+
+    def add(self, alias, role, spread=None, avoid=None, weight=None):
+        """Add a process to place.
+
+        Args:
+            alias: (str) The alias of the process, the key in the layout.
+            role: (str) A role of weights, e.g. 'mongod' or 'loader'.
+            spread: (str) Processes with the same spread go on distinct
+                machines.
+            avoid: (list of str) Roles to keep away from, instead of those of
+                the role.
+            weight: (tuple of float) The load of the process, instead of that
+                of the role.
+        """
+        if weight is None:
+            if role not in self.weights:
+                raise ValueError('Unknown role %s, give its weight' % role)
+            weight = self.weights[role]
+        if avoid is None:
+            avoid = self.avoid.get(role, [])
+        self._processes.append({'alias': alias, 'role': role,
+                                'spread': spread, 'avoid': set(avoid),
+                                'weight': weight})
+
+    def place(self):
+        """Place the processes added and print the layout.
+
+        Return: (dict of str to ProcMgr) The process manager of every alias.
+
+        Raises:
+            ValueError: A process can't go on any machine without breaking
+                its rules. Machines are overloaded rather than that, with a
+                warning.
+        """
+        self._machines = []
+        for pm in self.proc_mgrs:
+            if all(m['pm'].machine is not pm.machine for m in self._machines):
+                self._machines.append({'pm': pm,
+                                       'load': [0.0] * len(RESOURCES),
+                                       'roles': [], 'avoided': set(),
+                                       'spread': set()})
+        self.layout = {}
+        # Heaviest first; sorted() keeps the order of equal processes.
+        for p in sorted(self._processes, key=lambda p: -max(p['weight'])):
+            candidates = [m for m in self._machines if self._allowed(p, m)]
+            if not candidates:
+                raise ValueError('No machine for %s (%s) without breaking '
+                                 'its spread or avoid rules' %
+                                 (p['alias'], p['role']))
+            fitting = [m for m in candidates
+                       if self._peak(m, p['weight']) <= 1]
+            if fitting:
+                best = max(fitting, key=lambda m: self._peak(m, p['weight']))
+            else:
+                best = min(candidates,
+                           key=lambda m: self._peak(m, p['weight']))
+            best['load'] = [l + w for l, w in zip(best['load'], p['weight'])]
+            best['roles'].append(p['role'])
+            best['avoided'] |= p['avoid']
+            if p['spread'] is not None:
+                best['spread'].add(p['spread'])
+            self.layout[p['alias']] = best['pm']
+        self.print_layout()
+        overloaded = [m for m in self._machines
+                      if max(m['load']) > self.capacity]
+        if overloaded:
+            print ("Warning: %d machines are overloaded, add machines or "
+                   "give lower weights." % len(overloaded))
+        return self.layout
+
+    @staticmethod
+    def _allowed(process, machine):
+        return (process['role'] not in machine['avoided'] and
+                not process['avoid'].intersection(machine['roles']) and
+                process['spread'] not in machine['spread'])
+
+    def _peak(self, machine, weight):
+        """Load of the busiest resource of machine if weight is added."""
+        return max((l + w) / self.capacity
+                   for l, w in zip(machine['load'], weight))
+
+    def print_layout(self):
+        """Print the estimated load and processes of every machine."""
+        print '\n', '=' * 20, 'Placement', '=' * 20
+        print '%-20s %6s %s  processes' % (
+            'host', 'port', ' '.join('%5s' % r for r in RESOURCES))
+        for m in self._machines:
+            counts = {}
+            for role in m['roles']:
+                counts[role] = counts.get(role, 0) + 1
+            print '%-20s %6d %s  %s' % (
+                m['pm'].host, m['pm'].port,
+                ' '.join('%4.0f%%' % (l / self.capacity * 100)
+                         for l in m['load']),
+                ', '.join('%s x%d' % rc for rc in sorted(counts.items()))
+                or '-')
 
 class RemoteRunnable(object):
     """Base class for class that can generate commands running on process
@@ -273,13 +781,15 @@ class RemoteRunnable(object):
 
     Attributes:
         proc_mgr: (ProcMgr) The process manager that commands runs on.
-        alias: (str) The alias of process, which is also used in dbpath
-            and log file name.
+        name: (str) The alias given in the config.
+        alias: (str) The alias of process in its namespace, which is also used
+            in dbpath and log file name.
         program: (str) The name of program used in command.
     """
     def __init__(self, proc_mgr, alias, program, version=None, arch=None):
         self.proc_mgr = proc_mgr
-        self.alias = alias
+        self.name = alias
+        self.alias = _scoped(alias)
         self.program = program
         self.version = version
         self.arch = arch
@@ -291,20 +801,26 @@ class RemoteRunnable(object):
             
             remote_binaries = {}
             if host in _remote_binaries:
-                _remote_binaries = _remote_binaries[host]
+                remote_binaries = _remote_binaries[host]
             
-            if (self.program, self.version, self.arch) in _remote_binaries:
-                rel_path = _remote_binaries[(self.program, self.version, self.arch)]
+            if (self.program, self.version, self.arch) in remote_binaries:
+                rel_path = remote_binaries[(self.program, self.version, self.arch)]
                 return "./remote_resources/%s" % rel_path
         
         
         return self.program
 
-    def gen_command_for_pm(self, cmd, phase, alias=None, wait=False):
+    def gen_command_for_pm(self, cmd, phase, alias=None, wait=False, deps=None,
+                           forward=None):
         """Add command to given process manager."""
         if alias is None:
             alias = self.alias
-        AddCommandToProcMgr(self.proc_mgr, cmd, alias, phase, wait=wait)
+        AddCommandToProcMgr(self.proc_mgr, cmd, alias, phase, wait=wait,
+                            deps=deps, forward=forward)
+
+    def ready_name(self):
+        """Name of the phase checker waiting for this process to be ready."""
+        return _scoped('ready_' + self.name)
 
 
 class MongoD(RemoteRunnable):
@@ -312,7 +828,9 @@ class MongoD(RemoteRunnable):
 
     Attributes:
         host: (str) Hostname of mongod server, copied from ProcMgr.
-        port: (int) The port of mongod.
+        port: (int) The port of mongod. None in the config means any free
+            port, see _claim_port(). Machines of provisioning.Local map it
+            to a port that is free on this machine.
         replset: (str) The replset of mongod. If it is None, the mongod is not
             in a replica set.
         is_arbiter: (boolean) Whether mongod is an arbiter.
@@ -323,7 +841,8 @@ class MongoD(RemoteRunnable):
                  is_arbiter=False, is_configsvr=False, version=None):
         super(MongoD, self).__init__(proc_mgr, alias, 'mongod', version, 'x86_64')
         self.host = proc_mgr.host
-        self.port = port
+        self.port = proc_mgr.machine.map_port(
+            _claim_port(self.host, port, self.alias))
         self.replset = replset
         self.is_arbiter = is_arbiter
         self.is_configsvr = is_configsvr
@@ -332,7 +851,8 @@ class MongoD(RemoteRunnable):
     def gen_command(self, start_phase):
         """Generate command based on its attributes."""
         self.gen_command_for_pm('mkdir -p data/%s' % self.alias, start_phase,
-                               alias='mk_' + self.alias, wait=True)
+                               alias=_scoped('mk_' + self.name), wait=True,
+                               deps=[])
         cmd_list = [self.resolve_program(), '--oplogSize 50', '-v'] # verbose
         cmd_list.append('--dbpath data/%s' % self.alias)
         cmd_list.append('--port %d' % self.port)
@@ -344,19 +864,22 @@ class MongoD(RemoteRunnable):
             cmd_list.append('--configsvr')
         
         global _stats_server
+        forward = None
         if _stats_server != None:
-            _stats_server.add_server_client(self.proc_mgr)
-            cmd_list = _stats_server.cmd_with_syslog(self.proc_mgr, '%s.mongod.%s' % (self.alias, self.port), cmd_list)
+            forward = _stats_server.forward_to('%s.mongod.%s' % (self.alias, self.port))
         else:
             cmd_list.append('--logpath %s.log' % self.alias)
                         
         cmd = ' '.join(cmd_list)
         # Generate commands.
-        self.gen_command_for_pm(cmd, start_phase + 1)
+        self.gen_command_for_pm(cmd, start_phase + 1,
+                                deps=[_scoped('mk_' + self.name)],
+                                forward=forward)
         self.last_phase = start_phase + 1
         AddPhaseChecker(
-            lambda : wait_for_connection(self.proc_mgr.host, self.port),
-            self.last_phase)
+            lambda : _all_ready([(self.proc_mgr.host, self.port)]),
+            self.last_phase, name=self.ready_name(), deps=[self.alias],
+            timeout=READY_TIMEOUT)
 
     def host_str(self):
         """Get hostname:port."""
@@ -369,11 +892,15 @@ class Replset(object):
         name: (str) The name of replica set.
         members: (array of Mongod) Members of the replica set.
         last_phase: (int) The last phase of the replset's commands.
+        timings: (dict of str to float) When the bring-up of the last run
+            reached 'start', 'initiated', 'elected' and 'added', the last
+            set by Cluster.add_shards_to_cluster().
     """
     def __init__(self, name):
         self.name = name
         self.members = []
         self.last_phase = None
+        self.timings = {}
 
     def add_member(self, member):
         """Add member to replica set.
@@ -386,6 +913,7 @@ class Replset(object):
 
     def initialize(self):
         """Initialize a replica set."""
+        import pymongo
         if not self.members:
             print "We need at least 1 member to start replica set."
             return
@@ -402,28 +930,99 @@ class Replset(object):
 
         rs_host = self.members[0].proc_mgr.host  # Use the external hostname.
         rs_port = self.members[0].port
-        while True:
-            # Connect to primary.
-            conn = wait_for_connection(rs_host, rs_port)
-
-            # Replset initiate.
-            print 'Initializing replica set %s...' % self.name,
-            try:
-                conn.admin.command('replSetInitiate', rs_config)
-                print 'done'
-                break
-            except pymongo.errors.OperationFailure:
-                print 'failed. retry...'
-            conn.close()
-            time.sleep(1)
+        self.timings = {'start': time.time()}
+        if not _all_ready([(m.proc_mgr.host, m.port) for m in self.members]):
+            print "Members of replica set %s are not up." % self.name
+            return False
+        with run_trace.span('replSetInitiate ' + self.name, 'wait') as span:
+            attempt = 1
+            while True:
+                # Connect to primary.
+                conn = wait_for_connection(rs_host, rs_port)
+
+                # Replset initiate.
+                print 'Initializing replica set %s...' % self.name,
+                try:
+                    conn.admin.command('replSetInitiate', rs_config)
+                    print 'done'
+                    break
+                except pymongo.errors.OperationFailure as e:
+                    if 'already initialized' in str(e):
+                        # E.g. by an earlier run, the members elect anyway.
+                        print 'already initialized'
+                        break
+                    print 'failed. retry...'
+                    run_trace.instant('replSetInitiate retry', 'retry',
+                                      replset=self.name, attempt=attempt)
+                jobs.sleep(1)
+                attempt += 1
+            span.args['attempts'] = attempt
+        self.timings['initiated'] = time.time()
+
+        with run_trace.span('election ' + self.name, 'wait'):
+            primary = self.wait_for_election()
+        if primary is None:
+            print "Replica set %s elected no primary." % self.name
+            return False
+        self.timings['elected'] = time.time()
+        print "Replica set %s elected %s in %.2fs" % (
+            self.name, primary,
+            self.timings['elected'] - self.timings['initiated'])
         return True
 
+    def wait_for_election(self, timeout=READY_TIMEOUT):
+        """Wait until the members elected a primary.
+
+        Every poll asks all members with isMaster, so whichever learns of the
+        primary first tells. Polls start every ELECTION_POLL_START seconds,
+        catching a quick election at once, and slow down up to
+        ELECTION_POLL_MAX while the election takes longer.
+
+        Returns:
+            (str) 'host:port' of the primary, None if there was none within
+            timeout seconds.
+        """
+        import pymongo
+        start = time.time()
+        interval = ELECTION_POLL_START
+        while time.time() - start < timeout:
+            for m in self.members:
+                try:
+                    conn = connection_pool.get(m.proc_mgr.host, m.port)
+                    resp = conn.admin.command('isMaster')
+                except pymongo.errors.PyMongoError:
+                    connection_pool.discard(m.proc_mgr.host, m.port)
+                    continue
+                if resp.get('primary'):
+                    return resp['primary']
+            jobs.sleep(interval)
+            interval = min(interval * 1.5, ELECTION_POLL_MAX)
+        return None
+
+    def print_timings(self):
+        """Print how long the steps of the last bring-up took."""
+        t = self.timings
+        steps = [('initiate', 'start', 'initiated'),
+                 ('election', 'initiated', 'elected'),
+                 ('addShard', 'elected', 'added')]
+        print "%-20s %s" % (self.name, '  '.join(
+            '%s %6.2fs' % (step, t[end] - t[begin])
+            if begin in t and end in t else '%s      -' % step
+            for step, begin, end in steps))
+
     def gen_command(self, start_phase):
         """Generate commands."""
         for m in self.members:
             m.gen_command(start_phase)
         self.last_phase = max([m.last_phase for m in self.members])
-        AddPhaseChecker(self.initialize, self.last_phase)
+        AddPhaseChecker(self.initialize, self.last_phase,
+                        name=self.ready_name(),
+                        deps=[m.ready_name() for m in self.members],
+                        timeout=READY_TIMEOUT)
+
+    def ready_name(self):
+        """Name of the phase checker initializing the replica set."""
+        return 'init_' + self.name
 
     def host_str(self):
         """Get aggregated hostname like rs1/localhost:22000,localhost:22001"""
@@ -436,14 +1035,17 @@ class MongoS(RemoteRunnable):
 
     Attributes:
         host: (str) Hostname of mongos server, copied from ProcMgr.
-        port: (int) The port of mongos.
+        port: (int) The port of mongos. None in the config means any free
+            port, see _claim_port(). Machines of provisioning.Local map it
+            to a port that is free on this machine.
         last_phase: (int) The last phase of the mongos's commands.
         config_servers: (array of Mongod) Config servers.
     """
     def __init__(self, proc_mgr, alias, port, config_servers, version=None):
         super(MongoS, self).__init__(proc_mgr, alias, 'mongos', version, 'x86_64')
         self.host = proc_mgr.host
-        self.port = port
+        self.port = proc_mgr.machine.map_port(
+            _claim_port(self.host, port, self.alias))
         self.config_servers = config_servers
         self.last_phase = None
 
@@ -456,20 +1058,24 @@ class MongoS(RemoteRunnable):
         cmd_list.append('-vv') # verbose
         
         global _stats_server
+        forward = None
         if _stats_server != None:
-            _stats_server.add_server_client(self.proc_mgr)
-            cmd_list = _stats_server.cmd_with_syslog(self.proc_mgr, '%s.mongos.%s' % (self.alias, self.port), cmd_list)
+            forward = _stats_server.forward_to('%s.mongos.%s' % (self.alias, self.port))
         else:
             cmd_list.append('--logpath %s.log' % self.alias)
         
         cmd = ' '.join(cmd_list)
 
-        self.gen_command_for_pm(cmd, start_phase)
+        self.gen_command_for_pm(
+            cmd, start_phase,
+            deps=[c.ready_name() for c in self.config_servers],
+            forward=forward)
         self.last_phase = start_phase
         # Wait until I start.
         AddPhaseChecker(
-            lambda : wait_for_connection(self.proc_mgr.host, self.port),
-            self.last_phase)
+            lambda : _all_ready([(self.proc_mgr.host, self.port)]),
+            self.last_phase, name=self.ready_name(), deps=[self.alias],
+            timeout=READY_TIMEOUT)
 
     def enable_sharding(self, collection, key):
         """Enable sharding collection.
@@ -479,9 +1085,9 @@ class MongoS(RemoteRunnable):
             key: (dict of (key_field, direction)) Sharding key.
                 For example: {"_id": 1}
         """
+        import pymongo
         db = collection[:collection.find(':')]
-        c = pymongo.Connection(self.proc_mgr.host, self.port)
-        admin = c.admin
+        admin = connection_pool.get(self.proc_mgr.host, self.port).admin
         # Enable sharding.
         try:
             print "enable sharding result: %r" % admin.command(
@@ -504,12 +1110,19 @@ class Cluster(object):
     """Cluster of several shards.
 
     Attributes:
+        name: (str) The name of the cluster, unique among clusters. By
+            default 'cluster', 'cluster_2', ... in the order of creation.
         shards: (array of Replset or Mongod) Shards in the cluster.
         mongoses: (array of Mongos) Mongos in the cluster.
         config_servers: (array of Mongod) config servers in the cluster.
         last_phase: (int) The last phase of the cluster's commands.
     """
-    def __init__(self):
+    def __init__(self, name=None):
+        global _clusters
+        _clusters += 1
+        if name is None:
+            name = 'cluster' if _clusters == 1 else 'cluster_%d' % _clusters
+        self.name = name
         self.shards = []
         self.config_servers = []
         self.mongoses = []
@@ -552,30 +1165,139 @@ class Cluster(object):
                 m.gen_command(configsvr_phase + 1)
             mongos_phase = max([m.last_phase for m in self.mongoses])
             self.last_phase = mongos_phase
-            AddPhaseChecker(self.add_shards_to_cluster, mongos_phase)
+            # Shards are added as they get ready, so only wait for their
+            # processes, not for replica sets to be initialized.
+            deps = [m.ready_name() for m in self.mongoses]
+            for s in self.shards:
+                if isinstance(s, Replset):
+                    deps.extend(m.ready_name() for m in s.members)
+                else:
+                    deps.append(s.ready_name())
+            AddPhaseChecker(self.add_shards_to_cluster, mongos_phase,
+                            name='add_shards_' + self.name, deps=deps,
+                            timeout=READY_TIMEOUT)
 
     def add_shards_to_cluster(self):
-        """Add mongod or replsets to cluster."""
+        """Add mongod or replsets to cluster.
+
+        Every shard is added in its own thread as soon as it is ready, i.e. a
+        replica set has elected a primary, so shards are added while others
+        are still electing. A failing addShard is retried up to
+        ADD_SHARD_ATTEMPTS times. In the end one listShards checks that all
+        shards are in the cluster.
+
+        Returns:
+            Whether all shards were added.
+        """
+        import pymongo
         print "Connecting to mongos..."
         mongos = self.mongoses[0]
-        conn = wait_for_connection(mongos.proc_mgr.host, mongos.port)
+        wait_for_connection(mongos.proc_mgr.host, mongos.port)
 
         print "Adding shards..."
-        # Waiting for shards.
-        for shard in self.shards:
-            if isinstance(shard, Replset):
-                m = shard.members[0]
-                wait_for_primary(m.proc_mgr.host, m.port)
-            else:
-                wait_for_connection(shard.proc_mgr.host, shard.port).close()
+        start = time.time()
+        added = {}  # Map from shard to seconds until added, None if failed.
+        ctx = jobs.context()
+
+        def add(shard):
+            # Print to and be cancelled with the job adding the shards.
+            jobs.adopt(ctx)
+            ok = False
+            try:
+                ok = self._add_shard(shard, mongos)
+            except jobs.Cancelled:
+                pass
+            except Exception:
+                print traceback.format_exc()
+            added[shard] = time.time() - start if ok else None
+        threads = [threading.Thread(target=add, args=(s,),
+                                    name='addShard ' + s.host_str())
+                   for s in self.shards]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            while t.is_alive():
+                jobs.check_cancelled()
+                t.join(0.1)
+
+        failed = [s.host_str() for s in self.shards if added.get(s) is None]
+        if failed:
+            print "Failed to add shards: %s" % ', '.join(failed)
+            return False
+
+        # Verify, replica sets are listed by name.
+        try:
+            conn = connection_pool.get(mongos.proc_mgr.host, mongos.port)
+            listed = set(s['host'].split('/')[0] for s in
+                         conn.admin.command('listShards')['shards'])
+        except pymongo.errors.PyMongoError as e:
+            print "listShards failed: %s" % e
+            return False
+        missing = [s.host_str() for s in self.shards
+                   if (s.name if isinstance(s, Replset) else s.host_str())
+                   not in listed]
+        if missing:
+            print "Shards missing in listShards: %s" % ', '.join(missing)
+            return False
+        slowest = max(self.shards, key=added.get)
+        print "Added %d shards in %.2fs, the slowest %s after %.2fs" % (
+            len(self.shards), time.time() - start, slowest.host_str(),
+            added[slowest])
+
+        replsets = [s for s in self.shards if isinstance(s, Replset)]
+        if replsets:
+            print "Replica set bring-up:"
+            for rs in replsets:
+                rs.print_timings()
+        return True
+
+    def _add_shard(self, shard, mongos):
+        """Wait until shard is ready, then add it through mongos, retrying on
+        failure.
+
+        Returns:
+            Whether the shard was added.
+        """
+        import pymongo
+        if isinstance(shard, Replset):
+            # Any member knows when the set has a primary, and the first
+            # member may be down or slow to start.
+            ready = _any_ready([(m.proc_mgr.host, m.port)
+                                for m in shard.members], _has_primary)
+        else:
+            ready = _all_ready([(shard.proc_mgr.host, shard.port)])
+        if not ready:
+            print "Shard %s is not ready." % shard.host_str()
+            return False
 
-        for s in self.shards:
+        delay = ADD_SHARD_RETRY_DELAY
+        for attempt in range(1, ADD_SHARD_ATTEMPTS + 1):
             try:
-                conn.admin.command('addShard', s.host_str())
-                print 'shard have been added', s.host_str()
+                conn = connection_pool.get(mongos.proc_mgr.host, mongos.port)
+                with run_trace.span('addShard ' + shard.host_str(), 'wait',
+                                    attempt=attempt):
+                    conn.admin.command('addShard', shard.host_str())
+                print 'shard have been added', shard.host_str()
+                break
             except pymongo.errors.OperationFailure as e:
-                print e
+                if 'already' in str(e):
+                    # Added by an earlier run.
+                    print 'shard was already added', shard.host_str()
+                    break
+                error = e
+            except pymongo.errors.PyMongoError as e:
+                connection_pool.discard(mongos.proc_mgr.host, mongos.port)
+                error = e
+            print "addShard %s failed: %s" % (shard.host_str(), error)
+            if attempt == ADD_SHARD_ATTEMPTS:
                 return False
+            run_trace.instant('addShard retry', 'retry',
+                              shard=shard.host_str(), attempt=attempt)
+            jobs.sleep(delay)
+            delay *= 2
+        if isinstance(shard, Replset):
+            shard.timings['added'] = time.time()
         return True
 
 class MongoShell(RemoteRunnable):
@@ -612,13 +1334,69 @@ class MongoShell(RemoteRunnable):
         eval_cmd = 'inlineOptions = %s;' % json.dumps(opt)
         cmd_list.append('--eval %s' % console.escape(eval_cmd))
                         
+        forward = None
         if _stats_server != None:
-            _stats_server.add_server_client(self.proc_mgr)
-            cmd_list = _stats_server.cmd_with_syslog(self.proc_mgr, '%s.mongo' % self.alias, cmd_list)
+            forward = _stats_server.forward_to('%s.mongo' % self.alias)
         
         cmd = ' '.join(cmd_list)
         self.last_phase = start_phase
-        AddCommandToProcMgr(self.proc_mgr, cmd, self.alias, start_phase)
+        AddCommandToProcMgr(self.proc_mgr, cmd, self.alias, start_phase,
+                            forward=forward)
+
+class LoadGenerator(RemoteRunnable):
+    """Generate the load of PerfTest in driver.js from Python, with many
+    clients in each process, see base_remote_resources/load_generator.py.
+
+    Replaces a MongoShell per client running driver.js.
+
+    Attributes:
+        mongos: (Mongos) The mongos under test.
+        clients: (int) Logical clients, each doing one operation at a time.
+        processes: (int) Processes the clients are spread over, None for one
+            per core of the host.
+        collection: (str) The collection loaded, e.g. "foo.bar".
+        ops: (dict of str to float) Percentages of 'query', 'insert',
+            'update' and 'delete'. None for those of PerfTest.
+        wait_for: (float) Seconds before the first client starts.
+        ramp_up: (float) Seconds between the starts of clients.
+        last_phase: (int) The phase of the load generator's command.
+    """
+    def __init__(self, proc_mgr, alias, mongos, clients=100, processes=None,
+                 collection='foo.bar', ops=None, wait_for=0, ramp_up=0):
+        super(LoadGenerator, self).__init__(proc_mgr, alias, 'python')
+        self.mongos = mongos
+        self.clients = clients
+        self.processes = processes
+        self.collection = collection
+        self.ops = ops
+        self.wait_for = wait_for
+        self.ramp_up = ramp_up
+        self.last_phase = None
+        AddSetupScript(proc_mgr, PYMONGO_SETUP_SCRIPT)
+
+    def gen_command(self, start_phase):
+        """Generate command based on its attributes."""
+        cmd_list = ['python base_remote_resources/load_generator.py',
+                    self.mongos.host_str(),
+                    '--collection %s' % self.collection,
+                    '--clients %d' % self.clients,
+                    '--wait-for %g' % self.wait_for,
+                    '--ramp-up %g' % self.ramp_up]
+        if self.processes is not None:
+            cmd_list.append('--processes %d' % self.processes)
+        if self.ops is not None:
+            cmd_list.append('--ops %s' % ','.join(
+                '%s=%g' % item for item in sorted(self.ops.items())))
+
+        global _stats_server
+        forward = None
+        if _stats_server != None:
+            forward = _stats_server.forward_to('%s.load' % self.alias)
+
+        self.last_phase = start_phase
+        self.gen_command_for_pm(' '.join(cmd_list), start_phase,
+                                forward=forward)
+
 
 class LoadTester(RemoteRunnable):
     """Use mongo with javascript file to generate load.
@@ -843,41 +1621,19 @@ class MongoStat(RemoteRunnable):
 
 
 class StatsServer(MongoD):
-    """rsyslog and mongodb stats server"""
-    
-    def __init__(self, proc_mgr, alias, port, version=None, stats_script=None):
-        
-        rsyslog_setup = \
-"""
-    
-echo "Setting up rsyslogd for remote log collection..."
-    
-read -d '' LOG_SERVER_MODS <<"EOF"
-# provides support for local system logging
-$ModLoad imuxsock 
-
-# provides kernel logging support (previously done by rklogd)
-$ModLoad imklog
-
-# provides UDP syslog reception. For TCP, load imtcp.
-$ModLoad imudp
-
-# For TCP, InputServerRun 514
-$UDPServerRun 514
+    """Log collector and mongodb stats server.
 
-# This one is the template to generate the log filename dynamically, depending on the client's IP address.
-$template FILENAME,"/var/log/%fromhost%/syslog.log"
+    Process managers forward the output of mongod, mongos and mongo shells to
+    the log collector of the stats server, see log_collector.py.
 
-# Log all messages to the dynamically formed file. Now each clients log (192.168.1.2, 192.168.1.3,etc...), will be under a separate directory which is formed by the template FILENAME.
-*.* ?FILENAME
-EOF
+    Attributes:
+        collector_port: (int) The port of the log collector.
+    """
     
-sudo echo "$LOG_SERVER_MODS" | sudo tee -a /etc/rsyslog.conf > /dev/null    
-
-sudo service rsyslog restart
-
-"""
-        AddSetupScript(proc_mgr, rsyslog_setup)
+    # Port of the log collector asked for.
+    COLLECTOR_PORT = 5140
+    
+    def __init__(self, proc_mgr, alias, port, version=None, stats_script=None):
         
         pystats_setup = \
 """
@@ -931,98 +1687,191 @@ sudo pip install pymongo
         LocalResourceSync('./test_lib/stats', './base_remote_resources', pm=proc_mgr, to_abs_path=False)
         
         self.stats_script = os.path.abspath(stats_script)
-        self.clients = {}
+        self.collector_port = proc_mgr.machine.map_port(
+            _claim_port(self.host, StatsServer.COLLECTOR_PORT,
+                        self.alias + '_collector'))
     
-    def add_server_client(self, client_pm):
-        
-        if client_pm.host in self.clients: return
-        if client_pm.host == self.proc_mgr.host: return
-        
-        client_setup = \
-"""
-
-echo "Setting up client for remote rsyslogd log collection..."
-
-read -d '' LOG_CLIENT_MODS <<"EOF"
-$ModLoad imuxsock
-
-$ModLoad imklog
-
-# Provides UDP forwarding. The IP is the server's IP address
-*.* @%s:514 
-
-# Provides TCP forwarding. But the current server runs on UDP
-# *.* @@%s:514
-EOF
-
-sudo echo "$LOG_CLIENT_MODS" | sudo tee -a /etc/rsyslog.conf > /dev/null
-
-sudo service rsyslog restart
-
-""" % (self.proc_mgr.host, self.proc_mgr.host)
+    def gen_command(self, start_phase):
+        """Generate the commands of mongod and the log collector."""
+        AddCommandToProcMgr(
+            self.proc_mgr, 'python base_remote_resources/log_collector.py '
+            '%d collected' % self.collector_port, self.alias + '_collector',
+            start_phase)
+        super(StatsServer, self).gen_command(start_phase)
+    
+    def forward_to(self, tag):
+        """The 'forward' of a RemoteCommand whose output is forwarded to the
+        log collector, tagged with tag."""
+        return '%s@%s:%d' % (tag, self.host, self.collector_port)
 
-        AddSetupScript(client_pm, client_setup)
-        self.clients[client_pm.host] = True
-        
-        
-    def cmd_with_syslog(self, client_pm, tag, cmd_list):
-        
-        syslog_script = \
-"""
+########################### Global Functions ###########################
 
-# Running command via syslog
+def wait_for_all(endpoints, predicate=None, timeout=None, any_ready=False):
+    """Wait until all endpoints are ready, checking them concurrently.
 
-"$@" | logger -t "%s" 2>&1
+    An endpoint is ready once it accepts TCP connections and predicate, if
+    given, is true for it. Connects don't block, so all endpoints are tried at
+    once, and every endpoint is retried with jittered exponential backoff,
+    from BACKOFF_START up to BACKOFF_MAX seconds, so that a slow endpoint
+    doesn't hold up the others and retries don't come in lockstep. The
+    predicate runs in a thread per endpoint, so that slow predicates of many
+    endpoints take as long as the slowest one. Returns as soon as the last
+    endpoint, or with any_ready the first, is ready or the timeout hits, even
+    if predicates still run, and prints how long each one took.
 
-""" % tag
+    Args:
+        endpoints: (list of (str, int)) Hosts and ports.
+        predicate: (str, int) -> boolean. Called once the endpoint accepts
+            connections, e.g. whether the replica set has a primary. An
+            exception counts as not ready.
+        timeout: (float) Seconds to wait at most, None for no limit.
+        any_ready: (boolean) Stop once any endpoint is ready, e.g. one
+            member of a replica set that knows the primary.
 
-        syslog_script_name = AddRemoteScript(client_pm, syslog_script, 'bash')
-        
-        new_cmd_list = [ 'bash', './base_remote_resources/scripts/%s' % syslog_script_name ]
-        new_cmd_list.extend(cmd_list)
-        
-        return new_cmd_list   
+    Returns:
+        (dict of (str, int) to float) The seconds until each endpoint was
+        ready. Endpoints that were not ready when the timeout hit are missing.
+    """
+    start = time.time()
+    ready = {}
+    # Map from endpoint to when to try it next.
+    pending = dict((e, start) for e in endpoints)
+    delays = dict((e, BACKOFF_START) for e in pending)
+    # Map from fd to (socket, endpoint, when connecting started).
+    connecting = {}
+    # Endpoints whose predicate runs, and (endpoint, result) of predicates.
+    checking = set()
+    results = Queue.Queue()
+    poller = process_manager.Poller()
+    ctx = jobs.context()
+
+    def retry(e):
+        pending[e] = time.time() + random.uniform(0.5, 1) * delays[e]
+        delays[e] = min(delays[e] * 2, BACKOFF_MAX)
+
+    def set_ready(e):
+        ready[e] = time.time() - start
+        run_trace.complete('ready %s:%d' % e, 'wait', start, time.time())
+
+    def check(e):
+        """Put whether predicate is true for e on results."""
+        # Print to and be cancelled with the job waiting.
+        jobs.adopt(ctx)
+        try:
+            ok = predicate(*e)
+        except Exception:
+            ok = False
+        results.put((e, ok))
 
-########################### Global Functions ###########################
+    with run_trace.span('wait_for_all', 'wait', endpoints=len(pending)):
+        try:
+            while ((pending or connecting or checking) and
+                   not (any_ready and ready)):
+                jobs.check_cancelled()
+                now = time.time()
+                if timeout is not None and now - start > timeout:
+                    break
+                for e, when in pending.items():
+                    if when > now:
+                        continue
+                    del pending[e]
+                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    s.setblocking(0)
+                    try:
+                        err = s.connect_ex(e)
+                    except socket.error:
+                        # E.g. the host name doesn't resolve yet.
+                        err = errno.EHOSTUNREACH
+                    if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        connecting[s.fileno()] = (s, e, now)
+                        poller.register(s, process_manager.Poller.WRITE)
+                    else:
+                        s.close()
+                        retry(e)
+
+                # Wake up for the next endpoint due, or to be cancelled.
+                wait = min(pending.values() + [now + 0.1]) - now
+                for s, _ in poller.poll(max(0, wait)):
+                    _, e, _ = connecting.pop(s.fileno())
+                    poller.unregister(s.fileno())
+                    if s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                        retry(e)
+                    elif predicate is None:
+                        set_ready(e)
+                    else:
+                        checking.add(e)
+                        t = threading.Thread(target=check, args=(e,),
+                                             name='check %s:%d' % e)
+                        t.daemon = True
+                        t.start()
+                    s.close()
+                while True:
+                    try:
+                        e, ok = results.get_nowait()
+                    except Queue.Empty:
+                        break
+                    checking.remove(e)
+                    if ok:
+                        set_ready(e)
+                    else:
+                        retry(e)
+                for fd, (s, e, started) in connecting.items():
+                    if time.time() - started > CONNECT_TIMEOUT:
+                        del connecting[fd]
+                        poller.unregister(fd)
+                        s.close()
+                        retry(e)
+        finally:
+            for s, _, _ in connecting.values():
+                s.close()
+
+    for e in sorted(ready, key=ready.get):
+        print "%s:%d ready after %.2fs" % (e + (ready[e],))
+    if not (any_ready and ready):
+        for e in sorted(set(delays) - set(ready)):
+            print "%s:%d not ready after %.2fs" % (e + (time.time() - start,))
+    return ready
+
+def _all_ready(endpoints, predicate=None):
+    """Whether all endpoints got ready within READY_TIMEOUT, see
+    wait_for_all()."""
+    return (len(wait_for_all(endpoints, predicate, READY_TIMEOUT)) ==
+            len(set(endpoints)))
+
+def _any_ready(endpoints, predicate=None):
+    """Whether any endpoint got ready within READY_TIMEOUT, see
+    wait_for_all()."""
+    return bool(wait_for_all(endpoints, predicate, READY_TIMEOUT,
+                             any_ready=True))
+
+def _has_primary(server, port):
+    """Whether the replica set of the mongod at server:port has a primary."""
+    import pymongo
+    try:
+        return 'primary' in connection_pool.get(server, port).admin.command(
+            'isMaster')
+    except pymongo.errors.PyMongoError:
+        connection_pool.discard(server, port)
+        raise
 
 def wait_for_connection(server, port):
     """wait until server starts.
 
     Returns:
-        The connection to server.
+        The connection to server from connection_pool, not to be closed.
     """
-    try:
-        # Don't print message at the first time.
-        return pymongo.Connection(server, port)
-    except pymongo.errors.AutoReconnect:
-        print "Waiting for", server, port, 'to connect...',
-        while True:
-            try:
-                conn = pymongo.Connection(server, port)
-            except pymongo.errors.AutoReconnect as err:
-                print "\nError: " + str(err)
-                time.sleep(1)
-            else:
-                print 'done'
-                return conn
+    wait_for_all([(server, port)])
+    return connection_pool.get(server, port)
 
 def wait_for_primary(server, port):
     """Wait until primary has been elected."""
-    wait_for_connection(server, port)
-    print "Waiting for replset", server, port, 'to start...',
-    conn = pymongo.Connection(server, port)
-    while True:
-        resp = conn.admin.command('isMaster')
-        if 'primary' in resp:
-            print 'done'
-            return
-        time.sleep(1)
+    wait_for_all([(server, port)], _has_primary)
 
 def waiting_for(sec):
     """Wait for a given seconds."""
     print "Now:", str(datetime.datetime.now())
     print "Waiting for", sec, "seconds..."
-    time.sleep(sec)
+    jobs.sleep(sec)
     print "Now:", str(datetime.datetime.now())
     return True
 
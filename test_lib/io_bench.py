@@ -0,0 +1,116 @@
+#!/usr/bin/python
+"""Benchmark of the console's connection handling with many process managers
+on localhost.
+
+Usage:
+    PYTHONPATH=base_remote_resources python io_bench.py [-n 500] [-c 2]
+
+Starts n process managers in a child process, connects a console to all of
+them, runs c commands on each, stops them and shuts the process managers down,
+printing the wall time of every step.
+"""
+
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import console
+import process_manager
+
+BASE_PORT = 31000
+
+
+def raise_fd_limit():
+    """Allow as many open files as the hard limit permits."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def serve(number, work_dir):
+    """Run number process managers in threads of this process."""
+    raise_fd_limit()
+    os.chdir(work_dir)
+    ready = os.fdopen(os.dup(1), 'w')
+    sys.stdout = open(os.devnull, 'w')
+    threads = []
+    for i in range(number):
+        manager = process_manager.ProcessManager(BASE_PORT + i)
+        # Bind before reporting ready, so the console can connect at once.
+        server_socket = manager._build_server_socket()
+        manager._build_server_socket = lambda s=server_socket: s
+        t = threading.Thread(target=manager.start)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    ready.write('ready\n')
+    ready.flush()
+    for t in threads:
+        t.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Console I/O benchmark.')
+    parser.add_argument('-n', dest='agents', type=int, default=500,
+                        help='number of process managers (default=500)')
+    parser.add_argument('-c', dest='commands', type=int, default=2,
+                        help='commands per process manager (default=2)')
+    parser.add_argument('--serve', dest='work_dir', default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.work_dir is not None:
+        serve(args.agents, args.work_dir)
+        return
+
+    raise_fd_limit()
+    work_dir = tempfile.mkdtemp()
+    server = subprocess.Popen([sys.executable, __file__, '-n', str(args.agents),
+                               '--serve', work_dir], stdout=subprocess.PIPE)
+    server.stdout.readline()  # Wait for 'ready'.
+
+    c = console.Console()
+    for i in range(args.agents):
+        for j in range(args.commands):
+            c._remote_commands.append(console.RemoteCommand(
+                '127.0.0.1', BASE_PORT + i, 'bench', 'sleep 600',
+                alias='sleep_%d' % j))
+
+    # Proxies and commands print a line each, keep only the timings.
+    out = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    steps = [('init', c.init_proxies),
+             ('connect', c.connect_all),
+             ('run', lambda: c.async_run_all(
+                 lambda pm: pm.start_run(1), console.ProcMgrProxy.run_done)),
+             ('stop', lambda: c.async_run_all(console.ProcMgrProxy.stop)),
+             ('shutdown', lambda: c.async_run_all(
+                 console.ProcMgrProxy.start_shutdown,
+                 console.ProcMgrProxy.shutdown_done))]
+    timings = []
+    acked = 0
+    for name, fun in steps:
+        start = time.time()
+        fun()
+        timings.append((name, time.time() - start))
+        if name == 'run':
+            # Counted before 'stop' resets the state of the commands.
+            acked = len([rc for rc in c._remote_commands
+                         if rc.state == console.RemoteCommand.DONE])
+    sys.stdout = out
+
+    print "%d process managers, %d commands, %d acknowledged" % (
+        args.agents, len(c._remote_commands), acked)
+    for name, seconds in timings:
+        print "%-10s %8.3fs" % (name, seconds)
+
+    server.wait()
+    shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
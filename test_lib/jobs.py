@@ -0,0 +1,258 @@
+"""Background jobs of the console.
+
+A console command ending with '&', e.g. 'run &' or 'e load_data &', runs as a
+job in its own thread and the prompt returns at once:
+    jobs          List jobs with their state and last line of output.
+    wait %<id>    Show the output of a job and follow it until it ends.
+                  Ctrl-C stops following, not the job. 'wait' alone waits for
+                  all jobs.
+    cancel %<id>  Ask a job to stop.
+Job ids take a '%' as in bash, since 'wait <number>' sleeps that many
+seconds.
+
+What a job prints is kept with the job instead of interleaving with the
+prompt. Threads can't be killed, so cancelling is cooperative: a cancelled
+job stops at its next cancellation point, i.e. when it calls sleep() or
+check_cancelled(), which the console does between phases, in phase checkers
+and while waiting. Requests to process managers already sent are not taken
+back. A thread can also be cancelled on its own, with an event given to
+cancel_with(), e.g. a phase checker that timed out.
+"""
+
+import sys
+import threading
+import time
+import traceback
+
+# Job states.
+RUNNING = 'RUNNING'
+DONE = 'DONE'
+FAILED = 'FAILED'
+CANCELLED = 'CANCELLED'
+
+# Thread-local current job.
+_local = threading.local()
+
+
+class Cancelled(Exception):
+    """Raised in a cancelled job at its next cancellation point."""
+
+
+def current():
+    """The job of the current thread, None outside jobs."""
+    return getattr(_local, 'job', None)
+
+
+def set_current(job):
+    """Make the current thread part of job, e.g. a thread the job started."""
+    _local.job = job
+
+
+def cancel_with(event):
+    """Cancel the current thread when event is set, besides when its job is
+    cancelled, which sets event too."""
+    _local.event = event
+    job = current()
+    if job is not None:
+        job.link(event)
+
+
+def context():
+    """The job and cancel event of the current thread, for adopt() in the
+    threads it starts."""
+    return current(), getattr(_local, 'event', None)
+
+
+def adopt(ctx):
+    """Make the current thread print to and be cancelled with the thread
+    that took ctx with context()."""
+    _local.job, _local.event = ctx
+
+
+def _cancel_event():
+    """The event that cancels the current thread, None if there is none."""
+    event = getattr(_local, 'event', None)
+    if event is not None:
+        return event
+    job = current()
+    return job.cancelled if job is not None else None
+
+
+def check_cancelled():
+    """Raise Cancelled if the current thread or its job was cancelled."""
+    event = _cancel_event()
+    if event is not None and event.is_set():
+        raise Cancelled()
+
+
+def sleep(seconds):
+    """time.sleep() that a cancelled job or thread wakes up from."""
+    event = _cancel_event()
+    if event is None:
+        time.sleep(seconds)
+        return
+    event.wait(seconds)
+    check_cancelled()
+
+
+class Job(object):
+    """A console command running in the background.
+
+    Attributes:
+        id: (int)
+        command: (str)
+        state: (str) RUNNING, DONE, FAILED or CANCELLED.
+        started, ended: (float) ended is None while running.
+        cancelled: (threading.Event) Set by cancel().
+    """
+    def __init__(self, job_id, command):
+        self.id = job_id
+        self.command = command
+        self.state = RUNNING
+        self.started = time.time()
+        self.ended = None
+        self.cancelled = threading.Event()
+        # Events of cancel_with() set together with cancelled.
+        self._linked = []
+        self._output = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def write(self, s):
+        with self._lock:
+            self._output.append(s)
+
+    def output(self, start=0):
+        """What the job printed, from chunk start on.
+
+        Returns:
+            (str, int) The output and the index of the next chunk.
+        """
+        with self._lock:
+            return ''.join(self._output[start:]), len(self._output)
+
+    def last_line(self):
+        text, _ = self.output(max(0, len(self._output) - 20))
+        lines = [l for l in text.splitlines() if l.strip()]
+        return lines[-1] if lines else ''
+
+    def elapsed(self):
+        return (self.ended or time.time()) - self.started
+
+    def cancel(self):
+        self.cancelled.set()
+        with self._lock:
+            linked, self._linked = self._linked, []
+        for event in linked:
+            event.set()
+
+    def link(self, event):
+        """Set event when the job is cancelled."""
+        with self._lock:
+            if not self.cancelled.is_set():
+                self._linked.append(event)
+                return
+        event.set()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+
+class _Output(object):
+    """Replacement of sys.stdout sending what jobs print to the jobs."""
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, s):
+        job = current()
+        if job is None:
+            self._stream.write(s)
+        else:
+            job.write(s)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class JobManager(object):
+    """Starts jobs and keeps them until the console exits."""
+    def __init__(self):
+        self._jobs = []
+        self._next_id = 1
+        self._stdout = None
+
+    def start(self, command, fun):
+        """Run fun in a new job.
+
+        Args:
+            command: (str) The command, for display.
+            fun: () -> boolean. Whether the job succeeded.
+
+        Returns:
+            (Job)
+        """
+        if self._stdout is None:
+            self._stdout = sys.stdout
+            sys.stdout = _Output(sys.stdout)
+        job = Job(self._next_id, command)
+        self._next_id += 1
+
+        def target():
+            set_current(job)
+            try:
+                ok = fun()
+                job.state = DONE if ok else FAILED
+            except Cancelled:
+                job.state = CANCELLED
+            except Exception:
+                job.write(traceback.format_exc())
+                job.state = FAILED
+            job.ended = time.time()
+            self._stdout.write('\n[%d] %s  %s (%.1fs)\n' % (
+                job.id, job.state, job.command, job.elapsed()))
+        job._thread = threading.Thread(target=target, name='job %d' % job.id)
+        job._thread.daemon = True
+        self._jobs.append(job)
+        job._thread.start()
+        print "[%d] %s" % (job.id, command)
+        return job
+
+    def get(self, job_id):
+        """The job with job_id, None if there is none."""
+        for job in self._jobs:
+            if job.id == job_id:
+                return job
+        return None
+
+    def running(self):
+        return [j for j in self._jobs if j.state == RUNNING]
+
+    def print_jobs(self):
+        if not self._jobs:
+            print "No jobs."
+            return
+        for job in self._jobs:
+            print "[%d] %-9s %8.1fs  %-30s %s" % (
+                job.id, job.state, job.elapsed(), job.command,
+                job.last_line()[:60])
+
+    def wait(self, job):
+        """Print the output of job, following it until the job ends or
+        Ctrl-C.
+
+        Returns:
+            (boolean) Whether the job ended and succeeded.
+        """
+        index = 0
+        try:
+            while True:
+                ended = job.join(0.2)
+                text, index = job.output(index)
+                sys.stdout.write(text)
+                if ended:
+                    break
+        except KeyboardInterrupt:
+            print "\nStopped waiting, job %d is still running." % job.id
+            return False
+        return job.state == DONE
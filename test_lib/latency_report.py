@@ -0,0 +1,142 @@
+"""Latency of the load generators, merged from the histograms in their logs.
+
+Every load generator prints the latency histograms of each op every few
+seconds, see base_remote_resources/latency_histogram.py. After 'collect', the
+console's 'latency' command merges them:
+    latency
+        p50, p99, p99.9 and max of every op in every phase.
+    latency --by mongos --interval 30s '*/load_*'
+        The same per mongos loaded, and of the whole cluster every 30s,
+        from the logs matching a glob of 'host:port/name'.
+Times of the intervals are corrected by the clock offsets of the hosts, as
+in log_merge.
+"""
+
+import argparse
+import time
+
+import log_merge
+import run_report
+from latency_histogram import Histogram, parse_line
+
+# Groups of --by and how to get them from a record and the phase of its
+# command.
+GROUPS = {
+    'phase': lambda record, phase: phase,
+    'host': lambda record, phase: record['host'],
+    'mongos': lambda record, phase: record['mongos'],
+}
+PERCENTILES = [50, 99, 99.9]
+# Suffixes of the names of logs after the alias of their command: the log
+# file of the process manager, and the log of the stats server it forwards to.
+LOG_SUFFIXES = ['_proc', '.load']
+
+
+def alias_of(log_name):
+    """The alias of the command whose log is named log_name."""
+    for suffix in LOG_SUFFIXES:
+        if log_name.endswith(suffix):
+            return log_name[:-len(suffix)]
+    return log_name
+
+
+def read(log_path, pattern=None):
+    """Yield the LATENCY lines of the collected logs matching pattern.
+
+    Yields:
+        (dict) 'time' corrected to the console's clock, 'interval',
+        'mongos', 'ops' with a Histogram per op, and 'host' and 'alias' of
+        the command of the log.
+    """
+    for source in log_merge.find_sources(log_path, pattern):
+        host, _, name = source.label.partition('/')
+        alias = alias_of(name)
+        with open(source.path, 'r') as f:
+            for line in f:
+                try:
+                    record = parse_line(line)
+                except ValueError:
+                    # Cut off when the log was collected.
+                    continue
+                if record is None:
+                    continue
+                record['time'] -= source.offset
+                record['host'] = host
+                record['alias'] = alias
+                yield record
+
+
+def build_parser():
+    """The argument parser of 'latency'."""
+    parser = argparse.ArgumentParser(
+        prog='latency', description='Latency of the load generators.')
+    parser.add_argument('logs', nargs='?', default=None,
+                        help="glob of 'host:port/name' (default=all)")
+    parser.add_argument('--by', default='phase', choices=sorted(GROUPS),
+                        help='group by (default=phase)')
+    parser.add_argument('--interval', type=run_report.parse_duration,
+                        default=60, help='of the time series (default=1m)')
+    return parser
+
+
+def _row(label, op, h, seconds=None):
+    values = ['%8.2f' % (h.percentile(p) / 1000.0) for p in PERCENTILES]
+    values.append('%8.2f' % (h.max / 1000.0))
+    rate = '%8.0f' % (h.total() / seconds) if seconds else ''
+    return '%-24s %-7s %9d %s %s' % (label, op, h.total(), rate,
+                                     ' '.join(values))
+
+
+def _header(first, rate=False):
+    return '%-24s %-7s %9s %s %s' % (
+        first, 'op', 'count', '   ops/s' if rate else '',
+        ' '.join('%8s' % ('p%g' % p) for p in PERCENTILES) + '      max')
+
+
+def report(records, phase_of, by='phase', interval=60):
+    """Print latencies per group and op, then per interval and op.
+
+    Args:
+        records: (list of dict) See read().
+        phase_of: (dict of str to int) Phase of the command of every alias.
+        by: (str) A key of GROUPS.
+        interval: (float) Seconds per row of the time series.
+    """
+    groups = {}  # Map from (group, op) to Histogram.
+    series = {}  # Map from (interval index, op) to Histogram.
+    start = min(r['time'] - r['interval'] for r in records)
+    for r in records:
+        group = GROUPS[by](r, phase_of.get(r['alias']))
+        index = int((r['time'] - start) // interval)
+        for op, h in r['ops'].items():
+            groups.setdefault((group, op), Histogram()).merge(h)
+            series.setdefault((index, op), Histogram()).merge(h)
+
+    print "Latency in ms, %d histograms" % len(records)
+    print _header(by)
+    for (group, op), h in sorted(groups.items()):
+        if h.total():
+            print _row('-' if group is None else str(group), op, h)
+    print
+    print _header('time (UTC)', rate=True)
+    for (index, op), h in sorted(series.items()):
+        if h.total():
+            label = time.strftime(
+                '%H:%M:%S', time.gmtime(start + index * interval))
+            print _row(label, op, h, interval)
+
+
+def run(log_path, argv, phase_of):
+    """Parse argv as the arguments of 'latency' and print the latencies of
+    the logs in log_path.
+
+    Returns:
+        Whether there were latencies.
+    """
+    args = build_parser().parse_args(argv)
+    records = list(read(log_path, args.logs))
+    if not records:
+        print "No latencies, perhaps you should run 'collect' first."
+        return False
+    report(records, phase_of, args.by, args.interval)
+    return True
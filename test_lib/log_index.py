@@ -0,0 +1,306 @@
+#!/usr/bin/python
+"""Index of collected logs in SQLite, for fast searches by log, time and words.
+
+'collect --index' ingests the logs collected in the log path into
+'<log_path>/logs.db'. Every line is stored with its time, corrected by the
+host's clock offset as in log_merge, and its text goes into an FTS4 full text
+index. Ingestion is incremental: for every log, the byte offset ingested so far
+is recorded and only the lines after it are read next time. A log that no
+longer starts the same way was replaced and is ingested again.
+
+Queries (the console's 'logq', or 'python log_index.py <log_path> ...'):
+    logq "stale config"
+        Lines containing both words, in time order.
+    logq --logs '*/mongos*' --by log,minute '"stale config"'
+        Count of lines with the phrase per mongos per minute.
+    logq --from 2012-08-13T12:00 --to 2012-08-13T12:05 --logs '10.0.0.1:*'
+        All lines of a host in a time window.
+The words are an FTS4 MATCH expression, e.g. 'stale OR stepdown'.
+"""
+
+import argparse
+import calendar
+import hashlib
+import os
+import sqlite3
+import time
+
+import log_merge
+
+# Name of the database in the log path.
+DB_FILE = 'logs.db'
+
+# Bytes at the start of a log whose hash tells whether the log was replaced.
+HEAD_BYTES = 1024
+
+# Lines inserted per statement batch.
+BATCH = 10000
+
+# Group keys of --by and their SQL expressions.
+GROUPS = {
+    'host': 'files.host',
+    'log': 'files.label',
+    'name': 'files.name',
+    'hour': "strftime('%Y-%m-%dT%H:00', lines.ts, 'unixepoch')",
+    'minute': "strftime('%Y-%m-%dT%H:%M', lines.ts, 'unixepoch')",
+    'second': "strftime('%Y-%m-%dT%H:%M:%S', lines.ts, 'unixepoch')",
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    label TEXT UNIQUE,   -- 'host:port/name' as in log_merge
+    host TEXT,           -- 'host:port'
+    name TEXT,
+    size INTEGER,        -- Bytes ingested.
+    head_len INTEGER,    -- Bytes hashed into head.
+    head TEXT,
+    last_ts REAL         -- Time of the last ingested line.
+);
+CREATE TABLE IF NOT EXISTS lines (
+    id INTEGER PRIMARY KEY,  -- The docid of the line in messages.
+    file_id INTEGER,
+    ts REAL
+);
+CREATE INDEX IF NOT EXISTS lines_ts ON lines (ts);
+CREATE INDEX IF NOT EXISTS lines_file_ts ON lines (file_id, ts);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts4 (message);
+"""
+
+
+def connect(log_path):
+    """Open the index in log_path, creating it if needed."""
+    db = sqlite3.connect(os.path.join(log_path, DB_FILE))
+    db.text_factory = str
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = OFF')
+    db.executescript(_SCHEMA)
+    return db
+
+
+def _head(path, length):
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read(length)).hexdigest()
+
+
+def _complete_lines(f):
+    """Yield the lines of f that end with a newline, skipping a last line
+    still being written."""
+    for line in iter(f.readline, ''):
+        if not line.endswith('\n'):
+            return
+        yield line
+
+
+def _forget(db, file_id):
+    """Delete the lines of a file from the index."""
+    db.execute('DELETE FROM messages WHERE docid IN '
+               '(SELECT id FROM lines WHERE file_id = ?)', (file_id,))
+    db.execute('DELETE FROM lines WHERE file_id = ?', (file_id,))
+
+
+def ingest_file(db, source):
+    """Ingest the lines of source added since the last ingestion.
+
+    Args:
+        db: (sqlite3.Connection)
+        source: (log_merge.LogSource)
+
+    Returns:
+        (int) Number of new lines.
+    """
+    size = os.path.getsize(source.path)
+    row = db.execute('SELECT id, size, head_len, head, last_ts FROM files '
+                     'WHERE label = ?', (source.label,)).fetchone()
+    if row is not None:
+        file_id, start, head_len, head, last_ts = row
+        if head is not None and (size < start or
+                                 _head(source.path, head_len) != head):
+            print "%s was replaced, ingesting it again" % source.label
+            _forget(db, file_id)
+            start, last_ts = 0, None
+    else:
+        host, _, name = source.label.partition('/')
+        file_id = db.execute('INSERT INTO files (label, host, name, size) '
+                             'VALUES (?, ?, ?, 0)',
+                             (source.label, host, name)).lastrowid
+        start, last_ts = 0, None
+    if size == start:
+        return 0
+
+    next_id = (db.execute('SELECT max(id) FROM lines').fetchone()[0] or 0) + 1
+    count = 0
+    end = start
+    lines, messages = [], []
+    with open(source.path, 'rb') as f:
+        f.seek(start)
+        for ts, line in log_merge.timestamped(
+                _complete_lines(f), os.path.getmtime(source.path),
+                source.offset, last_ts, source.utc_offset):
+            lines.append((next_id + count, file_id, ts))
+            messages.append((next_id + count, line.rstrip('\n')))
+            count += 1
+            end += len(line)
+            last_ts = ts
+            if len(lines) >= BATCH:
+                _insert(db, lines, messages)
+                lines, messages = [], []
+    _insert(db, lines, messages)
+
+    head_len = min(end, HEAD_BYTES)
+    db.execute('UPDATE files SET size = ?, head_len = ?, head = ?, '
+               'last_ts = ? WHERE id = ?',
+               (end, head_len, _head(source.path, head_len), last_ts,
+                file_id))
+    return count
+
+
+def _insert(db, lines, messages):
+    db.executemany('INSERT INTO lines (id, file_id, ts) VALUES (?, ?, ?)',
+                   lines)
+    db.executemany('INSERT INTO messages (docid, message) VALUES (?, ?)',
+                   messages)
+
+
+def ingest(log_path):
+    """Ingest new lines of all logs collected in log_path.
+
+    Returns:
+        (int) Number of new lines.
+    """
+    start = time.time()
+    db = connect(log_path)
+    total = 0
+    with db:
+        for source in log_merge.find_sources(log_path):
+            total += ingest_file(db, source)
+    db.close()
+    print "Indexed %d new lines in %.2fs" % (total, time.time() - start)
+    return total
+
+
+def parse_time(s):
+    """Parse a UTC time like '2012-08-13T12:34[:56]' or seconds since the
+    epoch."""
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(s, fmt))
+        except ValueError:
+            pass
+    return float(s)
+
+
+def build_parser():
+    """The argument parser of queries."""
+    parser = argparse.ArgumentParser(prog='logq',
+                                     description='Query the log index.')
+    parser.add_argument('words', nargs='*',
+                        help='FTS4 match expression, e.g. \'"stale config"\'')
+    parser.add_argument('--logs', default=None,
+                        help="glob of 'host:port/name' (default=all)")
+    parser.add_argument('--from', dest='since', type=parse_time, default=None,
+                        help='UTC start time, e.g. 2012-08-13T12:00')
+    parser.add_argument('--to', dest='until', type=parse_time, default=None,
+                        help='UTC end time')
+    parser.add_argument('--by', default=None,
+                        help='count lines grouped by a comma separated list '
+                        'of %s' % ', '.join(sorted(GROUPS)))
+    parser.add_argument('-n', dest='limit', type=int, default=100,
+                        help='maximum rows shown (default=100)')
+    return parser
+
+
+def query(db, args):
+    """Run a query.
+
+    Args:
+        db: (sqlite3.Connection)
+        args: (argparse.Namespace) Parsed by build_parser().
+
+    Returns:
+        (list of str, list of tuple) The column names and the rows.
+    """
+    where = []
+    params = []
+    if args.words:
+        where.append('lines.id IN (SELECT docid FROM messages '
+                     'WHERE messages MATCH ?)')
+        params.append(' '.join(args.words))
+    if args.logs is not None:
+        where.append('files.label GLOB ?')
+        params.append(args.logs)
+    if args.since is not None:
+        where.append('lines.ts >= ?')
+        params.append(args.since)
+    if args.until is not None:
+        where.append('lines.ts < ?')
+        params.append(args.until)
+    where_sql = ' WHERE ' + ' AND '.join(where) if where else ''
+
+    if args.by:
+        keys = args.by.split(',')
+        for k in keys:
+            if k not in GROUPS:
+                raise ValueError('Unknown group <%s>, use %s' % (
+                    k, ', '.join(sorted(GROUPS))))
+        exprs = ', '.join(GROUPS[k] for k in keys)
+        sql = ('SELECT %s, count(*) FROM lines JOIN files '
+               'ON files.id = lines.file_id%s GROUP BY %s ORDER BY %s '
+               'LIMIT ?' % (exprs, where_sql, exprs, exprs))
+        columns = keys + ['count']
+    else:
+        sql = ("SELECT strftime('%%Y-%%m-%%dT%%H:%%M:%%S', lines.ts, "
+               "'unixepoch'), files.label, messages.message FROM lines "
+               "JOIN files ON files.id = lines.file_id "
+               "JOIN messages ON messages.docid = lines.id%s "
+               "ORDER BY lines.ts, lines.id LIMIT ?" % where_sql)
+        columns = ['time', 'log', 'message']
+    params.append(args.limit)
+    return columns, db.execute(sql, params).fetchall()
+
+
+def run_query(log_path, argv):
+    """Parse argv as a query, run it on the index in log_path and print the
+    result with its time."""
+    args = build_parser().parse_args(argv)
+    if not os.path.exists(os.path.join(log_path, DB_FILE)):
+        print "No log index, perhaps you should run 'collect --index' first."
+        return
+    db = connect(log_path)
+    start = time.time()
+    try:
+        columns, rows = query(db, args)
+    except (ValueError, sqlite3.OperationalError) as e:
+        print "Bad query:", e
+        return
+    finally:
+        db.close()
+    elapsed = time.time() - start
+    if args.by:
+        print '  '.join(columns)
+        for row in rows:
+            print '  '.join(str(v) for v in row)
+    else:
+        width = max([len(r[1]) for r in rows] + [0])
+        for ts, label, message in rows:
+            print '%s %-*s | %s' % (ts, width, label, message)
+    print "%d rows in %.3fs%s" % (len(rows), elapsed,
+                                  ' (limited)' if len(rows) == args.limit
+                                  else '')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Index collected logs or query the index.',
+        epilog='Any other arguments are a query, see logq -h.')
+    parser.add_argument('log_path', help='directory logs were collected to')
+    parser.add_argument('--ingest', action='store_true',
+                        help='ingest new lines instead of querying')
+    args, rest = parser.parse_known_args()
+    if args.ingest:
+        ingest(args.log_path)
+    else:
+        run_query(args.log_path, rest)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/python
+"""Merge logs collected from all hosts into one time-ordered stream.
+
+'collect' copies the logs of every process manager into
+'<log_path>/<host>_<port>/' and records the clock offset and the time zone of
+the host in '<host>_<port>/clock_offset'. The merge reads every log line by
+line and merges them with a heap, so memory doesn't grow with the size of the
+logs.
+
+Timestamps at the start of a line are recognized in the formats of mongod,
+mongos, the shell and syslog:
+    + 2012-08-13T12:34:56.789-0400 (ISO 8601, mongod 2.6 and later)
+    + Mon Aug 13 12:34:56.789 (ctime, older mongod, mongos and the shell)
+    + Aug 13 12:34:56 (syslog)
+Timestamps without a time zone are in the local time of the host, so its UTC
+offset recorded by 'collect' is subtracted (none if unknown), and ctime
+timestamps get the year of the file's modification time. Lines without a
+timestamp belong to the line before them.
+
+Usage:
+    python log_merge.py [-o <file>] [<log_path>] [<glob>]
+
+From the console: 'logs [-o <file>] [<glob>]'.
+"""
+
+import argparse
+import calendar
+import errno
+import fnmatch
+import heapq
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+# File in a host's log directory recording its clock offset.
+CLOCK_FILE = 'clock_offset'
+
+# Lines without timestamp kept while waiting for the first timestamp of a
+# file. Beyond that, they are given the file's modification time.
+MAX_LEADING_LINES = 1000
+
+_MONTHS = dict((m, i + 1) for i, m in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct',
+     'Nov', 'Dec']))
+
+_ISO = re.compile(r'^(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})'
+                  r'(\.\d+)?(Z|[+-]\d{2}:?\d{2})?')
+_CTIME = re.compile(r'^(?:(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun) )?'
+                    r'(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) +'
+                    r'(\d{1,2}) (\d{2}):(\d{2}):(\d{2})(\.\d+)?')
+
+
+def parse_timestamp(line, mtime, utc_offset=0):
+    """Parse the timestamp at the start of line.
+
+    Args:
+        line: (str) A log line.
+        mtime: (float) Modification time of the file, giving the year of
+            timestamps without one.
+        utc_offset: (int) Seconds the local time of the host is ahead of
+            UTC, for timestamps without a time zone.
+
+    Returns:
+        (float) Seconds since the epoch, None if line has no timestamp.
+    """
+    m = _ISO.match(line)
+    if m is not None:
+        ts = calendar.timegm(tuple(int(g) for g in m.groups()[:6]))
+        if m.group(7):
+            ts += float(m.group(7))
+        tz = m.group(8)
+        if not tz:
+            ts -= utc_offset
+        elif tz != 'Z':
+            tz = tz.replace(':', '')
+            minutes = int(tz[1:3]) * 60 + int(tz[3:5])
+            ts -= minutes * 60 if tz[0] == '+' else -minutes * 60
+        return ts
+    m = _CTIME.match(line)
+    if m is not None:
+        file_time = time.gmtime(mtime)
+        month = _MONTHS[m.group(1)]
+        # A log written across new year.
+        year = file_time.tm_year - (1 if month > file_time.tm_mon else 0)
+        ts = calendar.timegm((year, month, int(m.group(2)), int(m.group(3)),
+                              int(m.group(4)), int(m.group(5))))
+        if m.group(6):
+            ts += float(m.group(6))
+        return ts - utc_offset
+    return None
+
+
+class LogSource(object):
+    """A log file of a host.
+
+    Attributes:
+        path: (str) The path of the file.
+        label: (str) 'host:port/name' shown with every line.
+        offset: (float) Seconds the host's clock is ahead of the console's.
+        utc_offset: (int) Seconds the host's local time is ahead of UTC.
+    """
+    def __init__(self, path, label, offset=0.0, utc_offset=0):
+        self.path = path
+        self.label = label
+        self.offset = offset
+        self.utc_offset = utc_offset
+
+    def lines(self):
+        """Yield (time, line) in the order of the file, with time corrected
+        to the console's clock."""
+        with open(self.path, 'r') as f:
+            for pair in timestamped(f, os.path.getmtime(self.path),
+                                    self.offset, utc_offset=self.utc_offset):
+                yield pair
+
+
+def timestamped(lines, mtime, offset=0.0, last=None, utc_offset=0):
+    """Pair the lines of a log with their time.
+
+    A line without timestamp gets the time of the line before it. Leading
+    lines without timestamp get the time of the first timestamp, or mtime if
+    there is none in MAX_LEADING_LINES lines.
+
+    Args:
+        lines: (iterable of str) Lines of a log in order.
+        mtime: (float) Modification time of the log.
+        offset: (float) Clock offset subtracted from times.
+        last: (float) Time of the line before lines, if continuing a log.
+        utc_offset: (int) See parse_timestamp().
+
+    Yields:
+        (time, line) for every line.
+    """
+    leading = []
+    for line in lines:
+        ts = parse_timestamp(line, mtime, utc_offset)
+        if ts is not None:
+            last = ts - offset
+        if last is None:
+            leading.append(line)
+            if len(leading) < MAX_LEADING_LINES:
+                continue
+            last = mtime - offset
+        for l in leading:
+            yield last, l
+        leading = []
+        yield last, line
+    for l in leading:
+        yield mtime - offset, l
+
+
+def read_clock_offset(host_dir):
+    """The clock offset and UTC offset recorded by 'collect' in host_dir, 0
+    if unknown."""
+    path = os.path.join(host_dir, CLOCK_FILE)
+    if not os.path.exists(path):
+        return 0.0, 0
+    with open(path, 'r') as f:
+        recorded = json.load(f)
+    return recorded['offset'], recorded.get('utc_offset', 0)
+
+
+def write_clock_offset(host_dir, offset, error, utc_offset=0):
+    """Record the clock offset and the UTC offset of the local time of the
+    host whose logs are in host_dir."""
+    with open(os.path.join(host_dir, CLOCK_FILE), 'w') as f:
+        json.dump({'offset': offset, 'error': error, 'utc_offset': utc_offset,
+                   'measured': time.time()}, f)
+
+
+def find_sources(log_path, pattern=None):
+    """Find the logs collected in log_path.
+
+    Args:
+        log_path: (str) The directory 'collect' copies logs to.
+        pattern: (str) Glob matched against the labels of logs, e.g.
+            '*:2900/mongod*'. None means all logs.
+
+    Returns:
+        (list of LogSource)
+    """
+    sources = []
+    for host_port in sorted(os.listdir(log_path)):
+        host_dir = os.path.join(log_path, host_port)
+        if not os.path.isdir(host_dir):
+            continue
+        offset, utc_offset = read_clock_offset(host_dir)
+        host, _, port = host_port.rpartition('_')
+        for name in sorted(os.listdir(host_dir)):
+            if not name.endswith('.log'):
+                continue
+            label = '%s:%s/%s' % (host, port, name[:-len('.log')])
+            if pattern is None or fnmatch.fnmatch(label, pattern):
+                sources.append(LogSource(os.path.join(host_dir, name), label,
+                                         offset, utc_offset))
+    return sources
+
+
+def merge(sources):
+    """Merge the lines of sources in time order.
+
+    Yields:
+        (str) Lines prefixed with the UTC time and the label of the source.
+    """
+    def tagged(i, source):
+        for n, (ts, line) in enumerate(source.lines()):
+            # i and n keep the order of equal times stable and prevent
+            # comparing lines.
+            yield ts, i, n, line
+
+    width = max([len(s.label) for s in sources] + [0])
+    for ts, i, _, line in heapq.merge(*[tagged(i, s)
+                                        for i, s in enumerate(sources)]):
+        yield '%s.%03dZ %-*s | %s' % (
+            time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(ts)),
+            int(ts * 1000) % 1000, width, sources[i].label,
+            line.rstrip('\n'))
+
+
+def output(lines, out_path=None):
+    """Write lines to out_path, or to a pager if stdout is a terminal.
+
+    The pager is $PAGER, 'less' by default.
+    """
+    if out_path is not None:
+        count = 0
+        with open(out_path, 'w') as f:
+            for line in lines:
+                f.write(line + '\n')
+                count += 1
+        print "Wrote %d lines to %s" % (count, out_path)
+        return
+    pager = None
+    out = sys.stdout
+    if out.isatty():
+        pager = subprocess.Popen(os.environ.get('PAGER', 'less -S'),
+                                 shell=True, stdin=subprocess.PIPE)
+        out = pager.stdin
+    try:
+        for line in lines:
+            out.write(line + '\n')
+        out.flush()
+    except IOError as e:
+        # The reader quit before reading everything.
+        if e.errno != errno.EPIPE:
+            raise
+    if pager is not None:
+        try:
+            pager.stdin.close()
+        except IOError:
+            pass
+        pager.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Merge collected logs into one time-ordered stream.')
+    parser.add_argument('log_path', nargs='?', default='logs/',
+                        help='directory logs were collected to (default=logs/)')
+    parser.add_argument('pattern', nargs='?', default=None,
+                        help="glob of 'host:port/name' to merge (default=all)")
+    parser.add_argument('-o', dest='out_path', default=None,
+                        help='write to file instead of a pager')
+    args = parser.parse_args()
+    output(merge(find_sources(args.log_path, args.pattern)), args.out_path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""Cache of the plan evaluated from a command config.
+
+Evaluating a command config provisions machines (S3 and EC2 calls) and
+generates all remote commands, which is slow and the same every time until the
+config changes. The evaluated plan, everything the console needs except live
+Python objects like phase checkers and the provisioner, is saved after
+evaluation and loaded on the next start instead.
+
+A plan is cached under '.plan_cache/' next to the config, keyed by the SHA1 of
+the config's content. It is only used if the modules the config imported from
+its directory and the framework modules that build the plan are unchanged too.
+Configs loaded together as namespaces make one plan, cached next to the first
+config and keyed by all of them.
+Machines may still change behind the cache's back, e.g. after 'terminate', so
+the console refreshes or clears the cache explicitly, see 'plan' in the
+console.
+"""
+
+import cPickle
+import glob
+import hashlib
+import os
+import sys
+import time
+
+# Directory of cached plans, next to the config.
+CACHE_DIR = '.plan_cache'
+
+# Bump when the content of Plan changes.
+VERSION = 1
+
+# Framework modules whose code shapes the plan.
+FRAMEWORK_MODULES = ['console_config', 'provisioning', 'console']
+
+
+class Plan(object):
+    """The evaluated config.
+
+    Attributes:
+        remote_commands: (list of RemoteCommand)
+        state: (dict) Values of the console_config globals listed in
+            console_config.PLAN_GLOBALS.
+        checkers: (list of tuple) (name, phase, deps, timeout) of every phase
+            checker, for display only.
+        deps: (dict of str to str) SHA1 of every file the plan depends on.
+        created: (float) When the config was evaluated.
+        version: (int) VERSION when saved.
+    """
+    def __init__(self, remote_commands, state, checkers, deps):
+        self.remote_commands = remote_commands
+        self.state = state
+        self.checkers = checkers
+        self.deps = deps
+        self.created = time.time()
+        self.version = VERSION
+
+
+def _sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _source(module):
+    """Source file of module, None for built-in modules."""
+    path = getattr(module, '__file__', None)
+    if path is None:
+        return None
+    if path.endswith('.pyc') or path.endswith('.pyo'):
+        path = path[:-1]
+    return os.path.abspath(path) if os.path.exists(path) else None
+
+
+def dependencies(configs, imported):
+    """Files a plan evaluated from configs depends on.
+
+    Args:
+        configs: (list of (str, str)) The namespace and path of every config,
+            see Console.config().
+        imported: (iterable of str) Names of the modules imported while
+            evaluating the configs.
+
+    Returns:
+        (dict of str to str) SHA1 by path.
+    """
+    config_dirs = set(os.path.dirname(os.path.abspath(path))
+                      for _, path in configs)
+    paths = set()
+    for name in list(imported) + FRAMEWORK_MODULES:
+        path = _source(sys.modules.get(name))
+        if path is None:
+            continue
+        if name in FRAMEWORK_MODULES or any(path.startswith(d + os.sep)
+                                            for d in config_dirs):
+            paths.add(path)
+    return dict((p, _sha1(p)) for p in paths)
+
+
+def _name(configs):
+    """File name of the plans of configs, without content hash."""
+    return '+'.join(os.path.basename(path) if namespace is None
+                    else '%s=%s' % (namespace, os.path.basename(path))
+                    for namespace, path in configs)
+
+
+def _cache_path(configs):
+    directory = os.path.dirname(os.path.abspath(configs[0][1]))
+    sha1 = hashlib.sha1()
+    for namespace, path in configs:
+        sha1.update('%s\0%s\0' % (namespace, _sha1(path)))
+    return os.path.join(directory, CACHE_DIR,
+                        '%s-%s.pickle' % (_name(configs), sha1.hexdigest()))
+
+
+def load(configs):
+    """Load the cached plan of configs, a list of (namespace, path).
+
+    Returns:
+        (Plan) None if there is no valid plan.
+    """
+    path = _cache_path(configs)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            plan = cPickle.load(f)
+    except Exception as e:
+        print "Ignoring unreadable cached plan %s: %s" % (path, e)
+        return None
+    if getattr(plan, 'version', None) != VERSION:
+        return None
+    for dep, sha1 in plan.deps.items():
+        if not os.path.exists(dep) or _sha1(dep) != sha1:
+            print "Cached plan is out of date, %s changed." % dep
+            return None
+    return plan
+
+
+def save(configs, plan):
+    """Cache plan as the plan of configs, replacing the plans of their
+    earlier content."""
+    clear(configs)
+    path = _cache_path(configs)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            cPickle.dump(plan, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def clear(configs):
+    """Remove all cached plans of configs, of any content.
+
+    Returns:
+        (int) Number of plans removed.
+    """
+    directory = os.path.dirname(os.path.abspath(configs[0][1]))
+    paths = glob.glob(os.path.join(directory, CACHE_DIR,
+                                   _name(configs) + '-*.pickle'))
+    for p in paths:
+        os.remove(p)
+    return len(paths)
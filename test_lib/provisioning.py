@@ -1,14 +1,16 @@
-"""Provisioning on local network, AWS or other cloud provider."""
+"""Provisioning on this machine, local network, AWS or other cloud
+provider."""
 
 import datetime
+import getpass
 import time
 import json
 import os
+import shutil
+import signal
 import sys
 
-import boto.ec2 as ec2
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
+# boto is imported when first used, it takes a while to import.
 
 CLUSTER_TEST_KEY = 'purpose'
 CLUSTER_TEST_VALUE = 'cluster_test_framework'
@@ -32,6 +34,15 @@ TYPE_SMALL_32 = "small32" # 32bit
 TYPE_SMALL = "small" # 64bit
 TYPE_LARGE = "large"
 
+# Directory of the working directories of machines provisioned by Local.
+LOCAL_ROOT = '~/cluster_test_local'
+# Local machines are 127.0.0.1 to 127.0.0.<MAX_LOCAL_MACHINES>.
+MAX_LOCAL_MACHINES = 254
+
+# Ports of the machines of all Local provisioners, which share this machine's
+# ports: map from (host, port asked for) to port.
+_local_ports = {}
+
 # AMI types, instance store
 AMI_TYPES = {
         REGION_US_EAST_1 : {
@@ -81,15 +92,61 @@ class Machine(object):
     """Represent a machine on AWS or locally.
 
     Attributes:
-        host: (str) The IP or DNS hostname.
+        host: (str) The IP or DNS hostname. If the machine was created with a
+            resolver, the resolver is only called when host is first read.
         user_name: (str) User name for SSH.
         machine_options: (MachineOptions)
             Description of the machine's location and type, maybe None.
+        local_root: (str) For a machine provisioned by Local, the directory of
+            the working directories of its process managers, which run
+            without SSH. None for remote machines.
     """
-    def __init__(self, host, user_name, options=None):
-        self.host = host
+    def __init__(self, host, user_name, options=None, resolver=None,
+                 local_root=None, port_map=None):
+        self._host = host
+        self._resolver = resolver
         self.user_name = user_name
         self.machine_options = options
+        self.local_root = local_root
+        self._port_map = port_map
+
+    @property
+    def host(self):
+        if self._resolver is not None:
+            self._host = self._resolver()
+            self._resolver = None
+        return self._host
+
+    @property
+    def resolved(self):
+        """Whether host is known without calling the resolver."""
+        return self._resolver is None
+
+    def map_port(self, port):
+        """The port that a process asking for port listens on.
+
+        It is port itself, except on machines of Local, which share their
+        ports.
+        """
+        if self._port_map is None:
+            return port
+        return self._port_map(port)
+
+
+class _MachineRequest(object):
+    """Machines asked for by one get_machines() call, provisioned together
+    when the host of any of them is first needed."""
+    def __init__(self, provisioner, machine_options, number):
+        self._provisioner = provisioner
+        self._machine_options = machine_options
+        self._number = number
+        self._hosts = None
+
+    def host(self, i):
+        if self._hosts is None:
+            self._hosts = self._provisioner._get_hosts(self._machine_options,
+                                                       self._number)
+        return self._hosts[i]
 
 def get_ami_user(ami):
     
@@ -148,6 +205,100 @@ class ProvisioningError(Exception):
     def __str__(self):
         return repr(self.msg)
 
+def local_processes(path):
+    """Pids of the processes of this machine running in directory path or
+    below it, Linux only."""
+    pids = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit() or int(name) == os.getpid():
+            continue
+        try:
+            cwd = os.readlink('/proc/%s/cwd' % name)
+        except OSError:
+            # Gone, or not ours.
+            continue
+        if cwd == path or cwd.startswith(path + os.sep):
+            pids.append(int(name))
+    return pids
+
+class Local(object):
+    """Provisioning on this machine, to try a topology or run a smoke test
+    without waiting for AWS.
+
+    Every machine gets its own loopback address, 127.0.0.<n>, which Linux
+    routes without configuration. The machines share the ports of this
+    machine though, so a port asked for by a process manager, mongod or mongos
+    is mapped to one that no other local machine uses, see
+    Machine.map_port(). Process managers are set up and run without SSH, in
+    working directories under root.
+
+    Attributes:
+        root: (str) The directory of the working directories.
+    """
+    def __init__(self, root=LOCAL_ROOT, user_name=None):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self._user_name = user_name or getpass.getuser()
+        self._machine_counter = 0
+
+    def get_machine(self, options=None):
+        return self.get_machines(options, number=1)[0]
+
+    def get_machines(self, machine_options=None, number=1):
+        """New local machines.
+
+        This function is a part of the public interface of provisioner.
+
+        Parameters:
+            machine_options: (MachineOptions) Kept in the machines, but
+                otherwise ignored.
+            number: (int) The number of machine.
+
+        Return:
+            (list of Machine)
+        """
+        if self._machine_counter + number > MAX_LOCAL_MACHINES:
+            raise ProvisioningError('At most %d local machines' %
+                                    MAX_LOCAL_MACHINES)
+        machines = []
+        for _ in range(number):
+            self._machine_counter += 1
+            host = '127.0.0.%d' % self._machine_counter
+            machines.append(Machine(
+                host, self._user_name, machine_options,
+                local_root=self.root,
+                port_map=lambda port, host=host: self._map_port(host, port)))
+        return machines
+
+    @staticmethod
+    def _map_port(host, port):
+        """The port asked for if no other local machine uses it, the next
+        free one otherwise. The same for the same host and port."""
+        if (host, port) not in _local_ports:
+            used = set(_local_ports.values())
+            mapped = port
+            while mapped in used:
+                mapped += 1
+            _local_ports[(host, port)] = mapped
+        return _local_ports[(host, port)]
+
+    def terminate_all(self):
+        """Kill the process managers and the processes they run, and remove
+        their working directories.
+
+        This function is a part of the public interface of provisioner.
+        """
+        if not os.path.exists(self.root):
+            print "No local machines to terminate."
+            return
+        pids = local_processes(self.root)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        shutil.rmtree(self.root)
+        print "Killed %d processes and removed %s." % (len(pids), self.root)
+
 class AWS(object):
     
     """Provisioning on AWS."""
@@ -174,7 +325,8 @@ class AWS(object):
         self._ts = str(datetime.datetime.now())
         
         self._used_options = set()
-        self._all_instances = self._get_all_instances()
+        # Listed from S3 and EC2 when first needed.
+        self._all_instances = None
         self._used_instances = {}
 
     def load_credentials_from_file(self, credentials_dir):
@@ -221,10 +373,23 @@ class AWS(object):
             options: (MachineOptions) Options of machine.
             number: (int) The number of machine.
 
+        The machines are handles: the instances are only looked up, or run,
+        when the host of one of them is first read.
+
         Return:
             (list of Machine) new existing machines.
         """
-        
+        request = _MachineRequest(self, machine_options, number)
+        return [Machine(None, machine_options.user_name, machine_options,
+                        resolver=lambda i=i: request.host(i))
+                for i in range(number)]
+
+    def _get_hosts(self, machine_options, number):
+        """Reuse existing instances if possible or run new instances.
+
+        Return:
+            (list of str) The public DNS names of the instances.
+        """
         print "Checking existing instances on AWS..."
         
         existing_instances = self._get_instances(machine_options)
@@ -244,7 +409,7 @@ class AWS(object):
             # Get new instances from AWS.
             new_instances = self._run_instances(machine_options, number - len(existing_instances))
             self._register_instances(new_instances, machine_options)
-            self._all_instances.extend(new_instances)
+            self._get_known_instances().extend(new_instances)
             
             existing_instances.extend(new_instances)
                 
@@ -255,10 +420,29 @@ class AWS(object):
         self._used_instances[machine_options].extend(existing_instances)
         
         print "Now using %d instances out of %d." % \
-            (len(self._get_all_used_instances()), len(self._all_instances))
-        
-        ips = [i.public_dns_name for i in existing_instances]
-        return [Machine(ip, machine_options.user_name, machine_options) for ip in ips]
+            (len(self._get_all_used_instances()),
+             len(self._get_known_instances()))
+        
+        return [i.public_dns_name for i in existing_instances]
+
+    def _get_known_instances(self):
+        """All instances of this test, listed on first use."""
+        if self._all_instances is None:
+            self._all_instances = self._get_all_instances()
+        return self._all_instances
+
+    def _connect_ec2(self, region):
+        """Connect to EC2 in region."""
+        import boto.ec2
+        return boto.ec2.connect_to_region(
+            region, aws_access_key_id=self._access_key_id,
+            aws_secret_access_key=self._secret_access_key)
+
+    def _get_bucket(self):
+        """The S3 bucket of test metadata."""
+        from boto.s3.connection import S3Connection
+        s3_conn = S3Connection(self._access_key_id, self._secret_access_key)
+        return s3_conn.get_bucket(BUCKET_NAME)
     
     
 
@@ -292,9 +476,7 @@ class AWS(object):
         
         for region, machine_docs in regional_instances.items():
             
-            conn = ec2.connect_to_region(region,
-                                         aws_access_key_id=self._access_key_id,
-                                         aws_secret_access_key=self._secret_access_key)
+            conn = self._connect_ec2(region)
                     
             filters = {'tag:' + CLUSTER_TEST_KEY: CLUSTER_TEST_VALUE,
                        'tag:' + TEST_NAME_KEY: self.test_name}
@@ -330,9 +512,7 @@ class AWS(object):
             (list of boto.ec2.instance)
         """
                 
-        conn = ec2.connect_to_region(machine_options.region,
-                                     aws_access_key_id=self._access_key_id,
-                                     aws_secret_access_key=self._secret_access_key)
+        conn = self._connect_ec2(machine_options.region)
                 
         filters = {'tag:' + CLUSTER_TEST_KEY: CLUSTER_TEST_VALUE,
                    'tag:' + TEST_NAME_KEY: self.test_name,
@@ -357,9 +537,7 @@ class AWS(object):
         Return:
             list of instances.
         """
-        conn = ec2.connect_to_region(machine_options.region,
-                                     aws_access_key_id=self._access_key_id,
-                                     aws_secret_access_key=self._secret_access_key)
+        conn = self._connect_ec2(machine_options.region)
 
         # Read setup bash script.
         if machine_options.staging and USER_DATA_FILE is not None:
@@ -410,9 +588,7 @@ class AWS(object):
         Return:
             (list of boto.ec2.instance) Instances with up-to-date status.
         """
-        conn = ec2.connect_to_region(machine_options.region,
-                                     aws_access_key_id=self._access_key_id,
-                                     aws_secret_access_key=self._secret_access_key)
+        conn = self._connect_ec2(machine_options.region)
 
         done = False
         first_time = True
@@ -497,9 +673,7 @@ class AWS(object):
             
             print ("Will terminate %d instance(s) in %s... " % (len(instances), region)),
             
-            conn = ec2.connect_to_region(region,
-                                         aws_access_key_id=self._access_key_id,
-                                         aws_secret_access_key=self._secret_access_key)
+            conn = self._connect_ec2(region)
             
             conn.terminate_instances([i.id for i in instances])
             print "done."
@@ -515,8 +689,8 @@ class AWS(object):
         Return:
             (dict) The deserialized json document.
         """
-        s3_conn = S3Connection(self._access_key_id, self._secret_access_key)
-        bucket = s3_conn.get_bucket(BUCKET_NAME)
+        from boto.s3.key import Key
+        bucket = self._get_bucket()
         k = Key(bucket)
         k.key = key
         if k.exists():
@@ -533,8 +707,8 @@ class AWS(object):
             key: (str)
             obj: (dict) Used to be serialization.
         """
-        s3_conn = S3Connection(self._access_key_id, self._secret_access_key)
-        bucket = s3_conn.get_bucket(BUCKET_NAME)
+        from boto.s3.key import Key
+        bucket = self._get_bucket()
         k = Key(bucket)
         k.key = key
         json_content = json.dumps(obj)
@@ -552,7 +726,6 @@ class AWS(object):
         Parameters:
             key: (str)
         """
-        s3_conn = S3Connection(self._access_key_id, self._secret_access_key)
-        bucket = s3_conn.get_bucket(BUCKET_NAME)
+        bucket = self._get_bucket()
         bucket.delete_key(key)
 
@@ -0,0 +1,118 @@
+"""Scripts of console commands and the JSON report of running them.
+
+'console.py --exec "setup;run;wait 30m;collect;shutdown"', or '--exec-file'
+with one command per line, runs the commands without prompting, stops at the
+first failing command and exits with 1 if any failed. A run trace is recorded
+for the whole script and a report is written, by default to
+'<log_path>/report-<time>.json':
+    {
+      "config": "command_config",
+      "started": 1344861296.1,   Seconds since the epoch.
+      "wall": 2040.5,            Seconds of the whole script.
+      "ok": true,
+      "steps": [{"command": "setup", "start": 0.0, "wall": 95.2, "ok": true},
+                ...],
+      "setup": {"10.0.0.1:2900": {"wall": 40.1, "ok": true,
+                                  "scripts": [...]}, ...},
+      "phases": {"1": {"wall": 12.0, "commands": 30, "acks": 0.8, ...}, ...}
+    }
+The start of a step is relative to "started". "scripts" are the results of
+the host's setup scripts, see setup_runner, and "phases" is
+run_trace.phase_stats() of the trace.
+"""
+
+import json
+import os
+import re
+import time
+
+import run_trace
+
+# Seconds per unit of durations.
+_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_duration(s):
+    """Parse a duration like '90', '30s', '30m' or '1.5h' into seconds.
+
+    Raises:
+        ValueError: s is not a duration.
+    """
+    m = re.match(r'^(\d+(?:\.\d+)?)([smh]?)$', s.strip())
+    if m is None:
+        raise ValueError('Bad duration <%s>, use e.g. 30s, 30m or 1h' % s)
+    return float(m.group(1)) * _UNITS[m.group(2)]
+
+
+def parse_script(text):
+    """Split a script into commands.
+
+    Commands are separated by ';' or newlines. Blank lines and lines starting
+    with '#' are skipped.
+
+    Returns:
+        (list of str)
+    """
+    commands = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#'):
+            continue
+        commands.extend(c.strip() for c in line.split(';') if c.strip())
+    return commands
+
+
+class Report(object):
+    """The report of a scripted run.
+
+    Attributes:
+        config_path: (str) The command configs, e.g. 'a=a_config, b=b_config'.
+        started: (float) When the script started.
+        steps: (list of dict) 'command', 'start', 'wall' and 'ok' of every
+            command run.
+        setup: (dict of str to dict) 'wall', 'ok' and 'scripts' of the last
+            setup of every host.
+    """
+    def __init__(self, config_path):
+        self.config_path = config_path
+        self.started = time.time()
+        self.steps = []
+        self.setup = {}
+
+    def add_step(self, command, start, end, ok):
+        self.steps.append({'command': command,
+                           'start': start - self.started,
+                           'wall': end - start,
+                           'ok': ok})
+
+    def add_setup(self, host, start, end, ok, scripts):
+        self.setup[host] = {'wall': end - start, 'ok': ok,
+                            'scripts': scripts}
+
+    @property
+    def ok(self):
+        return all(s['ok'] for s in self.steps)
+
+    def to_dict(self, tracer=None):
+        """The report as a JSON serializable dict.
+
+        Args:
+            tracer: (run_trace.Tracer) The trace recorded during the script,
+                giving the phases.
+        """
+        phases = run_trace.phase_stats(tracer) if tracer is not None else {}
+        return {'config': self.config_path,
+                'started': self.started,
+                'wall': time.time() - self.started,
+                'ok': self.ok,
+                'steps': self.steps,
+                'setup': self.setup,
+                'phases': dict((str(p), s) for p, s in phases.items())}
+
+    def write(self, path, tracer=None):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(tracer), f, indent=2, sort_keys=True)
+        print "Report written to", path
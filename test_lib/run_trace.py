@@ -0,0 +1,221 @@
+"""Timing trace of 'run' in Chrome trace format.
+
+While a trace is started, the console records spans of phases, of every
+command from sending it to its acknowledgement and of phase checkers and the
+waits inside them. stop() writes them as a Chrome trace, to be opened in
+chrome://tracing or https://ui.perfetto.dev, and print_phase_summary() prints
+where the time of every phase went.
+
+Spans are recorded on lanes, shown as threads in the viewer: one for the
+console, one per process manager and one per phase checker thread. The
+functions of this module do nothing when no trace is started, so they can be
+called anywhere.
+"""
+
+import json
+import os
+import threading
+import time
+
+# The trace being recorded, None if not tracing.
+_tracer = None
+
+
+class Tracer(object):
+    """Recorder of trace events.
+
+    Attributes:
+        start_time: (float) When the trace started.
+        events: (list of dict) Complete and instant events in Chrome trace
+            format, except that 'ts' and 'dur' are still in seconds.
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.events = []
+        self._lanes = {}  # Map from lane name to tid.
+        self._lock = threading.Lock()
+
+    def _tid(self, lane):
+        if lane is None:
+            lane = threading.current_thread().name
+            if lane == 'MainThread':
+                lane = 'console'
+        if lane not in self._lanes:
+            self._lanes[lane] = len(self._lanes) + 1
+        return self._lanes[lane]
+
+    def complete(self, name, cat, start, end, lane=None, args=None):
+        """Record a span from start to end."""
+        with self._lock:
+            self.events.append({'name': name, 'cat': cat, 'ph': 'X',
+                                'ts': start, 'dur': end - start,
+                                'pid': 1, 'tid': self._tid(lane),
+                                'args': args or {}})
+
+    def instant(self, name, cat, lane=None, args=None):
+        """Record an event without duration, e.g. a retry."""
+        with self._lock:
+            self.events.append({'name': name, 'cat': cat, 'ph': 'i', 's': 't',
+                                'ts': time.time(), 'pid': 1,
+                                'tid': self._tid(lane), 'args': args or {}})
+
+    def write(self, path):
+        """Write the trace to path in Chrome trace format."""
+        with self._lock:
+            events = []
+            for e in self.events:
+                e = dict(e)
+                e['ts'] = int((e['ts'] - self.start_time) * 1e6)
+                if 'dur' in e:
+                    e['dur'] = int(e['dur'] * 1e6)
+                events.append(e)
+            for lane, tid in self._lanes.items():
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                               'tid': tid, 'args': {'name': lane}})
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class _Span(object):
+    """Context manager recording a span, see span()."""
+    def __init__(self, name, cat, lane, args):
+        self._name = name
+        self._cat = cat
+        self._lane = lane
+        self.args = args
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.args['error'] = str(exc_value)
+        complete(self._name, self._cat, self._start, time.time(), self._lane,
+                 self.args)
+        return False
+
+
+def start():
+    """Start recording a new trace."""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop(path=None):
+    """Stop recording, writing the trace to path if given.
+
+    Returns:
+        (Tracer) The stopped trace, None if none was started.
+    """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None and path is not None:
+        tracer.write(path)
+        print "Trace written to", path
+    return tracer
+
+
+def span(name, cat, lane=None, **args):
+    """Context manager recording the time of its block as a span.
+
+    Args:
+        name: (str) Name of the span.
+        cat: (str) Category, e.g. 'phase', 'command' or 'checker'.
+        lane: (str) Lane to show the span on, default the current thread's.
+        args: Shown with the span. The 'args' attribute of the returned object
+            can be updated inside the block.
+    """
+    return _Span(name, cat, lane, args)
+
+
+def complete(name, cat, start, end, lane=None, args=None):
+    """Record a span from start to end if tracing."""
+    if _tracer is not None:
+        _tracer.complete(name, cat, start, end, lane, args)
+
+
+def instant(name, cat, lane=None, **args):
+    """Record an event without duration if tracing."""
+    if _tracer is not None:
+        _tracer.instant(name, cat, lane, args)
+
+
+def tracing():
+    """Whether a trace is being recorded."""
+    return _tracer is not None
+
+
+def phase_stats(tracer):
+    """Where the time of every phase went.
+
+    Returns:
+        (dict of int to dict) For every phase: 'wall', its wall time;
+        'commands' and 'checkers', how many ran; 'acks' and 'checker_wall',
+        the time from the first start to the last end of commands and of
+        checkers; 'slowest_command' and 'slowest_checker', the name and
+        seconds of the slowest, or None.
+    """
+    phases = {}
+    for e in tracer.events:
+        if e['ph'] != 'X' or 'phase' not in e['args']:
+            continue
+        p = phases.setdefault(e['args']['phase'], {'command': [],
+                                                   'checker': [],
+                                                   'phase': []})
+        if e['cat'] in p:
+            p[e['cat']].append(e)
+
+    def window(events):
+        if not events:
+            return 0.0
+        return (max(e['ts'] + e['dur'] for e in events) -
+                min(e['ts'] for e in events))
+
+    def slowest(events):
+        if not events:
+            return None
+        e = max(events, key=lambda e: e['dur'])
+        return [e['name'].split(' ', 1)[-1], e['dur']]
+
+    stats = {}
+    for phase, p in phases.items():
+        stats[phase] = {
+            'wall': window(p['phase'] or p['command'] + p['checker']),
+            'commands': len(p['command']),
+            'acks': window(p['command']),
+            'slowest_command': slowest(p['command']),
+            'checkers': len(p['checker']),
+            'checker_wall': window(p['checker']),
+            'slowest_checker': slowest(p['checker']),
+        }
+    return stats
+
+
+def print_phase_summary(tracer):
+    """Print a table of where the time of every phase went.
+
+    For every phase: its wall time, how long commands took from sending to
+    acknowledgement, the slowest command, and the same for phase checkers.
+    """
+    stats = phase_stats(tracer)
+    if not stats:
+        return
+
+    def slowest(s):
+        return '-' if s is None else '%s (%.2fs)' % tuple(s)
+
+    print '\n', '=' * 20, "Phase summary", '=' * 20
+    print "%-6s %8s %5s %9s %-30s %5s %9s %-30s" % (
+        'phase', 'wall', 'cmds', 'acks', 'slowest command', 'chks',
+        'checkers', 'slowest checker')
+    for phase in sorted(stats):
+        p = stats[phase]
+        print "%-6s %7.2fs %5d %8.2fs %-30s %5d %8.2fs %-30s" % (
+            phase, p['wall'], p['commands'], p['acks'],
+            slowest(p['slowest_command'])[:30], p['checkers'],
+            p['checker_wall'], slowest(p['slowest_checker'])[:30])
@@ -0,0 +1,174 @@
+"""Live view of the processes running on all process managers.
+
+Process managers push the usage of their processes when asked with "top",
+sending only the entries that changed. ProcMgrProxy keeps the merged entries in
+ProcMgrProxy.top, and this module filters, sorts and renders them. See
+Console.top().
+"""
+
+import fnmatch
+import os
+import time
+
+# Sort keys and whether they sort in descending order.
+SORT_KEYS = {
+    'host': False,
+    'alias': False,
+    'state': False,
+    'cpu': True,
+    'rss': True,
+    'restarts': True,
+    'uptime': True,
+}
+
+
+class TopError(Exception):
+    """Error in the arguments of 'top'."""
+    def __init__(self, msg):
+        super(TopError, self).__init__(msg)
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+
+class TopOptions(object):
+    """Options of the 'top' command.
+
+    Usage: top [-s <key>] [-n <rows>] [-i <seconds>] [--once] [<glob>]
+
+    Attributes:
+        sort: (str) One of SORT_KEYS.
+        rows: (int) Maximum number of processes shown, None to fit the
+            terminal.
+        interval: (float) Seconds between refreshes.
+        once: (boolean) Print a single snapshot instead of refreshing.
+        pattern: (str) Glob matched against 'host', 'alias' and 'host/alias'.
+    """
+    def __init__(self, args):
+        self.sort = 'cpu'
+        self.rows = None
+        self.interval = 2.0
+        self.once = False
+        self.pattern = None
+        args = list(args)
+        try:
+            while args:
+                arg = args.pop(0)
+                if arg == '-s':
+                    self.sort = args.pop(0)
+                    if self.sort not in SORT_KEYS:
+                        raise TopError('Unknown sort key <%s>, use one of %s'
+                                       % (self.sort,
+                                          ', '.join(sorted(SORT_KEYS))))
+                elif arg == '-n':
+                    self.rows = int(args.pop(0))
+                elif arg == '-i':
+                    self.interval = float(args.pop(0))
+                elif arg == '--once':
+                    self.once = True
+                elif self.pattern is None and not arg.startswith('-'):
+                    self.pattern = arg
+                else:
+                    raise TopError('Unexpected argument <%s>' % arg)
+        except (IndexError, ValueError):
+            raise TopError('Missing or bad value of <%s>' % arg)
+
+    def matches(self, host, alias):
+        """Whether the process alias on host passes the filter."""
+        if self.pattern is None:
+            return True
+        return any(fnmatch.fnmatch(s, self.pattern)
+                   for s in (host, alias, '%s/%s' % (host, alias)))
+
+
+def rows(proxies, options):
+    """Collect the entries of all proxies that pass the filter.
+
+    Returns:
+        (list of dict) Entries with 'host' and 'uptime' added, sorted.
+    """
+    result = []
+    for pm in proxies:
+        host = '%s:%s' % pm.address
+        for alias, entry in pm.top.items():
+            if not options.matches(host, alias):
+                continue
+            row = dict(cpu=None, rss=None, started=None)
+            row.update(entry)
+            row['host'] = host
+            row['uptime'] = None
+            if row['started'] is not None and pm.top_time is not None:
+                # Both times come from the clock of the process manager.
+                row['uptime'] = pm.top_time - row['started']
+            result.append(row)
+    key = options.sort
+    result.sort(key=lambda r: (r['host'], r['alias']))
+    known = [r for r in result if r[key] is not None]
+    known.sort(key=lambda r: r[key], reverse=SORT_KEYS[key])
+    # Unknown values go last.
+    return known + [r for r in result if r[key] is None]
+
+
+def _format_duration(seconds):
+    if seconds is None:
+        return '-'
+    seconds = int(seconds)
+    if seconds >= 86400:
+        return '%dd%02dh' % (seconds / 86400, seconds % 86400 / 3600)
+    return '%02d:%02d:%02d' % (seconds / 3600, seconds % 3600 / 60,
+                               seconds % 60)
+
+
+def _format_rss(kb):
+    if kb is None:
+        return '-'
+    if kb >= 1024 * 1024:
+        return '%.1fG' % (kb / 1024.0 / 1024)
+    return '%dM' % (kb / 1024)
+
+
+def _terminal_rows():
+    """Number of rows of the terminal, 40 if unknown."""
+    try:
+        return int(os.popen('stty size 2>/dev/null', 'r').read().split()[0])
+    except (IndexError, ValueError):
+        return 40
+
+
+def render(proxies, options, clear=True):
+    """Render the view as a string.
+
+    Args:
+        proxies: (list of ProcMgrProxy) Connected proxies.
+        options: (TopOptions)
+        clear: (boolean) Start with the escape sequence clearing the screen.
+    """
+    all_rows = rows(proxies, options)
+    limit = options.rows
+    if limit is None:
+        limit = max(1, _terminal_rows() - 5) if clear else len(all_rows)
+    running = [r for r in all_rows if r['state'] == 'running']
+    lines = []
+    if clear:
+        lines.append('\033[H\033[2J')
+    lines.append('%s  hosts: %d  processes: %d (%d running)  cpu: %.1f%%  '
+                 'rss: %s  sort: %s%s' % (
+                     time.strftime('%H:%M:%S'), len(proxies), len(all_rows),
+                     len(running), sum(r['cpu'] or 0 for r in running),
+                     _format_rss(sum(r['rss'] or 0 for r in running)),
+                     options.sort,
+                     '  filter: %s' % options.pattern if options.pattern
+                     else ''))
+    lines.append('%-22s %-28s %-9s %7s %10s %4s %6s %7s' % (
+        'HOST', 'ALIAS', 'STATE', 'PID', 'UPTIME', 'RST', 'CPU%', 'RSS'))
+    for r in all_rows[:limit]:
+        lines.append('%-22s %-28s %-9s %7s %10s %4d %6s %7s' % (
+            r['host'][:22], r['alias'][:28], r['state'],
+            r['pid'] if r['pid'] is not None else '-',
+            _format_duration(r['uptime']), r['restarts'],
+            '%.1f' % r['cpu'] if r['cpu'] is not None else '-',
+            _format_rss(r['rss'])))
+    if len(all_rows) > limit:
+        lines.append('... %d more' % (len(all_rows) - limit))
+    return '\n'.join(lines)
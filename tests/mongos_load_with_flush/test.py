@@ -60,7 +60,8 @@ iostat_script = \
 """
 
 # SCRIPTS SHOULD BE IDEMPOTENT
-# They get run at each set-up, as normal user with sudo privs
+# They get run at set-up when their content changes (or on 'setup --force'),
+# as normal user with sudo privs
 
 echo "Installing iostat..."
 if [ -n "`command -v yum`" ]; then
@@ -206,29 +207,19 @@ print( "Sharding enabled." )
 init_shell = MongoShell(pms[5], 'shell_enable_sharding', cluster.mongoses[0], shard_coll_script, version='2.0.7')
 init_shell.gen_command(cluster.last_phase + 1)
 
-load_pms = [ pms[6], pms[7], pms[8], pms[9] ]
-
-for i in range(0, 200):
-    
-    load_pm = load_pms[i % len(load_pms)]
-    
-    load_shell = MongoShell(load_pm, 'shell_start_2.0.7_load_%d' % i, cluster.mongoses[0], \
-                            './driver.js', options={ 'waitFor' : 5 * 60 * 1000 + i * 100000 }, \
-                            isFile=True, version='2.0.7')
-    
-    load_shell.gen_command(init_shell.last_phase + 1)
-    
-load_pms = [ pms[11], pms[12], pms[13], pms[14] ]
-
-for i in range(0, 200):
-    
-    load_pm = load_pms[i % len(load_pms)]
-    
-    load_shell = MongoShell(load_pm, 'shell_start_2.2.0_load_%d' % i, cluster.mongoses[1], \
-                            './driver.js', options={ 'waitFor' : 5 * 60 * 1000 + i * 100000 }, \
-                            isFile=True, version='2.0.7')
+# 200 clients against each mongos, in one load generator per load machine.
+# Client i starts after 5 minutes plus i * 100s, like the shells that ran
+# driver.js one by one.
+for mongos, load_pms in [ (cluster.mongoses[0], [ pms[6], pms[7], pms[8], pms[9] ]),
+                          (cluster.mongoses[1], [ pms[11], pms[12], pms[13], pms[14] ]) ]:
     
-    load_shell.gen_command(init_shell.last_phase + 1)
+    for i, load_pm in enumerate(load_pms):
+        
+        load = LoadGenerator(load_pm, 'load_%s_%d' % (mongos.name, i), mongos, \
+                             clients=200 / len(load_pms), \
+                             wait_for=5 * 60 + i * 100, ramp_up=len(load_pms) * 100)
+        
+        load.gen_command(init_shell.last_phase + 1)
     
 chaos_pm = pms[4]
 chaos_shell = MongoShell(chaos_pm, 'shell_start_chaos', cluster.mongoses[0], \